@@ -1,6 +1,8 @@
 from IPython.display import Image
 #connect to application
-from app import * 
+from models import *
+from documents import model_document, chain_document
+import render
 #this gives us access to the database through a variables "db"
 def save(thing):
     if thing == None:
@@ -41,19 +43,29 @@ def link_tps_to_chains():
         tp.Chain = chain
         save(tp)
         
+def unlinked_document():
+    # States created for a chain that was never found belong to no chain;
+    # drawn together as chain 0, like the Chain=None query used to
+    states = State.query.filter_by(chain_id=None).order_by(State.id).all()
+    ids = set(state.id for state in states)
+    tps = [tp for tp in Transition_probability.query.order_by(Transition_probability.id).all()
+           if tp.From_state_id in ids]
+    return {'id': 0, 'name': 'No chain',
+            'states': [{'id': state.id, 'name': state.name} for state in states],
+            'transition_probabilities': [{'id': tp.id, 'from_state_id': tp.From_state_id,
+                                          'to_state_id': tp.To_state_id, 'tp_base': tp.Tp_base,
+                                          'is_dynamic': tp.Is_dynamic} for tp in tps],
+            'interactions': []}
+
 def visualize_chain(chain):
-    tps = Transition_probability.query.filter_by(Chain=chain).all()
-    G=pgv.AGraph(directed=True, rankdir="LR")
-    
-    for tp in tps:
-        G.add_node(tp.From_state.name, shape="box", fontname="ArialMT")
-        G.add_node(tp.To_state.name, shape="box", fontname="ArialMT")
-        if tp.Is_dynamic:
-            G.add_edge(tp.From_state.name, tp.To_state.name, label="Dynamic", fontname="ArialMT", fontsize="10") # adds edge 'b'-'c' (and also nodes 'b', 'c')
-        else:
-            G.add_edge(tp.From_state.name, tp.To_state.name, label=tp.Tp_base, fontname="ArialMT", fontsize="10") # adds edge 'b'-'c' (and also nodes 'b', 'c')
-    G.layout(prog='dot')
-    G.draw('file.png')
+    # Cached per version of the chain, see render.py; returns the PNG's path
+    document = None
+    if chain is not None:
+        document = chain_document(model_document(), chain.id)
+    if document is None:
+        print('No chain %r in the database; drawing the states without a chain' % (chain,))
+        document = unlinked_document()
+    return render.render_chain(document, ('png',))[0]
 # create the chains we need
 chain_names = ['TB disease', 'TB treatment', 'TB resistance',
           'HIV disease', 'HIV treatment', 'HIV risk groups',
@@ -245,10 +257,9 @@ import pygraphviz as pgv
 import time
 
 
-# In order to convert yearly rates to quarterly rates, we use the following function
-# TODO this is not really true - to discuss
-def convert_year_to_qt(value):
-    return value/4
+# In order to convert yearly rates to quarterly rates, we use the following
+# function; it lives in parameters.py so that expressions can use it too
+from parameters import convert_year_to_qt
 
 
 # TODO: Run PSA changes here?
@@ -289,7 +300,8 @@ slow_to_noninfectious_active = convert_year_to_qt(rate_slow_annual.value*(1.0-pr
 save(Transition_probability(
     From_state=slow_latent_state,
     To_state=noninfectious_active_state,
-    Tp_base=slow_to_noninfectious_active
+    Tp_base=slow_to_noninfectious_active,
+    Tp_expression="convert_year_to_qt(rate_slow_annual*(1.0-prop_infectious))"
 ))
 
 # Slow latent to infectious active
@@ -299,7 +311,8 @@ slow_to_infectious_active = convert_year_to_qt(rate_slow_annual.value*prop_infec
 save(Transition_probability(
     From_state=slow_latent_state,
     To_state=infectious_active_state,
-    Tp_base=slow_to_infectious_active
+    Tp_base=slow_to_infectious_active,
+    Tp_expression="convert_year_to_qt(rate_slow_annual*prop_infectious)"
 ))
 
 # Fast latent to non-infectious active
@@ -309,7 +322,8 @@ fast_to_noninfectious_active = convert_year_to_qt(rate_fast_annual.value*(1.0-pr
 save(Transition_probability(
     From_state=fast_latent_state,
     To_state=noninfectious_active_state,
-    Tp_base=fast_to_noninfectious_active
+    Tp_base=fast_to_noninfectious_active,
+    Tp_expression="convert_year_to_qt(rate_fast_annual*(1.0-prop_infectious))"
 ))
 
 # Fast latent to infectious active
@@ -319,7 +333,8 @@ fast_to_infectious_active = convert_year_to_qt(rate_fast_annual.value*prop_infec
 save(Transition_probability(
     From_state=fast_latent_state,
     To_state=infectious_active_state,
-    Tp_base=fast_to_infectious_active
+    Tp_base=fast_to_infectious_active,
+    Tp_expression="convert_year_to_qt(rate_fast_annual*prop_infectious)"
 ))
 
 # Self cure - infectious
@@ -329,7 +344,8 @@ rate_self_cure_qt = convert_year_to_qt(rate_self_cure_annual.value)
 save(Transition_probability(
     From_state=infectious_active_state,
     To_state=self_cure_from_infectious,
-    Tp_base=rate_self_cure_qt
+    Tp_base=rate_self_cure_qt,
+    Tp_expression="convert_year_to_qt(rate_self_cure_annual)"
 ))
 
 # Self cure - noninfectious
@@ -339,7 +355,8 @@ rate_self_cure_qt = convert_year_to_qt(rate_self_cure_annual.value)
 save(Transition_probability(
     From_state=noninfectious_active_state,
     To_state=self_cure_from_noninfectious,
-    Tp_base=rate_self_cure_qt
+    Tp_base=rate_self_cure_qt,
+    Tp_expression="convert_year_to_qt(rate_self_cure_annual)"
 ))
 
 # Relapse from self cure - infectious
@@ -349,7 +366,8 @@ rate_relapse_from_self_cure_qt = convert_year_to_qt(rate_relapse_from_self_cure_
 save(Transition_probability(
     From_state=self_cure_from_infectious ,
     To_state=infectious_active_state,
-    Tp_base=rate_relapse_from_self_cure_qt
+    Tp_base=rate_relapse_from_self_cure_qt,
+    Tp_expression="convert_year_to_qt(rate_relapse_from_self_cure_annual)"
 ))
 
 # Replase from self cure - noninfectious
@@ -359,7 +377,8 @@ rate_relapse_from_self_cure_qt = convert_year_to_qt(rate_relapse_from_self_cure_
 save(Transition_probability(
     From_state=self_cure_from_noninfectious,
     To_state=noninfectious_active_state,
-    Tp_base=rate_relapse_from_self_cure_qt
+    Tp_base=rate_relapse_from_self_cure_qt,
+    Tp_expression="convert_year_to_qt(rate_relapse_from_self_cure_annual)"
 ))
 
 
@@ -370,7 +389,8 @@ rate_conversion_qt = convert_year_to_qt(rate_conversion_annual.value)
 save(Transition_probability(
     From_state=noninfectious_active_state,
     To_state=infectious_active_state,
-    Tp_base=rate_conversion_qt
+    Tp_base=rate_conversion_qt,
+    Tp_expression="convert_year_to_qt(rate_conversion_annual)"
 ))
 
 
@@ -381,7 +401,8 @@ noninfect_tb_mort_qt = convert_year_to_qt(noninfect_tb_mort_annual.value)
 save(Transition_probability(
     From_state=noninfectious_active_state,
     To_state=death_state,
-    Tp_base=noninfect_tb_mort_qt
+    Tp_base=noninfect_tb_mort_qt,
+    Tp_expression="convert_year_to_qt(noninfect_tb_mort_annual)"
 ))
 
 # Mortality - from infectious
@@ -391,11 +412,11 @@ infect_tb_mort_qt = convert_year_to_qt(infect_tb_mort_annual.value)
 save(Transition_probability(
     From_state=infectious_active_state,
     To_state=death_state,
-    Tp_base=infect_tb_mort_qt
+    Tp_base=infect_tb_mort_qt,
+    Tp_expression="convert_year_to_qt(infect_tb_mort_annual)"
 ))
 link_tps_to_chains()
-visualize_chain(tb_chain)
-Image(filename='file.png')
+Image(filename=visualize_chain(tb_chain))
 # get TB resistance chain
 tb_resistance_chain = Chain.query.filter_by(name="TB resistance").first()
 
@@ -529,8 +550,7 @@ save(Transition_probability(
     Is_dynamic=True
 ))
 link_tps_to_chains()
-visualize_chain(tb_resistance_chain)
-Image(filename='file.png')
+Image(filename=visualize_chain(tb_resistance_chain))
 # get TB treatment chain
 tb_treatment_chain = Chain.query.filter_by(name="TB treatment").first()
 
@@ -571,6 +591,7 @@ save(percent_diagnosed_treated)
 overall_percent_active_treated = Raw_input(
     name="Percent of all active that will be treated",
     slug="overall_percent_active_treated",
+    expression="percent_diagnosed_treated * case_detection_rate",
     value=percent_diagnosed_treated.value * case_detection_rate.value,
     low=percent_diagnosed_treated.low * case_detection_rate.low,
     high=percent_diagnosed_treated.high * case_detection_rate.high,
@@ -621,7 +642,8 @@ save(Transition_probability(
 save(Transition_probability(
     From_state=untreated_active_state,
     To_state=treated_state,
-    Tp_base=enrollment_rate_qt
+    Tp_base=enrollment_rate_qt,
+    Tp_expression="convert_year_to_qt(overall_percent_active_treated)"
 ))
 
 
@@ -629,11 +651,11 @@ save(Transition_probability(
 save(Transition_probability(
     From_state=treated_state,
     To_state=untreated_active_state,
-     Tp_base=drop_out_rate_qt
+     Tp_base=drop_out_rate_qt,
+     Tp_expression="convert_year_to_qt(drop_out_rate_annual)"
 ))
 link_tps_to_chains()
-visualize_chain(tb_treatment_chain)
-Image(filename='file.png')
+Image(filename=visualize_chain(tb_treatment_chain))
 
 # get TB resistance chain
 hiv_disease_chain = Chain.query.filter_by(name="HIV disease").first()
@@ -685,6 +707,7 @@ general_parternships = Raw_input(
     high=2,
     reference=reference
 )
+save(general_parternships)
 
 
 reference = Reference(name="Alistar 137 using data from Cohen 33 and Hollingsworth 138")
@@ -938,6 +961,7 @@ save(Transition_probability(
     From_state=acute_state,
     To_state=early_state,
     Tp_base=acute_to_early_qt,
+    Tp_expression="convert_year_to_qt(acute_to_early_annual)",
     Is_dynamic=False
 ))
 
@@ -947,6 +971,7 @@ save(Transition_probability(
     From_state=early_state,
     To_state=late_state,
     Tp_base=early_to_late_qt,
+    Tp_expression="convert_year_to_qt(early_to_late_annual)",
     Is_dynamic=False
 ))
     
@@ -956,6 +981,7 @@ save(Transition_probability(
     From_state=late_state,
     To_state=advanced_state,
     Tp_base=late_to_adv_qt,
+    Tp_expression="convert_year_to_qt(late_to_adv_annual)",
     Is_dynamic=False
 ))      
 
@@ -971,6 +997,7 @@ save(Transition_probability(
     From_state=early_state,
     To_state=death_state,
     Tp_base=early_hiv_mortality_qt,
+    Tp_expression="convert_year_to_qt(early_hiv_mortality_annual)",
     Is_dynamic=False
 ))
     
@@ -980,6 +1007,7 @@ save(Transition_probability(
     From_state=late_state,
     To_state=death_state,
     Tp_base=late_hiv_mortality_qt,
+    Tp_expression="convert_year_to_qt(late_hiv_mortality_annual)",
     Is_dynamic=False
 ))    
 
@@ -989,11 +1017,11 @@ save(Transition_probability(
     From_state=advanced_state,
     To_state=death_state,
     Tp_base=advanced_hiv_mortality_qt,
+    Tp_expression="convert_year_to_qt(advanced_hiv_mortality_annual)",
     Is_dynamic=False
 ))    
 link_tps_to_chains()
-visualize_chain(hiv_disease_chain)
-Image(filename='file.png')
+Image(filename=visualize_chain(hiv_disease_chain))
 # get TB chain
 hiv_treatment_chain = Chain.query.filter_by(name="HIV treatment").first()
 
@@ -1057,6 +1085,7 @@ save(Transition_probability(
     From_state=untreated_state,
     To_state=treated_state,
     Tp_base=hiv_treatment_recruitment_qt,
+    Tp_expression="convert_year_to_qt(hiv_treatment_recruitment_annual)",
     Is_dynamic=False
 ))
 
@@ -1065,11 +1094,11 @@ save(Transition_probability(
     From_state=treated_state,
     To_state=untreated_state,
     Tp_base=hiv_treatment_drop_out_qt,
+    Tp_expression="convert_year_to_qt(hiv_treatment_drop_out_annual)",
     Is_dynamic=False
 ))
 link_tps_to_chains()
-visualize_chain(hiv_treatment_chain)
-Image(filename='file.png')
+Image(filename=visualize_chain(hiv_treatment_chain))
 # get TB chain
 hiv_risk_groups_chain = Chain.query.filter_by(name="HIV risk groups").first()
 
@@ -1258,8 +1287,7 @@ save(Transition_probability(
 ))
 
 link_tps_to_chains()
-visualize_chain(hiv_risk_groups_chain)
-Image(filename='file.png')
+Image(filename=visualize_chain(hiv_risk_groups_chain))
 # get TB chain
 diabetes_disease_and_treatment = Chain.query.filter_by(name="Diabetes disease and treatment").first()
 
@@ -1361,6 +1389,7 @@ save(Transition_probability(
     From_state=no_diabetes_state,
     To_state=pre_diabetes_state,
     Tp_base=risk_of_pre_dm_qt,
+    Tp_expression="convert_year_to_qt(risk_of_pre_dm_annual)",
     Is_dynamic=False
 ))
 
@@ -1370,6 +1399,7 @@ save(Transition_probability(
     From_state=pre_diabetes_state,
     To_state=uncomplicated_diabetes_state,
     Tp_base=risk_of_uncomplicated_dm_qt,
+    Tp_expression="convert_year_to_qt(risk_of_uncomplicated_dm_annual)",
     Is_dynamic=False
 ))
 
@@ -1379,6 +1409,7 @@ save(Transition_probability(
     From_state=uncomplicated_diabetes_state,
     To_state=complicated_diabetes_non_cvd_state,
     Tp_base=progression_of_diabetes_qt,
+    Tp_expression="convert_year_to_qt(progression_of_diabetes_annual)",
     Is_dynamic=False
 ))
 
@@ -1389,12 +1420,12 @@ save(Transition_probability(
     From_state=complicated_diabetes_non_cvd_state,
     To_state=complicated_diabetes_cvd_state,
     Tp_base=progression_of_diabetes_cvd_qt,
+    Tp_expression="convert_year_to_qt(progression_of_diabetes_cvd_annual)",
     Is_dynamic=False
 ))
 
 link_tps_to_chains()
-visualize_chain(dm_disease_chain)
-Image(filename='file.png')
+Image(filename=visualize_chain(dm_disease_chain))
 
 # Transition from untreated uncomplicated to treated uncomplicated; WAG
 
@@ -1,23 +1,25 @@
-
 import os
-from flask import Flask, render_template, session, redirect, url_for, flash
-app = Flask(__name__)
+import json
+import time
+from flask import Flask, Blueprint, render_template, session, redirect, url_for, flash, jsonify, \
+	request, abort, Response, stream_with_context, send_file, current_app
 
-app.config['SECRET_KEY'] = 'x3432d3232432lkjew3242'
-# allows for debuging mode in runserver
-app.config['DEBUG'] = True 
+# Importing this module only defines the application; create_app() builds it.
+# The tables live in models.py, which simulation workers import on their own.
 
 from flask.ext.script import Manager, Shell
-manager = Manager(app)
-
 from flask.ext.bootstrap import Bootstrap
-bootstrap = Bootstrap(app)
 
 # Flask-WTF
 from flask.ext.wtf import Form
 from wtforms import StringField, SubmitField 
 from wtforms.validators import Required
 
+from models import *
+from documents import model_document, chain_document
+
+main = Blueprint('main', __name__)
+
 class NameForm(Form):
 	name = StringField('What is your name?', validators=[Required()]) 
 	submit = SubmitField('Submit')
@@ -25,7 +27,7 @@ class NameForm(Form):
 
 #### ---------------- Routes -------------------------
 
-@app.route('/', methods=['GET', 'POST']) 
+@main.route('/', methods=['GET', 'POST']) 
 def index():
 	form = NameForm()
 	if form.validate_on_submit():
@@ -34,180 +36,275 @@ def index():
 			flash('Looks like you have changed your name!')
 		session['name'] = form.name.data
 		form.name.data = ''
-		return redirect(url_for('index'))
+		return redirect(url_for('.index'))
 	return render_template('index.html', form=form, name=session.get('name'))
 
 
-@app.route('/user/<name>') 
+@main.route('/user/<name>') 
 def user(name):
 	return render_template('user.html', name=name)
 
 
-@app.route('/chains') 
+@main.route('/chains') 
 def chains_view():
-	chains = Chain.query.all()
+	chains = cached_document(model_revision(), 'chains', model_document)
 	return render_template('chains.html', chains=chains)
 
-# if __name__ == '__main__':
-# 	app.run(debug=True)
+
+@main.route('/states')
+def states_view():
+	chains = cached_document(model_revision(), 'chains', model_document)
+	return render_template('states.html', chains=chains)
+
+
+@main.route('/transition_probabilities')
+def transition_probabilities_view():
+	chains = cached_document(model_revision(), 'chains', model_document)
+	state_names = dict((state['id'], state['name']) for chain in chains for state in chain['states'])
+	return render_template('transition_probabilities.html', chains=chains, state_names=state_names)
+
+
+@main.route('/chains/<int:chain_id>/diagram.<format>')
+def chain_diagram(chain_id, format):
+	# Laid out on first request for each version of a chain, see render.py
+	if format not in render.FORMATS:
+		abort(404)
+	chain = chain_or_404(cached_document(model_revision(), 'chains', model_document), chain_id)
+	path = render.render_chain(chain, (format,))[0]
+	return send_file(path, conditional=True)
+
+
+#### ---------------- Jobs -------------------------
+
+# Simulations run in background worker processes, see jobs.py
+
+from jobs import JobQueue, DONE, FAILED, start_workers, job_directory
+import profiling
+import render
 
 
+def job_queue():
+	return current_app.extensions['job_queue']
 
 
+@main.route('/jobs', methods=['GET'])
+def jobs_view():
+	return jsonify(jobs=job_queue().list(request.args.get('status')))
 
-#### ---------------- Models -------------------------
 
-from flask.ext.sqlalchemy import SQLAlchemy
-basedir = os.path.abspath(os.path.dirname(__file__))
+@main.route('/jobs', methods=['POST'])
+def submit_job():
+	body = request.get_json(force=True) or {}
+	try:
+		job_id = job_queue().submit(body.get('kind'), body.get('params'))
+	except ValueError as e:
+		return jsonify(error=str(e)), 400
+	response = jsonify(job_queue().get(job_id))
+	response.status_code = 202
+	response.headers['Location'] = url_for('.job_view', job_id=job_id)
+	return response
 
-app.config['SQLALCHEMY_DATABASE_URI'] =\
-    'sqlite:///' + os.path.join(basedir, 'database/limsa.sqlite')
-app.config['SQLALCHEMY_COMMIT_ON_TEARDOWN'] = True
 
-db = SQLAlchemy(app)
+@main.route('/jobs/<int:job_id>')
+def job_view(job_id):
+	job = job_queue().get(job_id)
+	if job is None:
+		abort(404)
+	return jsonify(job)
 
 
-class Chain(db.Model):
-	__tablename__ = 'chains'
-	id = db.Column(db.Integer, primary_key=True)
-	name = db.Column(db.String(64), unique=True)
-	states = db.relationship('State', backref='chain')
+@main.route('/jobs/<int:job_id>/progress')
+def job_progress(job_id):
+	# Server-sent events: one message whenever the job's progress changes,
+	# until it is done or has failed
+	if job_queue().get(job_id) is None:
+		abort(404)
 
-	def __repr__(self):
-		return self.name
+	def events():
+		last = None
+		while True:
+			job = job_queue().get(job_id)
+			progress = dict((key, job[key]) for key in ('status', 'done', 'total', 'unit'))
+			if progress != last:
+				yield 'data: %s\n\n' % json.dumps(progress)
+				last = progress
+			if job['status'] in (DONE, FAILED):
+				return
+			time.sleep(1)
 
-class State(db.Model):
-	__tablename__ = 'states'
-	id = db.Column(db.Integer, primary_key=True)
-	name = db.Column(db.String(64))
-	chain_id = db.Column(db.Integer,db.ForeignKey('chains.id'))
-	Chain = db.relationship("Chain", foreign_keys=[chain_id])
+	return Response(stream_with_context(events()), mimetype='text/event-stream')
 
 
-	# TODO: Add chain name to representation
-	def __repr__(self):
-		return self.name
+@main.route('/jobs/<int:job_id>/profile')
+def job_profile(job_id):
+	# Time per phase, counters and cycles per second of a finished job's run
+	if job_queue().get(job_id) is None:
+		abort(404)
+	report = profiling.read(job_directory(job_id))
+	if report is None:
+		abort(404)
+	return jsonify(report)
 
-class Transition_probability(db.Model):
-	__tablename__ = 'transition_probabilities'
-	id = db.Column(db.Integer, primary_key=True)
 
-	From_state_id = db.Column(db.Integer,db.ForeignKey('states.id'))
-	To_state_id = db.Column(db.Integer,db.ForeignKey('states.id'))
+#### ---------------- API -------------------------
 
-	From_state = db.relationship("State", foreign_keys=[From_state_id])
-	To_state = db.relationship("State", foreign_keys=[To_state_id])
+# Read-only JSON for the Go side and dashboards. Every document is built in
+# a constant number of queries (chains are loaded with their states in one
+# joined query, transitions and interactions in one query each) and kept in
+# memory until the model revision changes. Responses carry the revision as
+# their ETag, so a poll with a matching If-None-Match costs one query and
+# returns 304 Not Modified.
 
-	Tp_base = db.Column(db.Float)
+api_cache = {'revision': None, 'documents': {}}
 
-	Is_dynamic = db.Column(db.Boolean)
 
-	Chain_id = db.Column(db.Integer,db.ForeignKey('chains.id'))
-	Chain = db.relationship("Chain", foreign_keys=[Chain_id])
+def cached_document(revision, name, build):
+	# Documents are rebuilt only after the model has changed
+	if api_cache['revision'] != revision:
+		api_cache['revision'] = revision
+		api_cache['documents'] = {}
+	if name not in api_cache['documents']:
+		api_cache['documents'][name] = build()
+	return api_cache['documents'][name]
 
-	def __repr__(self):
-		return self.From_state.name + " => " + self.To_state.name
 
-class Interaction(db.Model):
-	__tablename__ = 'interactions'
-	id = db.Column(db.Integer, primary_key=True)
+def api_response(name, build=None):
+	# build(chains) derives the document from the full model document
+	revision = model_revision()
+	etag = 'r%d' % revision
+	if request.if_none_match.contains(etag):
+		response = Response(status=304)
+	else:
+		chains = cached_document(revision, 'chains', model_document)
+		document = chains if build is None else \
+			cached_document(revision, name, lambda: build(chains))
+		response = Response(json.dumps(document), mimetype='application/json')
+	response.set_etag(etag)
+	response.headers['X-Model-Revision'] = str(revision)
+	return response
 
-	In_state_id = db.Column(db.Integer,db.ForeignKey('states.id'))
-	From_state_id = db.Column(db.Integer,db.ForeignKey('states.id'))
-	To_state_id = db.Column(db.Integer,db.ForeignKey('states.id'))
 
-	In_state = db.relationship("State", foreign_keys=[In_state_id])
-	From_state = db.relationship("State", foreign_keys=[From_state_id])
-	To_state = db.relationship("State", foreign_keys=[To_state_id])
+def chain_or_404(chains, chain_id):
+	chain = chain_document(chains, chain_id)
+	if chain is None:
+		abort(404)
+	return chain
 
-	Adjustment = db.Column(db.Float)
 
-	Effected_chain_id = db.Column(db.Integer,db.ForeignKey('chains.id'))
+@main.route('/api/revision')
+def api_revision():
+	return jsonify(revision=model_revision())
 
-	def __repr__(self):
-		return self.In_state.name + " affects " + self.From_state.name + " => " + self.To_state.name
 
-# type TransitionProbability struct {
-# 	Id      int
-# 	From_id int
-# 	To_id   int
-# 	Tp_base float64
-# 	PSA_id  int
-# }
+@main.route('/api/chains')
+def api_chains():
+	return api_response('chains')
 
-# type Interaction struct {
-# 	Id                int
-# 	In_state_id       int
-# 	From_state_id     int
-# 	To_state_id       int
-# 	Adjustment        float64
-# 	Effected_model_id int
-# 	PSA_id            int
-# }
 
+@main.route('/api/chains/<int:chain_id>')
+def api_chain(chain_id):
+	return api_response('chains/%d' % chain_id, lambda chains: chain_or_404(chains, chain_id))
 
 
-class Raw_input(db.Model):
-	__tablename__ = 'raw_inputs'
-	id = db.Column(db.Integer, primary_key=True)
-	name = db.Column(db.String(64), unique=True)
-	slug = db.Column(db.String(64), unique=True)
-	value = db.Column(db.Float)
-	low = db.Column(db.Float)
-	high = db.Column(db.Float)
-	reference_id = db.Column(db.Integer,db.ForeignKey('references.id'))
+@main.route('/api/states')
+def api_states():
+	return api_response('states', lambda chains: [dict(state, chain_id=chain['id'])
+		for chain in chains for state in chain['states']])
 
-	def __repr__(self):
-		return self.name
 
-class Reference(db.Model):
-	__tablename__ = 'references'
-	id = db.Column(db.Integer, primary_key=True)
-	name = db.Column(db.String(4000))
-	bibtex = db.Column(db.String(2000))
-	raw_data = db.relationship('Raw_input', backref='reference')
+@main.route('/api/transition_probabilities')
+def api_transition_probabilities():
+	return api_response('transition_probabilities', lambda chains: [dict(tp, chain_id=chain['id'])
+		for chain in chains for tp in chain['transition_probabilities']])
 
-	def __repr__(self):
-		return self.name
 
+@main.route('/api/interactions')
+def api_interactions():
+	return api_response('interactions', lambda chains: [dict(interaction, chain_id=chain['id'])
+		for chain in chains for interaction in chain['interactions']])
 
-#### ---------------- Admin -------------------------
 
+#### ---------------- Application -------------------------
 
 from flask.ext.superadmin import Admin, model
+from flask.ext.migrate import Migrate, MigrateCommand
 
 
- # Create admin
-admin = Admin(app, 'Simple Models')
+def create_app(config=None):
+	app = Flask(__name__)
 
-# Add views
-admin.register(Chain, session=db.session)
-admin.register(State, session=db.session)
-admin.register(Raw_input, session=db.session)
-admin.register(Reference, session=db.session)
-admin.register(Transition_probability, session=db.session)
-admin.register(Interaction, session=db.session)
+	app.config['SECRET_KEY'] = 'x3432d3232432lkjew3242'
+	# allows for debuging mode in runserver
+	app.config['DEBUG'] = True 
+	app.config['SQLALCHEMY_DATABASE_URI'] = db.uri
+	app.config['SQLALCHEMY_COMMIT_ON_TEARDOWN'] = True
+	app.config.update(config or {})
+	if app.config['SQLALCHEMY_DATABASE_URI'] != db.uri:
+		db.configure(app.config['SQLALCHEMY_DATABASE_URI'])
 
+	Bootstrap(app)
+	app.register_blueprint(main)
+	app.extensions['job_queue'] = JobQueue()
 
-# admin.add_view(sqlamodel.ModelView(Post, session=db.session))
+	@app.teardown_appcontext
+	def shutdown_session(response_or_exc):
+		if app.config['SQLALCHEMY_COMMIT_ON_TEARDOWN'] and response_or_exc is None:
+			db.session.commit()
+		db.session.remove()
 
-# Create DB
-db.create_all()
+	# Create admin
+	admin = Admin(app, 'Simple Models')
 
+	# Add views
+	admin.register(Chain, session=db.session)
+	admin.register(State, session=db.session)
+	admin.register(Raw_input, session=db.session)
+	admin.register(Reference, session=db.session)
+	admin.register(Transition_probability, session=db.session)
+	admin.register(Interaction, session=db.session)
+	admin.register(Tag, session=db.session)
+	admin.register(Initialization_probability, session=db.session)
+	admin.register(Run, session=db.session)
 
-# Start app
-### Migration manager
+	# admin.add_view(sqlamodel.ModelView(Post, session=db.session))
+
+	### Migration manager
+	Migrate(app, db)
+	return app
 
-from flask.ext.migrate import Migrate, MigrateCommand
 
-migrate = Migrate(app, db)
+manager = Manager(create_app)
 manager.add_command('db', MigrateCommand)
 
 
-# if __name__ == '__main__': 
-# 	manager.run()
+@manager.command
+def create_db():
+	"""Create any missing tables"""
+	db.create_all()
 
-if __name__ == '__main__':
-	app.run(host='0.0.0.0')
+
+@manager.option('-p', '--processes', dest='processes', default=None)
+def render_diagrams(processes):
+	"""Render the diagrams of every chain"""
+	chains = model_document()
+	render.render_all(chains, processes=int(processes) if processes else None)
+	render.prune(chains)
 
 
+@manager.command
+def codegen():
+	"""Write the Go and Python parameter modules"""
+	import codegen as generator
+	generator.main()
+
+
+@manager.option('-p', '--processes', dest='processes', default=2)
+def worker(processes):
+	"""Run queued simulation jobs"""
+	start_workers(int(processes))
+
+
+if __name__ == '__main__':
+	app = create_app()
+	db.create_all()
+	app.run(host='0.0.0.0')
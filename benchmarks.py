@@ -0,0 +1,333 @@
+from __future__ import division
+
+# Benchmarks for the simulation and the web app.
+#
+#     python benchmarks.py [--quick] [--only compile,cohort,...] [--output path]
+#     python benchmarks.py --compare old.json new.json
+#
+# Synthetic models are built in memory with the shape of the real model
+# (nine chains of a few states) and scaled up to 100 chains x 50 states:
+# each state moves on to the next with a probability given by its own
+# Raw_input, or to the chain's last (Death) state, and every chain after the
+# first has an interaction with the one before it. The suite measures
+#
+#   compile     compile_model time at each model size
+#   cohort      cohort engine cycles per second for a batch of scenarios, in
+#               float64 and float32 (with the float32 run's precision error)
+#   microsim    microsimulation cycles per second and memory per person,
+#               for populations of 10^3 to 10^7 in the nine-chain model, with
+#               the grouped step and each kernel backend (see kernels.py),
+#               after checking the numba kernel against the numpy one
+#   psa         PSA draws per second per core
+#   api         /chains and /api/chains latency against a synthetic database
+#               (skipped when Flask is not installed)
+#
+# Results are written as JSON to benchmark_results/<commit>.json, one file per
+# commit, with the machine and library versions. Metric names end in their
+# unit (_seconds, _per_second, _bytes), which tells --compare whether a change
+# is a regression: it prints the ratio of every metric in two result files
+# and flags those more than --threshold worse.
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from collections import namedtuple, OrderedDict
+
+import numpy as np
+
+import kernels
+from compiler import compile_model
+from engine import Engine, precision_error, state_outcome
+from population import Population
+from psa import PSA
+from reducers import Reducer
+
+
+basedir = os.path.abspath(os.path.dirname(__file__))
+RESULTS_DIR = os.path.join(basedir, 'benchmark_results')
+
+MODEL_SIZES = [(9, 8), (25, 20), (100, 50)]
+POPULATIONS = [10 ** 3, 10 ** 4, 10 ** 5, 10 ** 6, 10 ** 7]
+
+QUICK_MODEL_SIZES = [(9, 8), (25, 20)]
+QUICK_POPULATIONS = [10 ** 3, 10 ** 4, 10 ** 5]
+
+ChainRow = namedtuple('ChainRow', 'id name')
+StateRow = namedtuple('StateRow', 'id name chain_id cost_input_id utility_input_id disability_input_id')
+TransitionRow = namedtuple('TransitionRow',
+                           'id From_state_id To_state_id Tp_base Tp_expression Is_dynamic Cost_input_id')
+InputRow = namedtuple('InputRow', 'id slug name value low high expression')
+InteractionRow = namedtuple('InteractionRow', 'id In_state_id From_state_id To_state_id Adjustment')
+
+
+#### ---------------- Synthetic models -------------------------
+
+def synthetic_rows(n_chains, n_states):
+    """Database-like rows for a model of n_chains chains of n_states states."""
+    chains, states, transitions, inputs, interactions = [], [], [], [], []
+    for c in range(n_chains):
+        chains.append(ChainRow(c + 1, 'Chain %d' % c))
+        first = len(states) + 1
+        for s in range(n_states):
+            state_id = first + s
+            inputs.append(InputRow(state_id, 'p_%d_%d' % (c, s), 'Progression %d %d' % (c, s),
+                                   0.05, 0.03, 0.08, None))
+            states.append(StateRow(state_id, 'State %d' % s if s < n_states - 1 else 'Death',
+                                   c + 1, state_id, None, None))
+        for s in range(n_states - 1):
+            state_id = first + s
+            transitions.append(TransitionRow(len(transitions) + 1, state_id, state_id + 1, None,
+                                             'convert_year_to_qt(p_%d_%d)' % (c, s), False, None))
+            if s < n_states - 2:
+                transitions.append(TransitionRow(len(transitions) + 1, state_id, first + n_states - 1,
+                                                 0.002, None, False, None))
+        if c:
+            previous = first - n_states
+            interactions.append(InteractionRow(c, previous + 1, first, first + 1, 1.5))
+    return chains, states, transitions, inputs, interactions
+
+
+def synthetic_model(n_chains, n_states):
+    return compile_model(*synthetic_rows(n_chains, n_states))
+
+
+def timed(function, repeat=3):
+    """Best wall time of repeat calls, and the last result."""
+    best, result = None, None
+    for _ in range(repeat):
+        start = time.time()
+        result = function()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+#### ---------------- Benchmarks -------------------------
+
+def bench_compile(sizes):
+    results = OrderedDict()
+    for n_chains, n_states in sizes:
+        rows = synthetic_rows(n_chains, n_states)
+        seconds, _ = timed(lambda: compile_model(*rows))
+        results['%dx%d' % (n_chains, n_states)] = {'compile_seconds': seconds}
+    return results
+
+
+def bench_cohort(sizes, n_scenarios=32, n_cycles=40):
+    results = OrderedDict()
+    for n_chains, n_states in sizes:
+        model = synthetic_model(n_chains, n_states)
+        values = model.parameters.base(n_scenarios)
+        for dtype, suffix in ((np.float64, ''), (np.float32, '/float32')):
+            engine = Engine(model, n_cycles, batch_size=n_scenarios, dtype=dtype)
+            seconds, _ = timed(lambda: engine.run(values), repeat=2)
+            results['%dx%d%s' % (n_chains, n_states, suffix)] = {
+                'cycles_per_second': n_cycles / seconds,
+                'scenario_cycles_per_second': n_scenarios * n_cycles / seconds,
+            }
+        results['%dx%d/float32' % (n_chains, n_states)]['precision_error'] = precision_error(engine)
+    return results
+
+
+def bench_microsim(populations, size=MODEL_SIZES[0], n_cycles=3):
+    model = synthetic_model(*size)
+    matrices = [m[0] for m in model.matrices(model.parameters.base())]
+    # numba-parallel is left out: its threads would hang the PSA pools forked later
+    backends = [(None, ''), ('numpy', '/numpy')]
+    results = OrderedDict()
+    if kernels.numba is not None:
+        backends.append(('numba', '/numba'))
+        mismatched = kernels.verify(model)['numba']
+        results['kernels'] = {'numba_mismatched_people': mismatched}
+        if mismatched:
+            raise RuntimeError('The numba kernel disagrees with numpy for %d people' % mismatched)
+    for n in populations:
+        for backend, suffix in backends:
+            population = Population(model, n, backend=backend)
+            population.add(np.zeros((n, len(model.chains)), dtype=population.states.dtype), 30.0, 0)
+            # The first step compiles the numba kernel
+            population.step(matrices)
+            start = time.time()
+            for _ in range(n_cycles):
+                population.step(matrices)
+            seconds = time.time() - start
+            arrays = [population.states, population.age, population.sex, population.alive, population.free]
+            results[str(n) + suffix] = {
+                'cycles_per_second': n_cycles / seconds,
+                'person_cycles_per_second': n * n_cycles / seconds,
+                'memory_per_person_bytes': sum(a.nbytes for a in arrays) / n,
+            }
+            del population
+    return results
+
+
+def bench_psa(sizes, n_draws=256, n_cycles=40, workers=(1,)):
+    results = OrderedDict()
+    for n_chains, n_states in sizes:
+        model = synthetic_model(n_chains, n_states)
+        outcome = state_outcome(model, model.chains[0].name, 'Death')
+        for n_workers in workers:
+            engine = Engine(model, n_cycles, batch_size=64)
+            psa = PSA(engine, [Reducer('death', outcome)], n_draws, check=False)
+            start = time.time()
+            psa.run(n_workers=n_workers)
+            seconds = time.time() - start
+            results['%dx%d/%d' % (n_chains, n_states, n_workers)] = {
+                'draws_per_second': n_draws / seconds,
+                'draws_per_core_per_second': n_draws / seconds / n_workers,
+            }
+    return results
+
+
+def bench_api(sizes, repeat=20):
+    try:
+        from app import create_app
+    except ImportError as e:
+        return {'skipped': 'Flask is not available (%s)' % e}
+    from db_benchmark import build
+    from models import db
+    import app as application
+
+    results = OrderedDict()
+    for n_chains, n_states in sizes:
+        directory = tempfile.mkdtemp(prefix='limsa-bench-')
+        try:
+            uri = 'sqlite:///' + os.path.join(directory, 'bench.sqlite')
+            client = create_app({'SQLALCHEMY_DATABASE_URI': uri, 'TESTING': True}).test_client()
+            build(n_chains, n_states)
+            result = {}
+            for path in ('/chains', '/api/chains'):
+                application.api_cache['revision'] = None
+                start = time.time()
+                client.get(path)
+                result['%s_cold_seconds' % path] = time.time() - start
+                result['%s_seconds' % path], _ = timed(lambda: client.get(path), repeat)
+            response = client.get('/api/chains')
+            etag = response.headers.get('ETag')
+            result['/api/chains_not_modified_seconds'], _ = \
+                timed(lambda: client.get('/api/chains', headers={'If-None-Match': etag}), repeat)
+            results['%dx%d' % (n_chains, n_states)] = result
+        finally:
+            db.dispose()
+            shutil.rmtree(directory)
+    return results
+
+
+#### ---------------- Results -------------------------
+
+def environment():
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=basedir,
+                                         stderr=subprocess.STDOUT).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = 'unknown'
+    return OrderedDict([
+        ('commit', commit),
+        ('created', time.strftime('%Y-%m-%dT%H:%M:%S')),
+        ('python', platform.python_version()),
+        ('numpy', np.__version__),
+        ('machine', platform.platform()),
+        ('processor', platform.processor() or platform.machine()),
+        ('cpus', multiprocessing.cpu_count()),
+    ])
+
+
+def metrics(results, prefix=''):
+    """Flatten nested results to {'suite/case/metric': value}."""
+    flat = OrderedDict()
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(metrics(value, prefix + key + '/'))
+        elif isinstance(value, (int, float)):
+            flat[prefix + key] = value
+    return flat
+
+
+def worse(metric, ratio):
+    """How much worse new / old = ratio is for metric (0 if it improved)."""
+    if metric.endswith('_per_second'):
+        return max(1.0 / ratio - 1.0, 0.0) if ratio > 0 else float('inf')
+    return max(ratio - 1.0, 0.0)
+
+
+def compare(old_path, new_path, threshold=0.1):
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    print('%s -> %s' % (old['environment']['commit'], new['environment']['commit']))
+    old_metrics, new_metrics = metrics(old['results']), metrics(new['results'])
+    regressions = 0
+    for metric, value in new_metrics.items():
+        if metric not in old_metrics or not old_metrics[metric]:
+            continue
+        ratio = value / old_metrics[metric]
+        regressed = worse(metric, ratio) > threshold
+        regressions += regressed
+        print('%-60s %12.4g %12.4g  x%.2f%s' % (metric, old_metrics[metric], value, ratio,
+                                                 '  REGRESSION' if regressed else ''))
+    return regressions
+
+
+SUITES = ['compile', 'cohort', 'microsim', 'psa', 'api']
+
+
+def run(suites=SUITES, quick=False, workers=(1,)):
+    sizes = QUICK_MODEL_SIZES if quick else MODEL_SIZES
+    populations = QUICK_POPULATIONS if quick else POPULATIONS
+    results = OrderedDict()
+    for suite in suites:
+        start = time.time()
+        if suite == 'compile':
+            results[suite] = bench_compile(sizes)
+        elif suite == 'cohort':
+            results[suite] = bench_cohort(sizes)
+        elif suite == 'microsim':
+            results[suite] = bench_microsim(populations)
+        elif suite == 'psa':
+            results[suite] = bench_psa(sizes[:2], workers=workers)
+        elif suite == 'api':
+            results[suite] = bench_api(sizes[:2])
+        else:
+            raise ValueError('Unknown benchmark suite: %s' % suite)
+        sys.stderr.write('%s: %.1fs\n' % (suite, time.time() - start))
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run the benchmarks and store the results as JSON')
+    parser.add_argument('--only', default=','.join(SUITES), help='comma-separated suites to run')
+    parser.add_argument('--quick', action='store_true', help='smaller models and populations')
+    parser.add_argument('--workers', default='1', help='comma-separated PSA worker counts')
+    parser.add_argument('--output', default=None, help='result file (default benchmark_results/<commit>.json)')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='compare two result files')
+    parser.add_argument('--threshold', type=float, default=0.1, help='regression threshold for --compare')
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        return 1 if compare(args.compare[0], args.compare[1], args.threshold) else 0
+
+    env = environment()
+    results = run([suite for suite in args.only.split(',') if suite], args.quick,
+                  [int(n) for n in args.workers.split(',')])
+    path = args.output or os.path.join(RESULTS_DIR, '%s.json' % env['commit'])
+    directory = os.path.dirname(os.path.abspath(path))
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(path, 'w') as f:
+        json.dump(OrderedDict([('environment', env), ('results', results)]), f, indent=2)
+    for metric, value in metrics(results).items():
+        print('%-60s %12.4g' % (metric, value))
+    print('wrote %s' % os.path.relpath(path))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,208 @@
+from __future__ import division
+
+# Content-addressed cache of simulation results.
+#
+# A result is keyed by what determines it: the digest of the compiled model
+# snapshot, the parameter values, the seed, the horizon and anything else
+# that changes the output (reducer settings, ...). Re-running a baseline or
+# re-rendering a report with an unchanged model and inputs is then a lookup.
+#
+# Values are (arrays, meta) pairs. They are kept in two tiers: a small
+# in-memory LRU for the long-lived Flask process, in front of snapshots on
+# local disk (see snapshot.py) evicted least-recently-used once the
+# directory grows past max_bytes.
+#
+# Writers of the same key (worker processes, server threads) take turns
+# through an exclusive lock on <entry>.lock, so one never removes the files
+# another's manifest still names; readers hold it shared while they open
+# an entry.
+
+import hashlib
+import json
+import os
+import shutil
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    # Not on Windows; writers there are not serialized
+    fcntl = None
+
+import numpy as np
+
+import snapshot
+
+
+basedir = os.path.abspath(os.path.dirname(__file__))
+CACHE_DIR = os.path.join(basedir, 'cache')
+
+
+def key(model, values, seed=0, n_cycles=None, **extra):
+    """Cache key for running model with values (scenarios x parameters)."""
+    sha = hashlib.sha1()
+    sha.update(model.digest().encode('utf-8'))
+    values = np.ascontiguousarray(values, dtype=float)
+    sha.update(('%s' % (values.shape,)).encode('utf-8'))
+    sha.update(values.tobytes() if hasattr(values, 'tobytes') else values.tostring())
+    sha.update(json.dumps([seed, n_cycles, extra], sort_keys=True).encode('utf-8'))
+    return sha.hexdigest()
+
+
+class Cache(object):
+
+    def __init__(self, root=CACHE_DIR, max_bytes=2 * 1024 ** 3, memory_entries=64):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.memory_entries = memory_entries
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+
+    def path(self, key):
+        return os.path.join(self.root, key[:2], key)
+
+    def get(self, key):
+        """(arrays, meta) stored under key, or None."""
+        with self.lock:
+            if key in self.memory:
+                value = self.memory.pop(key)
+                self.memory[key] = value
+                return value
+
+        path = self.path(key)
+        if not snapshot.exists(path):
+            return None
+        try:
+            with _locked(path, shared=True):
+                value = snapshot.load(path)
+                # The manifest's mtime records when the entry was last used
+                os.utime(os.path.join(path, snapshot.MANIFEST), None)
+        except (IOError, OSError):
+            # Evicted by another process while being read
+            return None
+        self._remember(key, value)
+        return value
+
+    def put(self, key, arrays, meta=None):
+        """Store (arrays, meta) under key and return them as stored."""
+        path = self.path(key)
+        with _locked(path):
+            snapshot.save(path, arrays, meta)
+            # Memory maps opened here stay valid whatever a later put removes
+            value = snapshot.load(path)
+        self._remember(key, value)
+        self.evict()
+        return value
+
+    def cached(self, key, compute):
+        """Return the value under key, calling compute() -> (arrays, meta) on a miss."""
+        value = self.get(key)
+        if value is None:
+            arrays, meta = compute()
+            value = self.put(key, arrays, meta)
+        return value
+
+    def evict(self):
+        """Delete least recently used entries until the disk tier fits max_bytes."""
+        entries, total = [], 0
+        if not os.path.exists(self.root):
+            return
+        for prefix in os.listdir(self.root):
+            directory = os.path.join(self.root, prefix)
+            if not os.path.isdir(directory):
+                continue
+            for name in os.listdir(directory):
+                path = os.path.join(directory, name)
+                manifest = os.path.join(path, snapshot.MANIFEST)
+                try:
+                    size = sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+                    entries.append((os.path.getmtime(manifest), size, name, path))
+                except (IOError, OSError):
+                    # Being written, or evicted, by someone else
+                    continue
+                total += size
+
+        entries.sort()
+        for used, size, name, path in entries:
+            if total <= self.max_bytes:
+                break
+            with _locked(path):
+                shutil.rmtree(path, ignore_errors=True)
+            with self.lock:
+                self.memory.pop(name, None)
+            total -= size
+
+    def clear(self):
+        with self.lock:
+            self.memory.clear()
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def _remember(self, key, value):
+        with self.lock:
+            self.memory.pop(key, None)
+            self.memory[key] = value
+            while len(self.memory) > self.memory_entries:
+                self.memory.popitem(last=False)
+
+
+def cached_psa(cache, psa, n_workers=1, checkpoint=None):
+    """Run psa (or fetch its reducers from cache) and return the reducers."""
+    engine = psa.engine
+    settings = [(reducer.name, reducer.quantiles, reducer.every, reducer.accuracy)
+                for reducer in psa.reducers]
+    k = key(engine.model, psa.draws, psa.seed, engine.n_cycles,
+            initial=sorted((name, list(np.atleast_1d(v))) for name, v in engine.initial.items()),
+            reducers=settings, dtype=engine.dtype.name,
+            strata=engine.strata.describe() if engine.strata is not None else None,
+            dynamics=[dynamic.describe() for dynamic in engine.dynamics],
+            schedules=engine.schedules.describe() if engine.schedules is not None else None)
+
+    def compute():
+        psa.run(n_workers=n_workers, checkpoint=checkpoint)
+        arrays = {}
+        for i, reducer in enumerate(psa.reducers):
+            for name, array in reducer.state().items():
+                arrays['reducers/%d/%s' % (i, name)] = array
+        return arrays, {'n_draws': psa.n_draws}
+
+    value = cache.cached(k, compute)
+    if value is None:
+        # Lost to a concurrent writer: a miss
+        value = compute()
+    arrays, meta = value
+    for i, reducer in enumerate(psa.reducers):
+        reducer.restore(engine, None, snapshot.group(arrays, 'reducers/%d' % i))
+    return psa.reducers
+
+
+@contextmanager
+def _locked(path, shared=False):
+    # Lock on path + '.lock', between processes and threads alike
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            # Created by a concurrent put
+            pass
+    with open(path + '.lock', 'a') as f:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+_default = None
+
+
+def default_cache():
+    """The cache shared by everything running in this process (e.g. the Flask app)."""
+    global _default
+    if _default is None:
+        _default = Cache()
+    return _default
@@ -0,0 +1,93 @@
+from __future__ import division
+
+# Checkpoint and resume for long engine and PSA runs.
+#
+# A checkpoint is a snapshot (see snapshot.py) of everything needed to carry
+# on from the start of a cycle: the batch's parameter values and occupancy,
+# the state of every observer (reducers, cost accumulators, ...), the
+# engine's random state and, for a PSA, which draws are already done.
+# Checkpoints taken at cycle 0 fall on batch boundaries. Because every piece
+# of state is restored exactly, a resumed run gives bit-identical results to
+# one that was never interrupted.
+
+import time
+
+import numpy as np
+
+import snapshot
+
+
+class Checkpoint(object):
+
+    def __init__(self, path, every_cycles=None, every_batches=1, every_seconds=None):
+        self.path = path
+        self.every_cycles = every_cycles
+        self.every_batches = every_batches
+        self.every_seconds = every_seconds
+        # Extra meta saved with every checkpoint (e.g. the PSA's progress)
+        self.meta = {}
+        self.last = time.time()
+        self.batches = 0
+
+    def due(self, cycle):
+        """Whether to save at the start of this cycle."""
+        if self.every_seconds is not None and time.time() - self.last >= self.every_seconds:
+            return True
+        if cycle == 0:
+            self.batches += 1
+            return self.every_batches is not None and self.batches >= self.every_batches
+        return bool(self.every_cycles) and cycle % self.every_cycles == 0
+
+    def save_batch(self, engine, values, cycle, occupancy, observers):
+        arrays = {'values': values}
+        for c, occ in enumerate(occupancy):
+            arrays['occupancy/%d' % c] = occ
+        for i, observer in enumerate(observers):
+            for name, array in observer.state().items():
+                arrays['observers/%d/%s' % (i, name)] = array
+        keys, rng_meta = rng_state(engine.rng)
+        arrays['rng/keys'] = keys
+
+        meta = dict(self.meta)
+        meta['batch'] = {'cycle': cycle, 'n_chains': len(occupancy), 'n_observers': len(observers)}
+        meta['rng'] = rng_meta
+        snapshot.save(self.path, arrays, meta)
+        self.last = time.time()
+        self.batches = 0
+
+
+def load(path):
+    """(arrays, meta) of a checkpoint, memory-mapped."""
+    return snapshot.load(path)
+
+
+def batch_state(arrays, meta):
+    """The resume argument for Engine.run_batch, from a loaded checkpoint."""
+    batch = meta['batch']
+    return {
+        'cycle': batch['cycle'],
+        'occupancy': [arrays['occupancy/%d' % c] for c in range(batch['n_chains'])],
+        'observers': [snapshot.group(arrays, 'observers/%d' % i) for i in range(batch['n_observers'])],
+    }
+
+
+def rng_state(rng):
+    name, keys, pos, has_gauss, cached_gaussian = rng.get_state()
+    return np.asarray(keys), [name, int(pos), int(has_gauss), float(cached_gaussian)]
+
+
+def set_rng_state(rng, keys, meta):
+    name, pos, has_gauss, cached_gaussian = meta
+    rng.set_state((str(name), np.array(keys, dtype=np.uint32), pos, has_gauss, cached_gaussian))
+
+
+def resume(engine, path, observers=(), checkpoint=None):
+    """Finish the batch saved at path and return its final occupancy.
+
+    observers must be configured like the ones the checkpointed run used,
+    in the same order.
+    """
+    arrays, meta = load(path)
+    set_rng_state(engine.rng, arrays['rng/keys'], meta['rng'])
+    return engine.run_batch(np.array(arrays['values']), observers,
+                            resume=batch_state(arrays, meta), checkpoint=checkpoint)
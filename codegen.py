@@ -0,0 +1,294 @@
+from __future__ import division
+
+# Parameter modules for code outside this package.
+#
+# As limsa.md describes, the Go model reads the Raw_inputs by their slugs
+# from a generated Go file. generate() writes, from a compiled model,
+#
+#     generated/parameters/parameters.go   (package parameters)
+#     generated/limsa_parameters.py
+#
+# each holding
+#
+#   - every Raw_input's base value as a constant named after its slug, and
+#     its column in parameter vectors; derived inputs have their evaluated
+#     base value
+#   - the slugs, base values, lows and highs as dense arrays
+#   - each chain's number and each state's database id as integer constants,
+#     with the state ids of every chain in order
+#   - the base-case transition matrix of every chain (states x states,
+#     rows summing to 1; dynamic transitions at their Tp_base)
+#
+# Files are only rewritten when their content changes (compared by hash),
+# so the Go build and anything else watching them is not invalidated by a
+# regeneration that changed nothing. Run it with `make codegen`, the
+# manager's codegen command or `python codegen.py`.
+
+import hashlib
+import json
+import keyword
+import math
+import os
+import re
+import sys
+import time
+
+
+basedir = os.path.abspath(os.path.dirname(__file__))
+GENERATED_DIR = os.path.join(basedir, 'generated')
+
+GO_FILE = os.path.join('parameters', 'parameters.go')
+PYTHON_FILE = 'limsa_parameters.py'
+
+
+def generate(model, root=None):
+    """Write the Go and Python parameter modules; returns the paths rewritten."""
+    root = root or GENERATED_DIR
+    contents = model_contents(model)
+    written = []
+    for name, render in ((GO_FILE, go_module), (PYTHON_FILE, python_module)):
+        path = os.path.join(root, name)
+        if write_if_changed(path, render(contents)):
+            written.append(path)
+    return written
+
+
+def model_contents(model):
+    """Everything the generated modules hold, as plain Python values."""
+    parameters = model.parameters
+    base = parameters.base()
+    matrices = model.matrices(base)
+    return {
+        'digest': model.digest(),
+        'slugs': parameters.slugs,
+        'names': parameters.names,
+        'values': [float(x) for x in base[0]],
+        'low': [float(x) for x in parameters.low],
+        'high': [float(x) for x in parameters.high],
+        'chains': [{'name': chain.name,
+                    'state_ids': [int(i) for i in chain.state_ids],
+                    'state_names': chain.state_names,
+                    'matrix': matrices[c][0].tolist()}
+                   for c, chain in enumerate(model.chains)],
+    }
+
+
+def content_hash(content):
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+
+def write_if_changed(path, content):
+    """Write content to path unless the file already holds it; True if written."""
+    if os.path.exists(path):
+        with open(path, 'rb') as f:
+            if content_hash(f.read().decode('utf-8')) == content_hash(content):
+                return False
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    temporary = '%s.%d.tmp' % (path, os.getpid())
+    with open(temporary, 'wb') as f:
+        f.write(content.encode('utf-8'))
+    os.rename(temporary, path)
+    return True
+
+
+#### ---------------- Names -------------------------
+
+WORD = re.compile(r'[0-9A-Za-z]+')
+
+
+def words(text):
+    return WORD.findall(text)
+
+
+def unique(names, reserved=()):
+    # Names that collide after cleaning up, with each other or with the
+    # names the module defines itself (reserved), get a number
+    taken, result = set(reserved), []
+    for name in names:
+        candidate, n = name, 1
+        while candidate in taken:
+            n += 1
+            candidate = '%s%d' % (name, n)
+        taken.add(candidate)
+        result.append(candidate)
+    return result
+
+
+def go_name(*parts):
+    name = ''.join(word[0].upper() + word[1:] for part in parts for word in words(part))
+    if not name or not name[0].isalpha():
+        name = 'X' + name
+    return name
+
+
+def python_name(*parts):
+    name = '_'.join(word.upper() for part in parts for word in words(part))
+    if not name or name[0].isdigit():
+        name = '_' + name
+    return name
+
+
+def python_slug(slug):
+    name = '_'.join(words(slug)) or '_'
+    if name[0].isdigit() or keyword.iskeyword(name):
+        name = '_' + name
+    return name
+
+
+#### ---------------- Go -------------------------
+
+# Package-level names go_module always defines
+GO_RESERVED = ('Slugs', 'Values', 'Low', 'High', 'ChainNames', 'StateIDs', 'Matrices')
+
+def go_float(x):
+    if math.isnan(x):
+        return 'math.NaN()'
+    if math.isinf(x):
+        return 'math.Inf(%d)' % (1 if x > 0 else -1)
+    return repr(float(x))
+
+
+def go_floats(xs):
+    return '{%s}' % ', '.join(repr(x) if x - x == 0 else go_float(x) for x in xs)
+
+
+def go_block(keyword, entries):
+    """A const or var block of (name, value, comment) entries, aligned as gofmt does."""
+    width = max(len(name) for name, _, _ in entries)
+    value_width = max(len(value) for _, value, _ in entries)
+    lines = ['%s (' % keyword]
+    for name, value, comment in entries:
+        if comment:
+            lines.append('\t%s = %s // %s' % (name.ljust(width), value.ljust(value_width), comment))
+        else:
+            lines.append('\t%s = %s' % (name.ljust(width), value))
+    return lines + [')', '']
+
+
+def go_module(contents):
+    lines = ['// Code generated by codegen.py from the Limsa model. DO NOT EDIT.',
+             '// Model digest: %s' % contents['digest'],
+             '',
+             'package parameters',
+             '']
+    values = contents['values']
+    uses_math = any(math.isnan(x) or math.isinf(x) for x in values + contents['low'] + contents['high'])
+    if uses_math:
+        lines += ['import "math"', '']
+
+    chains = contents['chains']
+    slugs = contents['slugs']
+    states = [(chain['name'], state) for chain in chains for state in chain['state_names']]
+    # One namespace for every constant, so none can collide
+    names = unique([go_name(slug) for slug in slugs] + [go_name('Index', slug) for slug in slugs] +
+                   [go_name('Chain', chain['name']) for chain in chains] +
+                   [go_name('State', chain, state) for chain, state in states], GO_RESERVED)
+    n = len(slugs)
+    slug_names, index_names = names[:n], names[n:2 * n]
+    chain_names, state_names = names[2 * n:2 * n + len(chains)], names[2 * n + len(chains):]
+
+    finite = [i for i, value in enumerate(values) if not (math.isnan(value) or math.isinf(value))]
+    others = [i for i, value in enumerate(values) if math.isnan(value) or math.isinf(value)]
+    if finite:
+        lines.append('// Base value of each Raw_input')
+        lines += go_block('const', [(slug_names[i], go_float(values[i]), slugs[i]) for i in finite])
+    if others:
+        lines += go_block('var', [(slug_names[i], go_float(values[i]), slugs[i]) for i in others])
+    if slugs:
+        lines.append('// Column of each Raw_input in parameter vectors')
+        lines += go_block('const', [(name, str(i), None) for i, name in enumerate(index_names)])
+
+    lines += ['var Slugs = []string{%s}' % ', '.join(json.dumps(slug) for slug in contents['slugs']),
+              'var Values = []float64%s' % go_floats(values),
+              'var Low = []float64%s' % go_floats(contents['low']),
+              'var High = []float64%s' % go_floats(contents['high']),
+              '']
+
+    if chains:
+        lines.append('// Position of each chain')
+        lines += go_block('const', [(name, str(c), None) for c, name in enumerate(chain_names)])
+        lines.append('// Database id of each state')
+        ids = [state_id for chain in chains for state_id in chain['state_ids']]
+        lines += go_block('const', [(name, str(state_id), None) for name, state_id in zip(state_names, ids)])
+
+    lines.append('var ChainNames = []string{%s}' % ', '.join(json.dumps(chain['name']) for chain in chains))
+    lines.append('')
+    lines.append('// State ids of each chain, in matrix order')
+    lines.append('var StateIDs = [][]int{')
+    lines += ['\t{%s},' % ', '.join(str(i) for i in chain['state_ids']) for chain in chains]
+    lines += ['}', '']
+    lines.append('// Base-case transition matrix of each chain (states x states, rows sum to 1)')
+    lines.append('var Matrices = [][][]float64{')
+    for chain in chains:
+        lines.append('\t{ // %s' % chain['name'])
+        lines += ['\t\t%s,' % go_floats(row) for row in chain['matrix']]
+        lines.append('\t},')
+    lines += ['}', '']
+    return '\n'.join(lines)
+
+
+#### ---------------- Python -------------------------
+
+# Module-level names python_module always defines or imports
+PYTHON_RESERVED = ('np', 'nan', 'inf', 'SLUGS', 'INDEX', 'VALUES', 'LOW', 'HIGH',
+                   'CHAIN_NAMES', 'STATE_IDS', 'MATRICES')
+
+def python_module(contents):
+    lines = ['# Generated by codegen.py from the Limsa model. Do not edit.',
+             '# Model digest: %s' % contents['digest'],
+             '',
+             'import numpy as np',
+             '',
+             'nan, inf = float(\'nan\'), float(\'inf\')',
+             '']
+    names = unique([python_slug(slug) for slug in contents['slugs']], PYTHON_RESERVED)
+    if names:
+        lines.append('# Base value of each Raw_input')
+        lines += ['%s = %r' % (name, value) for name, value in zip(names, contents['values'])]
+        lines.append('')
+    lines += ['SLUGS = %r' % [str(slug) for slug in contents['slugs']],
+              '# Column of each Raw_input in parameter vectors',
+              'INDEX = dict((slug, i) for i, slug in enumerate(SLUGS))',
+              'VALUES = np.array(%r)' % contents['values'],
+              'LOW = np.array(%r)' % contents['low'],
+              'HIGH = np.array(%r)' % contents['high'],
+              '']
+
+    chains = contents['chains']
+    if chains:
+        lines.append('# Position of each chain')
+        names = unique([python_name('chain', chain['name']) for chain in chains], PYTHON_RESERVED)
+        lines += ['%s = %d' % (name, c) for c, name in enumerate(names)]
+        lines.append('')
+        lines.append('# Database id of each state')
+        names = unique([python_name('state', chain['name'], state)
+                        for chain in chains for state in chain['state_names']], PYTHON_RESERVED)
+        ids = [state_id for chain in chains for state_id in chain['state_ids']]
+        lines += ['%s = %d' % (name, state_id) for name, state_id in zip(names, ids)]
+        lines.append('')
+    lines.append('CHAIN_NAMES = %r' % [str(chain['name']) for chain in chains])
+    lines.append('# State ids of each chain, in matrix order')
+    lines.append('STATE_IDS = %r' % [chain['state_ids'] for chain in chains])
+    lines.append('# Base-case transition matrix of each chain (states x states, rows sum to 1)')
+    lines.append('MATRICES = [')
+    for chain in chains:
+        lines.append('    # %s' % chain['name'])
+        lines.append('    np.array(%r),' % (chain['matrix'],))
+    lines += [']', '']
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    from compiler import compile_database
+    start = time.time()
+    written = generate(compile_database(check=False))
+    for path in written:
+        print('wrote %s' % os.path.relpath(path, basedir))
+    print('%d of 2 files changed in %.3fs' % (len(written), time.time() - start))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
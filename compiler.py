@@ -0,0 +1,325 @@
+from __future__ import division
+
+# Compiles the chains, states and transition probabilities stored in the
+# database into dense arrays the engine can step.
+#
+# Each chain becomes a square transition matrix over its states (ordered by
+# id). Transition probabilities with a Tp_expression are evaluated against a
+# parameter matrix, so a single call builds the matrices of every scenario in
+# a batch; the others keep their stored Tp_base. Dynamic transitions start
+# from their Tp_base (or zero) and are filled in by the engine each cycle.
+#
+# State costs, utilities and disability weights and one-off transition costs
+# are references to Raw_inputs; they are compiled to parameter column indices
+# (-1 where a state or transition has none).
+#
+# compile_database() checks the model's structure before returning it (see
+# validate.py).
+#
+# A compiled model can be saved as a snapshot (see snapshot.py) and loaded
+# back zero-copy, without touching the database.
+
+from collections import OrderedDict
+
+import numpy as np
+
+import snapshot
+import validate
+from parameters import Parameters, compile_expression, evaluate_expression
+
+
+class CompiledChain(object):
+
+    def __init__(self, id, name, state_ids, state_names):
+        self.id = id
+        self.name = name
+        self.state_ids = list(state_ids)
+        self.state_names = list(state_names)
+        self.index = dict((state_id, i) for i, state_id in enumerate(self.state_ids))
+
+        # One entry per transition probability
+        self.tp_ids = []
+        self.from_index = []
+        self.to_index = []
+        self.base = []
+        self.expressions = []
+        self.codes = []
+        self.is_dynamic = []
+        self.tp_cost_index = []
+
+        self.cost_index = -np.ones(len(self.state_ids), dtype=int)
+        self.utility_index = -np.ones(len(self.state_ids), dtype=int)
+        self.disability_index = -np.ones(len(self.state_ids), dtype=int)
+
+    def __repr__(self):
+        return self.name
+
+    def __len__(self):
+        return len(self.state_ids)
+
+    # Code objects cannot be pickled, so expressions are recompiled when a
+    # pickled copy is loaded (e.g. in a worker process)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['codes']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.codes = [compile_expression(expression)[0] if expression else None
+                      for expression in self.expressions]
+
+    def state(self, name):
+        return self.state_names.index(name)
+
+    def _freeze(self):
+        self.from_index = np.array(self.from_index, dtype=int)
+        self.to_index = np.array(self.to_index, dtype=int)
+        self.base = np.array(self.base, dtype=float)
+        self.is_dynamic = np.array(self.is_dynamic, dtype=bool)
+        self.tp_cost_index = np.array(self.tp_cost_index, dtype=int)
+
+
+class CompiledInteraction(object):
+
+    # Being in state in_state of chain in_chain multiplies the from -> to
+    # transition probability of chain by adjustment
+
+    def __init__(self, in_chain, in_state, chain, from_state, to_state, adjustment):
+        self.in_chain = in_chain
+        self.in_state = in_state
+        self.chain = chain
+        self.from_state = from_state
+        self.to_state = to_state
+        self.adjustment = adjustment
+
+
+class CompiledModel(object):
+
+    def __init__(self, chains, parameters, interactions=(), unresolved=()):
+        self.chains = list(chains)
+        self.parameters = parameters
+        self.interactions = list(interactions)
+        # Transition probabilities that could not be placed in a chain
+        self.unresolved = list(unresolved)
+        self.chain_index = dict((chain.name, i) for i, chain in enumerate(self.chains))
+
+    def chain(self, name):
+        return self.chains[self.chain_index[name]]
+
+    def digest(self):
+        """Content hash of the model's snapshot (see snapshot.digest)."""
+        if getattr(self, '_digest', None) is None:
+            self._digest = snapshot.digest(*model_snapshot(self))
+        return self._digest
+
+    def tp_values(self, chain, values, namespace=None):
+        """Transition probabilities of chain for every scenario row of values."""
+        n = values.shape[0]
+        if namespace is None:
+            namespace = self.parameters.namespace(values)
+        columns = np.tile(chain.base, (n, 1))
+        for j, code in enumerate(chain.codes):
+            if code is not None:
+                columns[:, j] = evaluate_expression(code, namespace, n)
+        return columns
+
+    def matrices(self, values):
+        """Row-stochastic matrices (scenarios x states x states) for each chain.
+
+        values is a scenarios x parameters matrix whose derived columns have
+        already been evaluated.
+        """
+        values = np.atleast_2d(values)
+        namespace = self.parameters.namespace(values)
+        return [self.chain_matrices(chain, self.tp_values(chain, values, namespace))
+                for chain in self.chains]
+
+    def state_values(self, values, attribute, default=0.0):
+        """Per-state parameter values (scenarios x states) for each chain.
+
+        attribute is one of 'cost_index', 'utility_index' or 'disability_index';
+        states without an input get default.
+        """
+        values = np.atleast_2d(values)
+        result = []
+        for chain in self.chains:
+            index = getattr(chain, attribute)
+            columns = np.empty((values.shape[0], len(chain)))
+            columns.fill(default)
+            present = index >= 0
+            columns[:, present] = values[:, index[present]]
+            result.append(columns)
+        return result
+
+    def transition_costs(self, values):
+        """One-off transition costs (scenarios x states x states) for each chain."""
+        values = np.atleast_2d(values)
+        result = []
+        for chain in self.chains:
+            costs = np.zeros((values.shape[0], len(chain), len(chain)))
+            present = chain.tp_cost_index >= 0
+            if present.any():
+                costs[:, chain.from_index[present], chain.to_index[present]] = \
+                    values[:, chain.tp_cost_index[present]]
+            result.append(costs)
+        return result
+
+    def chain_matrices(self, chain, tps):
+        n, s = tps.shape[0], len(chain)
+        matrix = np.zeros((n, s, s))
+        matrix[:, chain.from_index, chain.to_index] = tps
+        diagonal = np.arange(s)
+        matrix[:, diagonal, diagonal] = 1.0 - matrix.sum(axis=2)
+        return matrix
+
+
+def compile_model(chains, states, transition_probabilities, raw_inputs, interactions=()):
+    """Compile model rows (as loaded from the database) into a CompiledModel."""
+    parameters = Parameters.from_raw_inputs(raw_inputs)
+    column_of_input = dict((raw_input.id, parameters.index[raw_input.slug])
+                           for raw_input in raw_inputs if raw_input.slug in parameters.index)
+
+    def column(input_id):
+        return column_of_input.get(input_id, -1) if input_id is not None else -1
+
+    by_chain = {}
+    for state in sorted(states, key=lambda state: state.id):
+        by_chain.setdefault(state.chain_id, []).append(state)
+
+    compiled = []
+    chain_of_state = {}
+    for chain in sorted(chains, key=lambda chain: chain.id):
+        members = by_chain.get(chain.id, [])
+        compiled_chain = CompiledChain(chain.id, chain.name,
+                                       [state.id for state in members],
+                                       [state.name for state in members])
+        compiled.append(compiled_chain)
+        for i, state in enumerate(members):
+            chain_of_state[state.id] = compiled_chain
+            compiled_chain.cost_index[i] = column(state.cost_input_id)
+            compiled_chain.utility_index[i] = column(state.utility_input_id)
+            compiled_chain.disability_index[i] = column(state.disability_input_id)
+
+    unresolved = []
+    for tp in sorted(transition_probabilities, key=lambda tp: tp.id):
+        chain = chain_of_state.get(tp.From_state_id)
+        if chain is None or tp.To_state_id not in chain.index:
+            unresolved.append(tp.id)
+            continue
+        chain.tp_ids.append(tp.id)
+        chain.from_index.append(chain.index[tp.From_state_id])
+        chain.to_index.append(chain.index[tp.To_state_id])
+        chain.base.append(tp.Tp_base or 0.0)
+        chain.is_dynamic.append(bool(tp.Is_dynamic))
+        chain.tp_cost_index.append(column(tp.Cost_input_id))
+        chain.expressions.append(tp.Tp_expression or None)
+        if tp.Tp_expression:
+            code, names = compile_expression(tp.Tp_expression)
+            unknown = [name for name in names if name not in parameters.index]
+            if unknown:
+                raise KeyError('Transition probability %s uses unknown inputs: %s' % (tp.id, ', '.join(unknown)))
+            chain.codes.append(code)
+        else:
+            chain.codes.append(None)
+
+    for chain in compiled:
+        chain._freeze()
+
+    chain_number = dict((chain.id, i) for i, chain in enumerate(compiled))
+    compiled_interactions = []
+    for interaction in sorted(interactions, key=lambda interaction: interaction.id):
+        in_chain = chain_of_state.get(interaction.In_state_id)
+        chain = chain_of_state.get(interaction.From_state_id)
+        if in_chain is None or chain is None or interaction.To_state_id not in chain.index:
+            continue
+        compiled_interactions.append(CompiledInteraction(
+            chain_number[in_chain.id], in_chain.index[interaction.In_state_id],
+            chain_number[chain.id], chain.index[interaction.From_state_id],
+            chain.index[interaction.To_state_id], interaction.Adjustment))
+
+    return CompiledModel(compiled, parameters, interactions=compiled_interactions, unresolved=unresolved)
+
+
+def compile_database(check=True):
+    """Compile the model currently stored in the application database.
+
+    With check, the base case is validated (see validate.py) and a model
+    with errors is refused.
+    """
+    from models import Chain, State, Transition_probability, Raw_input, Interaction
+    model = compile_model(Chain.query.all(), State.query.all(),
+                          Transition_probability.query.all(), Raw_input.query.all(),
+                          Interaction.query.all())
+    if check:
+        validate.check(model)
+    return model
+
+
+# Arrays of a CompiledChain stored in snapshots
+CHAIN_ARRAYS = ['from_index', 'to_index', 'base', 'is_dynamic', 'tp_cost_index',
+                'cost_index', 'utility_index', 'disability_index']
+
+INTERACTION_FIELDS = ['in_chain', 'in_state', 'chain', 'from_state', 'to_state']
+
+
+def model_snapshot(model):
+    """(arrays, meta) describing a compiled model, as stored by save_model."""
+    parameters = model.parameters
+    arrays = {'parameters/value': parameters.value,
+              'parameters/low': parameters.low,
+              'parameters/high': parameters.high,
+              'interactions/index': np.array([[getattr(i, field) for field in INTERACTION_FIELDS]
+                                              for i in model.interactions], dtype=int).reshape(-1, 5),
+              'interactions/adjustment': np.array([i.adjustment for i in model.interactions], dtype=float)}
+    chains = []
+    for c, chain in enumerate(model.chains):
+        for name in CHAIN_ARRAYS:
+            arrays['chains/%d/%s' % (c, name)] = getattr(chain, name)
+        chains.append({'id': chain.id, 'name': chain.name, 'state_ids': chain.state_ids,
+                       'state_names': chain.state_names, 'tp_ids': chain.tp_ids,
+                       'expressions': chain.expressions})
+    meta = {'parameters': {'slugs': parameters.slugs, 'names': parameters.names,
+                           'sources': list(parameters.sources.items())},
+            'chains': chains,
+            'unresolved': model.unresolved}
+    return arrays, meta
+
+
+def save_model(model, path):
+    """Save a compiled model as a snapshot at path."""
+    arrays, meta = model_snapshot(model)
+    snapshot.save(path, arrays, meta)
+
+
+def load_model(path):
+    """Load a compiled model saved by save_model; arrays are memory-mapped."""
+    arrays, meta = snapshot.load(path)
+
+    parameters = Parameters.__new__(Parameters)
+    saved = meta['parameters']
+    sources = [(slug, expression) for slug, expression in saved['sources']]
+    parameters.__setstate__({
+        'slugs': saved['slugs'], 'names': saved['names'],
+        'value': arrays['parameters/value'], 'low': arrays['parameters/low'],
+        'high': arrays['parameters/high'],
+        'index': dict((slug, i) for i, slug in enumerate(saved['slugs'])),
+        'sources': OrderedDict(sources),
+    })
+    parameters.order = parameters._topological_order()
+
+    chains = []
+    for c, saved in enumerate(meta['chains']):
+        chain = CompiledChain.__new__(CompiledChain)
+        state = dict(saved)
+        state['index'] = dict((state_id, i) for i, state_id in enumerate(saved['state_ids']))
+        for name in CHAIN_ARRAYS:
+            state[name] = arrays['chains/%d/%s' % (c, name)]
+        chain.__setstate__(state)
+        chains.append(chain)
+
+    interactions = [CompiledInteraction(*(list(index) + [adjustment]))
+                    for index, adjustment in zip(arrays['interactions/index'].tolist(),
+                                                 arrays['interactions/adjustment'].tolist())]
+    return CompiledModel(chains, parameters, interactions=interactions, unresolved=meta['unresolved'])
@@ -0,0 +1,211 @@
+from __future__ import division
+
+# Concurrency benchmark for the model database.
+#
+#     python db_benchmark.py [--processes 2] [--readers 4] [--writers 1]
+#                            [--seconds 10] [--default] [--require 200]
+#
+# A synthetic model (chains x states, with transitions and inputs) is written
+# to a temporary SQLite file. Then, for a fixed time, reader threads in each
+# of --processes processes repeat what the dashboard and the workers do:
+#
+#   poll   read the model revision (a dashboard's ETag check)
+#   load   the three queries behind the API's model document, which is also
+#          what a worker reads before compiling a run
+#
+# while writer threads record runs and edit inputs through db.write. It
+# prints polls, loads and writes per second, read latency percentiles and
+# how many operations failed with "database is locked". --default repeats
+# the load with SQLAlchemy's default SQLite settings for comparison, and
+# --require makes it exit with an error if loads per second fall below the
+# given rate.
+
+import argparse
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import joinedload
+
+from models import db, Chain, State, Transition_probability, Interaction, Raw_input, Reference, Tag, \
+    Initialization_probability, Run, model_revision
+
+
+def build(n_chains, n_states):
+    """Write a synthetic model to the configured database."""
+    db.create_all()
+    reference = Reference(name='Synthetic')
+    inputs = [Raw_input(name='input %d' % i, slug='input_%d' % i, value=0.1, reference=reference)
+              for i in range(n_chains * n_states)]
+    db.session.add_all(inputs)
+    for c in range(n_chains):
+        chain = Chain(name='Chain %d' % c)
+        states = [State(name='State %d' % s, chain=chain, cost_input=inputs[c * n_states + s])
+                  for s in range(n_states)]
+        db.session.add(chain)
+        db.session.add_all(states)
+        for s in range(n_states - 1):
+            db.session.add(Transition_probability(From_state=states[s], To_state=states[s + 1],
+                                                  Tp_base=0.05, Chain=chain))
+        db.session.add(Tag(name='In chain %d state 1' % c, states=[states[1]]))
+        for s, state in enumerate(states):
+            db.session.add(Initialization_probability(State=state, Probability=1.0 / n_states))
+        if c:
+            db.session.add(Interaction(In_state=previous[1], From_state=states[0], To_state=states[1],
+                                       Adjustment=1.5, Effected_chain_id=c + 1))
+        previous = states
+    db.session.commit()
+    db.session.remove()
+
+
+def load():
+    chains = Chain.query.options(joinedload(Chain.states)).all()
+    transitions = Transition_probability.query.all()
+    interactions = Interaction.query.all()
+    return len(chains) + len(transitions) + len(interactions)
+
+
+def record_run(session, i):
+    session.add(Run(name='benchmark %d' % i, n_draws=1, n_cycles=1))
+
+
+def edit_input(session, i):
+    raw = session.query(Raw_input).get(i % 100 + 1)
+    raw.value = (raw.value or 0.0) + 1e-6
+
+
+def reader(stop, counts, latencies, loads_per_poll):
+    i = 0
+    while not stop.is_set():
+        start = time.time()
+        try:
+            if i % (loads_per_poll + 1):
+                load()
+                kind = 'load'
+            else:
+                model_revision()
+                kind = 'poll'
+            db.session.commit()
+        except OperationalError:
+            db.session.rollback()
+            counts['locked'] += 1
+        else:
+            counts[kind] += 1
+            latencies.append(time.time() - start)
+        i += 1
+    db.session.remove()
+
+
+def writer(stop, counts, pause):
+    i = 0
+    while not stop.is_set():
+        try:
+            db.write(record_run if i % 2 else edit_input, i)
+        except OperationalError:
+            counts['locked'] += 1
+        else:
+            counts['write'] += 1
+        i += 1
+        time.sleep(pause)
+
+
+def run_process(uri, tuned, readers, writers, seconds, pause, loads_per_poll, results=None):
+    db.dispose()
+    db.configure(uri, tuned)
+    stop = threading.Event()
+    counts = dict(poll=0, load=0, write=0, locked=0)
+    latencies = []
+    # Counters are only ever incremented from one thread each, so give every
+    # thread its own and add them up afterwards
+    per_thread = [(dict(counts), []) for _ in range(readers)] + [(dict(counts), None) for _ in range(writers)]
+    threads = [threading.Thread(target=reader, args=(stop, c, l, loads_per_poll))
+               for c, l in per_thread[:readers]]
+    threads += [threading.Thread(target=writer, args=(stop, c, pause)) for c, _ in per_thread[readers:]]
+    for thread in threads:
+        thread.start()
+    time.sleep(seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    for c, l in per_thread:
+        for key in counts:
+            counts[key] += c[key]
+        latencies.extend(l or [])
+    outcome = (counts, latencies)
+    if results is not None:
+        results.put(outcome)
+    return outcome
+
+
+def benchmark(path, tuned=True, processes=1, readers=4, writers=1, seconds=10.0, pause=0.01,
+              loads_per_poll=1):
+    """Rates (per second), read latency percentiles (ms) and lock failures."""
+    uri = 'sqlite:///' + path
+    args = (uri, tuned, readers, writers, seconds, pause, loads_per_poll)
+    if processes == 1:
+        outcomes = [run_process(*args)]
+    else:
+        results = multiprocessing.Queue()
+        workers = [multiprocessing.Process(target=run_process, args=args + (results,))
+                   for _ in range(processes)]
+        for worker in workers:
+            worker.start()
+        outcomes = [results.get() for _ in workers]
+        for worker in workers:
+            worker.join()
+    counts = dict((key, sum(c[key] for c, _ in outcomes)) for key in outcomes[0][0])
+    latencies = np.array([x for _, l in outcomes for x in l]) * 1000
+    report = dict((key + '_per_second', counts[key] / seconds) for key in ('poll', 'load', 'write'))
+    report['locked'] = counts['locked']
+    for q in (50, 99):
+        report['read_p%d_ms' % q] = float(np.percentile(latencies, q)) if len(latencies) else float('nan')
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Concurrent reads and writes against the model database')
+    parser.add_argument('--processes', type=int, default=2)
+    parser.add_argument('--readers', type=int, default=4, help='reader threads per process')
+    parser.add_argument('--writers', type=int, default=1, help='writer threads per process')
+    parser.add_argument('--seconds', type=float, default=10.0)
+    parser.add_argument('--pause', type=float, default=0.01, help='seconds between a writer\'s writes')
+    parser.add_argument('--chains', type=int, default=10)
+    parser.add_argument('--states', type=int, default=10)
+    parser.add_argument('--default', action='store_true', help='also run with default SQLite settings')
+    parser.add_argument('--require', type=float, default=None, help='minimum model loads per second')
+    args = parser.parse_args(argv)
+
+    directory = tempfile.mkdtemp(prefix='limsa-db-')
+    try:
+        profiles = [('tuned', True)] + ([('default', False)] if args.default else [])
+        reports = {}
+        for name, tuned in profiles:
+            path = os.path.join(directory, '%s.sqlite' % name)
+            db.configure('sqlite:///' + path, tuned)
+            build(args.chains, args.states)
+            db.dispose()
+            reports[name] = report = benchmark(path, tuned, args.processes, args.readers, args.writers,
+                                               args.seconds, args.pause)
+            print('%-8s polls/s %8.0f  loads/s %7.0f  writes/s %6.0f  read p50 %6.2fms  p99 %7.2fms  locked %d'
+                  % (name, report['poll_per_second'], report['load_per_second'],
+                     report['write_per_second'], report['read_p50_ms'], report['read_p99_ms'],
+                     report['locked']))
+    finally:
+        shutil.rmtree(directory)
+
+    if args.require is not None and reports['tuned']['load_per_second'] < args.require:
+        print('FAIL: %.0f model loads per second, %.0f required'
+              % (reports['tuned']['load_per_second'], args.require))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,124 @@
+from __future__ import division
+
+# Background mortality, births and ageing for a microsimulated population.
+#
+# Life tables (annual probability of death by age group and sex) and
+# fertility (annual births per woman by age group) are loaded as arrays and
+# applied to everyone alive at once each cycle:
+#
+#   1. people who die of background causes, and people in the Death state of
+#      any chain, are moved to Death in every chain in one masked assignment
+#      and their slots are freed (see population.py)
+#   2. women give birth with their age group's quarterly probability; the
+#      newborns take free slots, placed in the chains by an initializer (see
+#      initialize.py) or in each chain's first state
+#   3. everyone alive gets a quarter of a year older
+#
+# Annual rates are converted to quarterly ones with convert_year_to_qt, as
+# everywhere else in the model.
+
+import numpy as np
+
+from parameters import convert_year_to_qt
+from population import MALE, FEMALE
+
+
+class LifeTable(object):
+
+    def __init__(self, ages, male, female):
+        """ages are the lower bounds of the age groups; male and female the
+        annual probabilities of death in each."""
+        self.ages = np.asarray(ages, dtype=float)
+        self.rates = np.vstack([np.asarray(male, dtype=float), np.asarray(female, dtype=float)])
+
+    @classmethod
+    def from_csv(cls, path):
+        """Read a table with age, male and female columns."""
+        table = np.genfromtxt(path, delimiter=',', names=True)
+        return cls(table['age'], table['male'], table['female'])
+
+    def quarterly(self, age, sex):
+        group = np.maximum(np.searchsorted(self.ages, age, side='right') - 1, 0)
+        return convert_year_to_qt(self.rates[sex, group])
+
+
+class Fertility(object):
+
+    def __init__(self, ages, rates):
+        """ages are the lower bounds of the age groups; rates the annual births per woman."""
+        self.ages = np.asarray(ages, dtype=float)
+        self.rates = np.asarray(rates, dtype=float)
+
+    @classmethod
+    def from_csv(cls, path):
+        """Read a table with age and rate columns."""
+        table = np.genfromtxt(path, delimiter=',', names=True)
+        return cls(table['age'], table['rate'])
+
+    def quarterly(self, age):
+        group = np.searchsorted(self.ages, age, side='right') - 1
+        rates = np.where(group >= 0, self.rates[np.maximum(group, 0)], 0.0)
+        return convert_year_to_qt(rates)
+
+
+def death_states(model, name='Death'):
+    """Index of each chain's Death state (-1 for chains without one)."""
+    return np.array([chain.state_names.index(name) if name in chain.state_names else -1
+                     for chain in model.chains])
+
+
+class Demographics(object):
+
+    def __init__(self, population, life_table, fertility=None, initializer=None,
+                 male_births=0.512):
+        self.population = population
+        self.life_table = life_table
+        self.fertility = fertility
+        # Places newborns in the chains; None starts them in each chain's first state
+        self.initializer = initializer
+        self.male_births = male_births
+        self.death = death_states(population.model)
+        self.has_death = self.death >= 0
+
+    def cycle(self):
+        """Apply one cycle of deaths, births and ageing; returns (deaths, births)."""
+        population = self.population
+        profiler = population.profiler
+        t = profiler.start()
+        rng = population.rng
+        living = population.living()
+
+        states = population.states[living]
+        in_death = ((states == self.death) & self.has_death).any(axis=1)
+        background = rng.random_sample(len(living)) < \
+            self.life_table.quarterly(population.age[living], population.sex[living])
+        dying = living[in_death | background]
+        population.assign(dying, np.where(self.has_death, self.death, population.states[dying]))
+        population.remove(dying)
+        t = profiler.lap('demographics/deaths', t)
+
+        births = 0
+        if self.fertility is not None:
+            women = population.living()
+            women = women[population.sex[women] == FEMALE]
+            births = int((rng.random_sample(len(women)) < self.fertility.quarterly(population.age[women])).sum())
+            if births:
+                self.add(births)
+            t = profiler.lap('demographics/births', t)
+
+        population.age[population.alive] += 0.25
+        profiler.lap('demographics/ageing', t)
+        return len(dying), births
+
+    def add(self, n, age=0.0):
+        """Add n new people of the given age; returns their slots."""
+        population = self.population
+        rng = population.rng
+        sex = np.where(rng.random_sample(n) < self.male_births, MALE, FEMALE)
+        if self.initializer is not None:
+            states = self.initializer.sample(n, seed=rng.randint(2 ** 31 - 1),
+                                             given={'man': sex == MALE, 'woman': sex == FEMALE},
+                                             dtype=population.states.dtype)
+        else:
+            states = np.zeros((n, population.states.shape[1]), dtype=population.states.dtype)
+        return population.add(states, age, sex)
@@ -0,0 +1,76 @@
+from __future__ import division
+
+# The model as plain JSON-serializable documents.
+#
+# model_document() loads every chain with its states, transition
+# probabilities and interactions in three queries: chains with their states
+# in one joined query, transitions and interactions in one query each. The
+# API serves it (cached per model revision, see app.py), render.py lays out
+# diagrams from it and Limsa.py uses it to show the chains it builds.
+
+from sqlalchemy.orm import joinedload
+
+from models import Chain, Transition_probability, Interaction
+
+
+def model_document():
+    """Every chain with its states, transition probabilities and interactions."""
+    chains = Chain.query.options(joinedload(Chain.states)).order_by(Chain.id).all()
+    transitions = Transition_probability.query.order_by(Transition_probability.id).all()
+    interactions = Interaction.query.order_by(Interaction.id).all()
+
+    state_chain = {}
+    document = []
+    for chain in chains:
+        states = sorted(chain.states, key=lambda state: state.id)
+        for state in states:
+            state_chain[state.id] = chain.id
+        document.append({
+            'id': chain.id,
+            'name': chain.name,
+            'states': [{
+                'id': state.id,
+                'name': state.name,
+                'cost_input_id': state.cost_input_id,
+                'utility_input_id': state.utility_input_id,
+                'disability_input_id': state.disability_input_id,
+            } for state in states],
+            'transition_probabilities': [],
+            'interactions': [],
+        })
+    by_id = dict((chain['id'], chain) for chain in document)
+
+    for tp in transitions:
+        chain_id = state_chain.get(tp.From_state_id)
+        if chain_id is None:
+            continue
+        by_id[chain_id]['transition_probabilities'].append({
+            'id': tp.id,
+            'from_state_id': tp.From_state_id,
+            'to_state_id': tp.To_state_id,
+            'tp_base': tp.Tp_base,
+            'tp_expression': tp.Tp_expression,
+            'is_dynamic': tp.Is_dynamic,
+            'cost_input_id': tp.Cost_input_id,
+        })
+    for interaction in interactions:
+        # Listed under the chain whose transition is adjusted
+        chain_id = state_chain.get(interaction.From_state_id)
+        if chain_id is None:
+            continue
+        by_id[chain_id]['interactions'].append({
+            'id': interaction.id,
+            'in_state_id': interaction.In_state_id,
+            'from_state_id': interaction.From_state_id,
+            'to_state_id': interaction.To_state_id,
+            'adjustment': interaction.Adjustment,
+        })
+    return document
+
+
+def chain_document(chains, chain_id):
+    """The chain with chain_id from a model document, or None."""
+    for chain in chains:
+        if chain['id'] == chain_id:
+            return chain
+    return None
@@ -0,0 +1,117 @@
+from __future__ import division
+
+# Discounted costs, QALYs and DALYs accumulated inside the engine loop.
+#
+# State costs, utilities and disability weights are annual values taken from
+# the Raw_inputs attached to each state, and accrue per quarterly cycle; a
+# transition cost is paid once by everyone making that transition. Every
+# cycle adds a discounted running dot product of occupancy (or transition
+# flows) with those values, so totals are available at the end of a run
+# without storing a state trace.
+#
+# Utilities and disability weights of the chains are combined
+# multiplicatively: a person's utility is the product of the utilities of
+# the states they are in, and their disability weight is
+# 1 - product(1 - weight). Chains with no occupancy (such as chains
+# without states) are left out of both products.
+#
+# States without an input have no cost, a utility of 1 and a disability
+# weight of 0, except absorbing states (Death): they default to a utility
+# of 0 and a disability weight of 1, so the dead accrue no QALYs and every
+# quarter spent dead within the horizon counts as a quarter of life lost
+# in the DALYs.
+
+import numpy as np
+
+from engine import Observer
+from parameters import convert_year_to_qt
+
+
+class Economics(Observer):
+
+    def __init__(self, discount_rate=0.03, absorbing=('Death',)):
+        self.discount_rate = discount_rate
+        # Names of the states of the dead
+        self.absorbing = absorbing
+        self.costs, self.qalys, self.dalys = [], [], []
+
+    def start(self, engine, values):
+        model = engine.model
+        self.state_costs = model.state_values(values, 'cost_index', 0.0)
+        self.utilities = model.state_values(values, 'utility_index', 1.0)
+        self.disabilities = model.state_values(values, 'disability_index', 0.0)
+        for chain, utilities, disabilities in zip(model.chains, self.utilities, self.disabilities):
+            for s, name in enumerate(chain.state_names):
+                if name in self.absorbing:
+                    if chain.utility_index[s] < 0:
+                        utilities[:, s] = 0.0
+                    if chain.disability_index[s] < 0:
+                        disabilities[:, s] = 1.0
+        self.transition_costs = model.transition_costs(values)
+        self.has_transition_costs = [costs.any() for costs in self.transition_costs]
+
+        n = values.shape[0]
+        self.cost, self.qaly, self.daly = np.zeros(n), np.zeros(n), np.zeros(n)
+
+    def cycle(self, cycle, occupancy, matrices):
+        discount = (1.0 + self.discount_rate) ** (-cycle / 4.0)
+
+        cost = np.zeros_like(self.cost)
+        utility = np.ones_like(self.qaly)
+        healthy = np.ones_like(self.daly)
+        for c, occ in enumerate(occupancy):
+            cost += convert_year_to_qt(np.einsum('ns,ns->n', occ, self.state_costs[c]))
+            if self.has_transition_costs[c]:
+                cost += np.einsum('ns,nst,nst->n', occ, matrices[c], self.transition_costs[c])
+            # A chain nobody is in (one with no states, say) says nothing
+            # about anyone's health, so it leaves the products alone
+            mass = occ.sum(axis=1)
+            if not mass.any():
+                continue
+            populated = mass > 0
+            utility *= np.where(populated, np.einsum('ns,ns->n', occ, self.utilities[c]), 1.0)
+            healthy *= np.where(populated, 1.0 - np.einsum('ns,ns->n', occ, self.disabilities[c]), 1.0)
+
+        self.cost += discount * cost
+        self.qaly += discount * convert_year_to_qt(utility)
+        self.daly += discount * convert_year_to_qt(1.0 - healthy)
+
+    def finish(self, occupancy):
+        self.costs.append(self.cost)
+        self.qalys.append(self.qaly)
+        self.dalys.append(self.daly)
+
+    def state(self):
+        arrays = {'cost': self.cost, 'qaly': self.qaly, 'daly': self.daly}
+        if self.costs:
+            arrays['costs'], arrays['qalys'], arrays['dalys'] = self.totals()
+        return arrays
+
+    def restore(self, engine, values, state):
+        self.start(engine, values)
+        self.cost = np.array(state['cost'])
+        self.qaly = np.array(state['qaly'])
+        self.daly = np.array(state['daly'])
+        if 'costs' in state:
+            self.costs = [np.array(state['costs'])]
+            self.qalys = [np.array(state['qalys'])]
+            self.dalys = [np.array(state['dalys'])]
+
+    def totals(self):
+        """Discounted (costs, QALYs, DALYs) per scenario, over all batches run."""
+        return (np.concatenate(self.costs), np.concatenate(self.qalys),
+                np.concatenate(self.dalys))
+
+
+def icer(costs, effects, reference=0):
+    """Incremental cost-effectiveness ratios of each strategy against reference.
+
+    costs and effects are strategies (or scenarios x strategies) arrays of
+    discounted totals; the reference strategy's own ratio is nan.
+    """
+    costs = np.asarray(costs, dtype=float)
+    effects = np.asarray(effects, dtype=float)
+    delta_cost = costs - costs[..., reference:reference + 1]
+    delta_effect = effects - effects[..., reference:reference + 1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return delta_cost / delta_effect
@@ -0,0 +1,286 @@
+from __future__ import division
+
+# Cohort engine for compiled Limsa models.
+#
+# The engine steps the state occupancy of every chain (scenarios x states)
+# through n_cycles quarterly cycles. All scenarios in a batch - sensitivity
+# perturbations, PSA draws - advance together, so one cycle is a handful of
+# batched matrix products regardless of how many scenarios are run.
+#
+# Interactions are applied in mean-field form: the from -> to probability of
+# the affected chain is scaled by 1 + (Adjustment - 1) * (share of the cohort
+# in the interacting state).
+#
+# Dynamic transitions (transmission, see transmission.py) are set each cycle
+# by Dynamic objects from the current occupancy, after interactions.
+#
+# Observers see every cycle as it happens - the occupancy at the start of the
+# cycle and the matrices used to move it - so outputs such as discounted
+# costs can be accumulated in the loop instead of from a stored trace.
+#
+# With strata (see strata.py) every scenario is expanded into one row per
+# stratum inside run_batch; observers still see one row per scenario.
+#
+# dtype=np.float32 keeps the occupancy and transition matrices of the loop
+# in single precision, halving the memory the hot loop reads and writes for
+# large PSA batches. precision_error() measures what that costs on a
+# reference scenario against float64.
+#
+# With schedules (see schedules.py) inputs change over time; the matrices
+# are rebuilt, and dynamics prepared again, only at the cycles where a
+# scheduled input changes.
+
+import numpy as np
+
+from profiling import NULL_PROFILER
+
+
+class Engine(object):
+
+    def __init__(self, model, n_cycles, initial=None, batch_size=4096, seed=0, strata=None,
+                 dynamics=(), dtype=np.float64, schedules=None):
+        self.model = model
+        self.n_cycles = n_cycles
+        # Float type of the occupancy and matrices in the loop
+        self.dtype = np.dtype(dtype)
+        # chain name -> initial distribution over that chain's states
+        self.initial = initial or {}
+        self.batch_size = batch_size
+        # Random state for stochastic components; saved with checkpoints
+        self.rng = np.random.RandomState(seed)
+        self.strata = strata
+        self.dynamics = list(dynamics)
+        self.schedules = schedules
+        # Stratified occupancy and mass of the batch being run
+        self.stratified = None
+        self.mass = None
+        # Times the phases of each cycle, see profiling.py
+        self.profiler = NULL_PROFILER
+
+    def initial_occupancy(self, n):
+        if self.strata is not None:
+            n *= self.strata.size
+        occupancy = []
+        for chain in self.model.chains:
+            start = np.zeros(len(chain), dtype=self.dtype)
+            if chain.name in self.initial:
+                start[:] = self.initial[chain.name]
+            elif len(chain):
+                start[0] = 1.0
+            occupancy.append(np.tile(start, (n, 1)))
+        return occupancy
+
+    def run(self, values, observers=()):
+        """Final occupancy of every chain for each scenario row of values."""
+        values = np.atleast_2d(values)
+        results = [[] for _ in self.model.chains]
+        for start in range(0, values.shape[0], self.batch_size):
+            final = self.run_batch(values[start:start + self.batch_size], observers)
+            for i, occupancy in enumerate(final):
+                results[i].append(occupancy)
+        return [np.vstack(parts) for parts in results]
+
+    def run_batch(self, values, observers=(), resume=None, checkpoint=None):
+        """Run one batch of scenarios and return the final occupancy.
+
+        resume is the state saved by a checkpoint ({'cycle', 'occupancy',
+        'observers'}) to continue from; checkpoint, if given, is asked at the
+        start of every cycle whether to save the batch's state.
+        """
+        profiler = self.profiler
+        t = profiler.start()
+        strata = self.strata
+        schedules = self.schedules
+        if schedules is None:
+            matrices = self.matrices(values)
+            t = profiler.lap('matrices', t)
+        if resume is None:
+            first = 0
+            occupancy = self.initial_occupancy(values.shape[0])
+            for observer in observers:
+                observer.start(self, values)
+        else:
+            first = resume['cycle']
+            occupancy = [np.array(occ, dtype=self.dtype) for occ in resume['occupancy']]
+            for observer, state in zip(observers, resume['observers']):
+                observer.restore(self, values, state)
+        for dynamic in self.dynamics:
+            dynamic.start(self, values)
+        if strata is not None:
+            # Stratum sizes only change through ageing, so follow from the
+            # cycle (a checkpoint is taken after that cycle's birthdays)
+            self.mass = strata.mass(values.shape[0], first)
+        t = profiler.lap('start', t)
+        for cycle in range(first, self.n_cycles):
+            if schedules is not None and (cycle == first or schedules.changes(cycle)):
+                scheduled = schedules.values(values, cycle)
+                matrices = self.matrices(scheduled)
+                for dynamic in self.dynamics:
+                    dynamic.prepare(scheduled)
+                t = profiler.lap('matrices', t)
+            if strata is not None and (resume is None or cycle > first):
+                occupancy, self.mass = strata.age(cycle, occupancy, self.mass)
+                # Ageing mixes in the float64 masses
+                occupancy = [occ.astype(self.dtype, copy=False) for occ in occupancy]
+                t = profiler.lap('ageing', t)
+            if checkpoint is not None and (resume is None or cycle > first) and checkpoint.due(cycle):
+                checkpoint.save_batch(self, values, cycle, occupancy, observers)
+                t = profiler.lap('checkpoint', t)
+            adjusted = self.interact(occupancy, matrices)
+            t = profiler.lap('interactions', t)
+            for dynamic in self.dynamics:
+                adjusted = dynamic.update(cycle, occupancy, adjusted)
+                t = profiler.lap('dynamics/' + type(dynamic).__name__, t)
+            if observers:
+                self.stratified = occupancy
+                seen, seen_matrices = self.population(occupancy, adjusted)
+                t = profiler.lap('population', t)
+                for observer in observers:
+                    observer.cycle(cycle, seen, seen_matrices)
+                    t = profiler.lap('observers/' + type(observer).__name__, t)
+            occupancy = self.step(occupancy, adjusted)
+            t = profiler.lap('step', t)
+        self.stratified = occupancy
+        occupancy = self.population(occupancy)[0]
+        for observer in observers:
+            observer.finish(occupancy)
+        profiler.lap('finish', t)
+        profiler.count('cycles', self.n_cycles - first)
+        profiler.count('scenario_cycles', values.shape[0] * (self.n_cycles - first))
+        return occupancy
+
+    def matrices(self, values):
+        """Transition matrices of every chain for values, one row per scenario and stratum."""
+        if self.strata is not None:
+            values = self.strata.expand(self.model.parameters, values)
+        return [matrix.astype(self.dtype, copy=False) for matrix in self.model.matrices(values)]
+
+    def per_row(self, array):
+        """array with one row per scenario repeated for every stratum row."""
+        if self.strata is None:
+            return array
+        return np.repeat(array, self.strata.size, axis=0)
+
+    def population(self, occupancy, matrices=None):
+        """Occupancy (and matrices) with strata combined, one row per scenario."""
+        if self.strata is None:
+            return occupancy, matrices
+        return self.strata.population(occupancy, matrices, self.mass)
+
+    def step(self, occupancy, matrices):
+        return [np.einsum('ns,nst->nt', occ, matrix)
+                for occ, matrix in zip(occupancy, matrices)]
+
+    def interact(self, occupancy, matrices):
+        if not self.model.interactions:
+            return matrices
+        adjusted = list(matrices)
+        copied = set()
+        for interaction in self.model.interactions:
+            c = interaction.chain
+            if c not in copied:
+                adjusted[c] = adjusted[c].copy()
+                copied.add(c)
+            share = occupancy[interaction.in_chain][:, interaction.in_state]
+            f, t = interaction.from_state, interaction.to_state
+            old = adjusted[c][:, f, t].copy()
+            adjusted[c][:, f, t] = old * (1.0 + (interaction.adjustment - 1.0) * share)
+            adjusted[c][:, f, f] -= adjusted[c][:, f, t] - old
+        return adjusted
+
+
+def precision_error(engine, values=None):
+    """Largest absolute difference in final occupancy between engine and float64.
+
+    values defaults to the base case; the engine is rerun with the same
+    settings in float64 to compare against.
+    """
+    if values is None:
+        values = engine.model.parameters.base(1)
+    values = np.atleast_2d(values)
+    reference = Engine(engine.model, engine.n_cycles, engine.initial, engine.batch_size,
+                       strata=engine.strata, dynamics=engine.dynamics, schedules=engine.schedules)
+    compact = engine.run(values)
+    exact = reference.run(values)
+    # Chains without states give zero-size arrays, which have no max
+    return max([float(np.abs(a.astype(np.float64) - b).max()) for a, b in zip(compact, exact) if a.size]
+               + [0.0])
+
+
+class Observer(object):
+
+    # Base class for objects that watch a batch being run; cycle() is given
+    # the occupancy at the start of the cycle and the matrices that move it
+
+    def start(self, engine, values):
+        pass
+
+    def cycle(self, cycle, occupancy, matrices):
+        pass
+
+    def finish(self, occupancy):
+        pass
+
+    # Checkpointing: state() returns the arrays needed to pick a batch up
+    # where it stopped, and restore() is called instead of start() when it is
+
+    def state(self):
+        return {}
+
+    def restore(self, engine, values, state):
+        self.start(engine, values)
+
+
+class Dynamic(object):
+
+    # Base class for transitions set each cycle from the state of the
+    # cohort; update() returns the matrices to use for the cycle, without
+    # changing the ones it is given
+
+    def start(self, engine, values):
+        self.engine = engine
+        self.prepare(values)
+
+    def prepare(self, values):
+        # Read inputs from values; called again with the scheduled values
+        # whenever a schedule changes them
+        pass
+
+    def update(self, cycle, occupancy, matrices):
+        return matrices
+
+    def describe(self):
+        # What sets the dynamic apart from others of its class, for cache keys
+        return {'class': type(self).__name__}
+
+
+def set_transition(matrices, c, from_state, to_state, probability):
+    """Copy of matrices with chain c's from -> to probability replaced.
+
+    The change is balanced on the diagonal, so rows still sum to 1.
+    """
+    matrices = list(matrices)
+    matrix = matrices[c] = matrices[c].copy()
+    old = matrix[:, from_state, to_state].copy()
+    matrix[:, from_state, to_state] = probability
+    matrix[:, from_state, from_state] += old - probability
+    return matrices
+
+
+class StateOutcome(object):
+
+    # Share of the cohort in one state; a class rather than a closure so
+    # that it can be sent to worker processes
+
+    def __init__(self, chain, state):
+        self.chain = chain
+        self.state = state
+
+    def __call__(self, occupancy):
+        return occupancy[self.chain][:, self.state]
+
+
+def state_outcome(model, chain_name, state_name):
+    """Outcome function returning the share of the cohort in one state."""
+    c = model.chain_index[chain_name]
+    return StateOutcome(c, model.chains[c].state(state_name))
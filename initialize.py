@@ -0,0 +1,192 @@
+from __future__ import division
+
+# Initial placement of a population across all chains.
+#
+# Placement is correlated between chains (more HIV+ people have TB), so
+# following the tagging scheme in limsa.md, an Initialization_probability
+# row gives the probability of starting in its state for people carrying
+# all of its tags, and a person's tags are the tags of the states they have
+# already been placed in (plus any given up front, e.g. from strata).
+#
+# The rows are compiled once into a lookup table per chain: the chain's
+# conditioning tags are numbered, every combination of them is a pattern
+# (bit b set if a person has tag b), and each pattern's row of cumulative
+# probabilities comes from the most specific matching group of rows - the
+# ones whose tags are all in the pattern, with the most tags. Chains are
+# placed in an order where every tag a chain conditions on is provided by
+# a chain placed before it.
+#
+# Sampling is vectorized over the whole population: each person's pattern
+# is built from their states so far with a few bit operations, and within
+# each pattern present a state is looked up from a uniform draw in the
+# pattern's cumulative probabilities - a categorical draw per person, so
+# each pattern's counts are multinomial.
+
+from collections import OrderedDict
+
+import numpy as np
+
+
+class CompiledChainInitializer(object):
+
+    def __init__(self, chain, tags, cdf):
+        self.chain = chain
+        # Names of the conditioning tags, bit b of the pattern for tags[b]
+        self.tags = list(tags)
+        # patterns x states cumulative probabilities
+        self.cdf = cdf
+
+
+class Initializer(object):
+
+    def __init__(self, model, chains, state_tags):
+        self.model = model
+        # One CompiledChainInitializer per chain, in placement order
+        self.chains = list(chains)
+        # chain index -> (tag names, states x tags boolean) for tags its states carry
+        self.state_tags = state_tags
+
+    def sample(self, n, seed=0, given=None, dtype=np.int16):
+        """n x chains array of initial state indices (columns in model chain order).
+
+        given maps tag names not carried by any state (e.g. 'man', 'urban')
+        to boolean arrays saying which of the n people have them.
+        """
+        rng = np.random.RandomState(seed)
+        placed = np.zeros((n, len(self.model.chains)), dtype=dtype)
+        has = dict((tag, np.asarray(mask, dtype=bool)) for tag, mask in (given or {}).items())
+        for initializer in self.chains:
+            pattern = np.zeros(n, dtype=np.int64)
+            for bit, tag in enumerate(initializer.tags):
+                if tag in has:
+                    pattern |= has[tag].astype(np.int64) << bit
+            u = rng.random_sample(n)
+            last = initializer.cdf.shape[1] - 1
+            if not initializer.tags:
+                states = np.minimum(np.searchsorted(initializer.cdf[0], u, side='right'), last)
+            else:
+                # One categorical lookup per pattern present
+                states = np.empty(n, dtype=dtype)
+                for p in np.flatnonzero(np.bincount(pattern, minlength=len(initializer.cdf))):
+                    members = np.flatnonzero(pattern == p)
+                    states[members] = np.minimum(
+                        np.searchsorted(initializer.cdf[p], u[members], side='right'), last)
+            placed[:, initializer.chain] = states
+
+            names, carries = self.state_tags.get(initializer.chain, ([], None))
+            for t, tag in enumerate(names):
+                mask = carries[states, t]
+                has[tag] = has[tag] | mask if tag in has else mask
+        return placed
+
+    def occupancy(self, placed):
+        """Share of the population in each state of every chain (the cohort view)."""
+        return OrderedDict((chain.name, np.bincount(placed[:, c], minlength=len(chain)) / placed.shape[0])
+                           for c, chain in enumerate(self.model.chains))
+
+
+def compile_initializer(model, state_tags, rows):
+    """Compile initialization tables against a compiled model.
+
+    state_tags is (state id, tag name) pairs; rows is (state id,
+    probability, tag names) triples, one per Initialization_probability.
+    """
+    chain_of_state = {}
+    for c, chain in enumerate(model.chains):
+        for state_id in chain.state_ids:
+            chain_of_state[state_id] = c
+
+    # Tags carried by the states of each chain
+    carried = {}
+    for state_id, tag in state_tags:
+        if state_id in chain_of_state:
+            carried.setdefault(chain_of_state[state_id], {}).setdefault(tag, set()).add(state_id)
+    provider = {}
+    for c, tags in carried.items():
+        for tag in tags:
+            provider.setdefault(tag, set()).add(c)
+    tables = {}
+    for c, tags in carried.items():
+        chain = model.chains[c]
+        names = sorted(tags)
+        carries = np.zeros((len(chain), len(names)), dtype=bool)
+        for t, tag in enumerate(names):
+            for state_id in tags[tag]:
+                carries[chain.index[state_id], t] = True
+        tables[c] = (names, carries)
+
+    # Rows grouped by chain, then by their set of tags
+    groups = {}
+    for state_id, probability, tags in rows:
+        if state_id not in chain_of_state:
+            continue
+        c = chain_of_state[state_id]
+        group = groups.setdefault(c, {}).setdefault(frozenset(tags), np.zeros(len(model.chains[c])))
+        group[model.chains[c].index[state_id]] += probability
+
+    order = _placement_order(model, groups, provider)
+    compiled = []
+    for c in order:
+        chain = model.chains[c]
+        by_tags = groups.get(c, {})
+        tags = sorted(set(tag for group in by_tags for tag in group))
+        if len(tags) > 20:
+            raise ValueError('%s: too many conditioning tags (%d)' % (chain.name, len(tags)))
+        cdf = np.ones((2 ** len(tags), max(len(chain), 1)))
+        for pattern in range(2 ** len(tags)):
+            present = set(tag for b, tag in enumerate(tags) if pattern >> b & 1)
+            probabilities = _most_specific(chain, by_tags, present)
+            cdf[pattern] = np.cumsum(probabilities)
+        compiled.append(CompiledChainInitializer(c, tags, cdf))
+    return Initializer(model, compiled, tables)
+
+
+def _most_specific(chain, by_tags, present):
+    matching = [tags for tags in by_tags if tags <= present]
+    if not matching:
+        # No table for these people: start in the chain's first state, as
+        # the engine does by default
+        probabilities = np.zeros(max(len(chain), 1))
+        probabilities[0] = 1.0
+        return probabilities
+    size = max(len(tags) for tags in matching)
+    best = [tags for tags in matching if len(tags) == size]
+    if len(best) > 1:
+        raise ValueError('%s: ambiguous initialization probabilities for tags %s (%s)'
+                         % (chain.name, ', '.join(sorted(present)),
+                            ' / '.join(', '.join(sorted(tags)) for tags in best)))
+    probabilities = by_tags[best[0]]
+    total = probabilities.sum()
+    if total <= 0:
+        raise ValueError('%s: initialization probabilities for tags %s sum to %g'
+                         % (chain.name, ', '.join(sorted(best[0])), total))
+    return probabilities / total
+
+
+def _placement_order(model, groups, provider):
+    # Chains whose tables condition on tags from other chains are placed
+    # after those chains
+    after = {}
+    for c in range(len(model.chains)):
+        needs = set(tag for tags in groups.get(c, {}) for tag in tags)
+        after[c] = set(p for tag in needs for p in provider.get(tag, ()) if p != c)
+    order, done = [], set()
+    while len(order) < len(model.chains):
+        ready = [c for c in range(len(model.chains)) if c not in done and after[c] <= done]
+        if not ready:
+            raise ValueError('Initialization tags depend on each other in a cycle: %s'
+                             % ', '.join(model.chains[c].name for c in after if c not in done))
+        order.extend(ready)
+        done.update(ready)
+    return order
+
+
+def compile_database(model):
+    """Initializer for model from the tables stored in the application database."""
+    from sqlalchemy.orm import joinedload
+    from models import Tag, Initialization_probability
+    state_tags = [(state.id, tag.name)
+                  for tag in Tag.query.options(joinedload(Tag.states)).all() for state in tag.states]
+    rows = [(row.State_id, row.Probability or 0.0, [tag.name for tag in row.Tags])
+            for row in Initialization_probability.query.options(joinedload(Initialization_probability.Tags)).all()]
+    return compile_initializer(model, state_tags, rows)
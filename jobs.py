@@ -0,0 +1,402 @@
+from __future__ import division
+
+# Background simulation jobs.
+#
+# Runs are submitted to a queue kept in its own SQLite file (next to
+# limsa.sqlite, so a long run never holds a lock on the model database) and
+# picked up by a pool of worker processes (start_workers(), also available
+# as the manager's worker command).
+#
+# Each job row records its kind ('engine' or 'psa'), JSON parameters,
+# status, progress (cycles completed or draws finished) and, once it is
+# done, a JSON result or the error that stopped it. The web app only ever
+# inserts and reads rows, so a request returns immediately however long the
+# simulation takes, and several analysts can share one compute box.
+#
+# Workers claim jobs with an IMMEDIATE transaction, so two workers can never
+# take the same job. PSA jobs checkpoint as they go (see checkpoint.py); a
+# job left running by a worker that died is put back on the queue and
+# continues from its last checkpoint. The file is in WAL mode, so progress
+# polls from the web app never wait on a worker's update.
+#
+# Every job times the phases of its run (see profiling.py) and leaves the
+# report as profile.json in its directory under results/jobs, and in the
+# run's directory when it stored a trace. params['profile'] ({'sample_interval':
+# seconds, 'allocations': true}) also samples the worker's stack and traces
+# its allocations.
+#
+# params['dtype'] = 'float32' runs the cohort loop in single precision
+# (see engine.py). The base case is run both ways first, and the job fails
+# if the final occupancies differ by more than params['tolerance'].
+#
+# params['schedules'] (a list of {'slug', 'times', 'values', 'interpolation',
+# 'relative'}) with params['start_year'] changes inputs over time, see
+# schedules.py.
+
+import json
+import multiprocessing
+import os
+import shutil
+import socket
+import sqlite3
+import sys
+import time
+import traceback
+
+import numpy as np
+
+import cache
+from checkpoint import Checkpoint
+from compiler import compile_database
+from economics import Economics
+from engine import Engine, Observer, precision_error, state_outcome
+from profiling import Profiler
+from psa import PSA
+from reducers import Reducer
+from schedules import Schedules
+from results import RESULTS_DIR, TraceWriter, create_run, run_path
+
+
+basedir = os.path.abspath(os.path.dirname(__file__))
+JOBS_DATABASE = os.path.join(basedir, 'database/jobs.sqlite')
+
+QUEUED, RUNNING, DONE, FAILED = 'queued', 'running', 'done', 'failed'
+
+SCHEMA = """
+PRAGMA journal_mode = WAL;
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind VARCHAR(16) NOT NULL,
+    params TEXT NOT NULL,
+    status VARCHAR(16) NOT NULL,
+    worker VARCHAR(64),
+    created REAL NOT NULL,
+    started REAL,
+    updated REAL,
+    finished REAL,
+    done INTEGER NOT NULL DEFAULT 0,
+    total INTEGER,
+    unit VARCHAR(16),
+    result TEXT,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS ix_jobs_status ON jobs (status, id);
+"""
+
+COLUMNS = ['id', 'kind', 'params', 'status', 'worker', 'created', 'started', 'updated',
+           'finished', 'done', 'total', 'unit', 'result', 'error']
+
+
+class JobQueue(object):
+
+    def __init__(self, path=JOBS_DATABASE):
+        self.path = path
+        with self._connect() as connection:
+            connection.executescript(SCHEMA)
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        connection.row_factory = sqlite3.Row
+        return _Connection(connection)
+
+    def submit(self, kind, params=None):
+        """Queue a job and return its id."""
+        if kind not in RUNNERS:
+            raise ValueError('Unknown job kind: %s' % kind)
+        with self._connect() as connection:
+            cursor = connection.execute(
+                'INSERT INTO jobs (kind, params, status, created) VALUES (?, ?, ?, ?)',
+                (kind, json.dumps(params or {}), QUEUED, time.time()))
+            return cursor.lastrowid
+
+    def get(self, job_id):
+        with self._connect() as connection:
+            row = connection.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        return _job(row) if row is not None else None
+
+    def list(self, status=None, limit=100):
+        query, args = 'SELECT * FROM jobs', ()
+        if status is not None:
+            query, args = query + ' WHERE status = ?', (status,)
+        with self._connect() as connection:
+            rows = connection.execute(query + ' ORDER BY id DESC LIMIT ?', args + (limit,)).fetchall()
+        return [_job(row) for row in rows]
+
+    def claim(self, worker):
+        """Mark the oldest queued job as running by worker and return it, or None."""
+        with self._connect() as connection:
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                row = connection.execute('SELECT * FROM jobs WHERE status = ? ORDER BY id LIMIT 1',
+                                         (QUEUED,)).fetchone()
+                if row is not None:
+                    now = time.time()
+                    connection.execute(
+                        'UPDATE jobs SET status = ?, worker = ?, started = ?, updated = ? WHERE id = ?',
+                        (RUNNING, worker, now, now, row['id']))
+                connection.execute('COMMIT')
+            except Exception:
+                connection.execute('ROLLBACK')
+                raise
+        if row is None:
+            return None
+        job = _job(row)
+        job['status'], job['worker'] = RUNNING, worker
+        return job
+
+    def progress(self, job_id, done, total=None, unit=None):
+        with self._connect() as connection:
+            connection.execute(
+                'UPDATE jobs SET done = ?, total = COALESCE(?, total), unit = COALESCE(?, unit), '
+                'updated = ? WHERE id = ?', (int(done), total, unit, time.time(), job_id))
+
+    def finish(self, job_id, result):
+        self._close(job_id, DONE, result=json.dumps(jsonable(result)))
+
+    def fail(self, job_id, error):
+        self._close(job_id, FAILED, error=error)
+
+    def requeue_stale(self, timeout=600):
+        """Put running jobs not heard from for timeout seconds back on the queue."""
+        with self._connect() as connection:
+            cursor = connection.execute(
+                'UPDATE jobs SET status = ?, worker = NULL WHERE status = ? AND updated < ?',
+                (QUEUED, RUNNING, time.time() - timeout))
+            return cursor.rowcount
+
+    def _close(self, job_id, status, result=None, error=None):
+        with self._connect() as connection:
+            now = time.time()
+            connection.execute(
+                'UPDATE jobs SET status = ?, result = ?, error = ?, finished = ?, updated = ? '
+                'WHERE id = ?', (status, result, error, now, now, job_id))
+
+
+class _Connection(object):
+
+    # sqlite3 connections used as context managers commit but do not close
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __enter__(self):
+        return self.connection
+
+    def __exit__(self, *exc):
+        self.connection.close()
+
+
+def _job(row):
+    job = dict(zip(COLUMNS, [row[column] for column in COLUMNS]))
+    job['params'] = json.loads(job['params'])
+    if job['result'] is not None:
+        job['result'] = json.loads(job['result'])
+    return job
+
+
+def jsonable(value):
+    """value with numpy arrays and scalars converted for json.dumps."""
+    if isinstance(value, dict):
+        return dict((str(k), jsonable(v)) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return [jsonable(v) for v in value]
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+#### ---------------- Runners -------------------------
+
+# A runner takes the job's params, a report(done, total, unit) callback and
+# the job's profiler, and returns a JSON-serializable result.
+
+
+PRECISION_TOLERANCE = 1e-5
+
+
+def _engine(params, profiler=None):
+    model = compile_database()
+    n_cycles = int(params.get('n_cycles', 40))
+    schedules = None
+    if params.get('schedules'):
+        schedules = Schedules.from_params(model.parameters, params, n_cycles)
+    engine = Engine(model, n_cycles, initial=params.get('initial'),
+                    batch_size=int(params.get('batch_size', 4096)), seed=int(params.get('seed', 0)),
+                    dtype=params.get('dtype', 'float64'), schedules=schedules)
+    if engine.dtype != np.float64:
+        error = precision_error(engine)
+        tolerance = float(params.get('tolerance', PRECISION_TOLERANCE))
+        if error > tolerance:
+            raise ValueError('%s changes the base case occupancy by %.3g, more than %.3g'
+                             % (engine.dtype.name, error, tolerance))
+    if profiler is not None:
+        engine.profiler = profiler
+    return engine
+
+
+def _profiler(params):
+    options = params.get('profile') or {}
+    if options is True:
+        options = {'sample_interval': 0.01}
+    return Profiler(sample_interval=options.get('sample_interval'),
+                    allocations=bool(options.get('allocations')))
+
+
+def _outcomes(model, params):
+    return [('%s: %s' % (chain, state), state_outcome(model, chain, state))
+            for chain, state in params.get('outcomes', ())]
+
+
+class Progress(Observer):
+
+    # Reports cycles completed, at most every interval seconds
+
+    def __init__(self, report, n_cycles, interval=1.0):
+        self.report = report
+        self.n_cycles = n_cycles
+        self.interval = interval
+        self.last = 0
+
+    def cycle(self, cycle, occupancy, matrices):
+        if time.time() - self.last >= self.interval:
+            self.report(cycle, self.n_cycles, 'cycles')
+            self.last = time.time()
+
+    def finish(self, occupancy):
+        self.report(self.n_cycles, self.n_cycles, 'cycles')
+
+
+def run_engine(params, report, profiler=None):
+    """A single scenario: the base case with params['values'] (slug -> value) overridden.
+
+    Returns discounted costs, QALYs and DALYs, the final value of each
+    requested outcome and, with params['trace'], the id of the run its
+    trace was stored under.
+    """
+    engine = _engine(params, profiler)
+    parameters = engine.model.parameters
+    values = parameters.base(1)
+    for slug, value in params.get('values', {}).items():
+        values[:, parameters.index[slug]] = value
+    parameters.evaluate(values)
+
+    economics = Economics(float(params.get('discount_rate', 0.03)))
+    observers = [economics, Progress(report, engine.n_cycles)]
+    result = {}
+    if params.get('trace'):
+        run_id = create_run(params.get('name'), 1, engine.n_cycles)
+        observers.append(TraceWriter(run_id, engine.model, engine.n_cycles))
+        result['run_id'] = run_id
+
+    occupancy = engine.run_batch(values, observers)
+    costs, qalys, dalys = economics.totals()
+    result.update({'cost': costs[0], 'qaly': qalys[0], 'daly': dalys[0]})
+    result['outcomes'] = dict((name, outcome(occupancy)[0])
+                              for name, outcome in _outcomes(engine.model, params))
+    return result
+
+
+def run_psa(params, report, profiler=None, checkpoint_path=None):
+    """A PSA over params['outcomes'] ([chain, state] pairs); returns reducer summaries."""
+    engine = _engine(params, profiler)
+    n_draws = int(params.get('n_draws', 1000))
+    reducers = [Reducer(name, outcome, every=params.get('every'))
+                for name, outcome in _outcomes(engine.model, params)]
+    psa = PSA(engine, reducers, n_draws, seed=int(params.get('seed', 0)),
+              distribution=params.get('distribution', 'pert'),
+              progress=lambda done, reducers: report(done, n_draws, 'draws'))
+
+    checkpoint = None
+    if checkpoint_path is not None:
+        if os.path.exists(checkpoint_path):
+            psa.restore(checkpoint_path)
+        checkpoint = Checkpoint(checkpoint_path, every_batches=None, every_seconds=60)
+    cache.cached_psa(cache.default_cache(), psa, int(params.get('n_workers', 1)), checkpoint)
+    if checkpoint_path is not None and os.path.exists(checkpoint_path):
+        shutil.rmtree(checkpoint_path)
+    return [reducer.summary() for reducer in reducers]
+
+
+RUNNERS = {
+    'engine': run_engine,
+    'psa': run_psa,
+}
+
+
+#### ---------------- Workers -------------------------
+
+
+def job_directory(job_id):
+    return os.path.join(RESULTS_DIR, 'jobs', str(job_id))
+
+
+def job_checkpoint(job_id):
+    return os.path.join(job_directory(job_id), 'checkpoint')
+
+
+def run_job(queue, job):
+    def report(done, total=None, unit=None):
+        queue.progress(job['id'], done, total, unit)
+
+    profiler = _profiler(job['params'])
+    try:
+        with profiler:
+            if job['kind'] == 'psa':
+                result = run_psa(job['params'], report, profiler, job_checkpoint(job['id']))
+            else:
+                result = RUNNERS[job['kind']](job['params'], report, profiler)
+    except Exception:
+        profiler.write(job_directory(job['id']))
+        queue.fail(job['id'], traceback.format_exc())
+    else:
+        profiler.write(job_directory(job['id']))
+        if isinstance(result, dict) and 'run_id' in result:
+            profiler.write(run_path(result['run_id']))
+        queue.finish(job['id'], result)
+
+
+def work(path=JOBS_DATABASE, poll=1.0, once=False, stop=None):
+    """Run queued jobs until interrupted (or, with once, until the queue is empty).
+
+    stop, a multiprocessing.Event, ends the loop between jobs once set.
+    """
+    models = sys.modules.get('models')
+    if models is not None:
+        # Connections pooled by the process this one was forked from stay there
+        models.db.dispose()
+    queue = JobQueue(path)
+    worker = '%s:%d' % (socket.gethostname(), os.getpid())
+    while stop is None or not stop.is_set():
+        job = queue.claim(worker)
+        if job is not None:
+            run_job(queue, job)
+        elif once:
+            return
+        else:
+            time.sleep(poll)
+
+
+def start_workers(processes=2, path=JOBS_DATABASE, stale=600, once=False):
+    """Start a pool of worker processes and wait for them.
+
+    Workers are not daemonic, so a PSA job can run a pool of its own
+    (params['n_workers']); they are stopped here instead when this process
+    is interrupted.
+    """
+    JobQueue(path).requeue_stale(stale)
+    stop = multiprocessing.Event()
+    workers = [multiprocessing.Process(target=work, args=(path,), kwargs={'once': once, 'stop': stop})
+               for _ in range(processes)]
+    for worker in workers:
+        worker.start()
+    try:
+        for worker in workers:
+            worker.join()
+    finally:
+        stop.set()
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+            worker.join()
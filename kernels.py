@@ -0,0 +1,180 @@
+from __future__ import division
+
+# Fused transition kernels for microsimulation.
+#
+# For every person alive and every chain, one step
+#
+#   1. looks up the row of the chain's matrix for the person's current state
+#   2. applies the model's interactions: being in in_state of in_chain
+#      multiplies the from -> to probability by the adjustment, balanced on
+#      the diagonal so the row still sums to 1 (as Engine.interact does for
+#      a cohort, with a share of 0 or 1)
+#   3. samples the next state from the row's cumulative probabilities
+#
+# Interactions read everyone's states at the start of the cycle, so the
+# order of the chains does not matter. Chains without states are passed
+# over, their column left as it is.
+#
+# Two backends compute the same thing:
+#
+#   numpy   a person x states array of rows per chain; several temporaries
+#           per chain, but no dependencies beyond numpy
+#   numba   one pass over the people, in blocks of BLOCK, each person's row
+#           held in a per-block buffer; used when Numba is installed (no GPU
+#           needed)
+#   numba-parallel
+#           the same pass with the blocks run in parallel with prange
+#
+# numba-parallel is never chosen automatically: once Numba's default
+# (workqueue) threading layer has started its threads, a process forked
+# afterwards - a PSA or diagram worker pool - hangs at exit. Use it in
+# processes that do not fork, or with the tbb threading layer installed.
+#
+# All backends take the same uniform draws, so they agree exactly; verify()
+# checks that on a model, and the microsim benchmark runs it. Population(
+# backend=...) steps with these kernels.
+
+import numpy as np
+
+try:
+    import numba
+    from numba import prange
+except ImportError:
+    numba = None
+    prange = range
+
+
+BACKENDS = ('numpy', 'numba', 'numba-parallel')
+
+# People per parallel block of the numba kernel
+BLOCK = 4096
+
+
+def default_backend():
+    return 'numba' if numba is not None else 'numpy'
+
+
+def resolve(backend):
+    """The backend to use for backend ('auto' or one of BACKENDS)."""
+    if backend in (None, 'auto'):
+        return default_backend()
+    if backend not in BACKENDS:
+        raise ValueError('Unknown kernel backend: %s' % backend)
+    if backend.startswith('numba') and numba is None:
+        raise ValueError('The numba backend needs Numba installed')
+    return backend
+
+
+class Tables(object):
+
+    # A model's matrices and interactions packed into dense arrays for the
+    # kernels: every chain's matrix padded to the largest chain's size
+
+    def __init__(self, model, matrices):
+        self.sizes = np.array([len(chain) for chain in model.chains], dtype=np.int64)
+        width = max(list(self.sizes) + [1])
+        self.matrices = np.zeros((len(model.chains), width, width))
+        for c, matrix in enumerate(matrices):
+            size = self.sizes[c]
+            self.matrices[c, :size, :size] = matrix
+        # in_chain, in_state, chain, from_state, to_state of each interaction
+        self.interactions = np.array([[i.in_chain, i.in_state, i.chain, i.from_state, i.to_state]
+                                      for i in model.interactions], dtype=np.int64).reshape(-1, 5)
+        self.adjustments = np.array([i.adjustment for i in model.interactions], dtype=float)
+
+
+def step(backend, states, living, tables, u):
+    """Next states (people x chains) of the people in living.
+
+    states is the population's people x chains array, tables a Tables and
+    u uniform draws (chains x people).
+    """
+    following = np.empty((len(living), states.shape[1]), dtype=states.dtype)
+    kernel = {'numpy': _step_numpy, 'numba': _step_numba,
+              'numba-parallel': _step_numba_parallel}[resolve(backend)]
+    kernel(states, living, tables.matrices, tables.sizes, tables.interactions,
+           tables.adjustments, u, following)
+    return following
+
+
+def _step_numpy(states, living, matrices, sizes, interactions, adjustments, u, following):
+    current = states[living]
+    for c in range(states.shape[1]):
+        s = current[:, c]
+        if sizes[c] == 0:
+            following[:, c] = s
+            continue
+        rows = matrices[c][s, :sizes[c]]
+        for k in np.flatnonzero(interactions[:, 2] == c):
+            in_chain, in_state, _, f, t = interactions[k]
+            hit = np.flatnonzero((current[:, in_chain] == in_state) & (s == f))
+            old = rows[hit, t]
+            rows[hit, t] = old * adjustments[k]
+            rows[hit, f] -= rows[hit, t] - old
+        above = np.cumsum(rows, axis=1) > u[c][:, None]
+        following[:, c] = np.where(above.any(axis=1), above.argmax(axis=1), sizes[c] - 1)
+
+
+def _step_fused(states, living, matrices, sizes, interactions, adjustments, u, following):
+    # Compiled by Numba below; prange runs as a plain range unless compiled
+    # with parallel=True
+    n = living.shape[0]
+    n_chains = states.shape[1]
+    for b in prange((n + BLOCK - 1) // BLOCK):
+        row = np.empty(matrices.shape[2])
+        for i in range(b * BLOCK, min(n, (b + 1) * BLOCK)):
+            person = living[i]
+            for c in range(n_chains):
+                s = states[person, c]
+                size = sizes[c]
+                if size == 0:
+                    following[i, c] = s
+                    continue
+                for j in range(size):
+                    row[j] = matrices[c, s, j]
+                for k in range(interactions.shape[0]):
+                    if interactions[k, 2] == c and interactions[k, 3] == s and \
+                            states[person, interactions[k, 0]] == interactions[k, 1]:
+                        t = interactions[k, 4]
+                        old = row[t]
+                        row[t] = old * adjustments[k]
+                        row[s] -= row[t] - old
+                chosen = size - 1
+                total = 0.0
+                for j in range(size):
+                    total += row[j]
+                    if total > u[c, i]:
+                        chosen = j
+                        break
+                following[i, c] = chosen
+
+
+if numba is not None:
+    # Numba's on-disk cache does not tell the two compilations apart, so
+    # only the serial one is cached
+    _step_numba = numba.njit(cache=True)(_step_fused)
+    _step_numba_parallel = numba.njit(parallel=True)(_step_fused)
+else:
+
+    def _step_numba(*args):
+        raise ValueError('The numba backend needs Numba installed')
+
+    _step_numba_parallel = _step_numba
+
+
+def verify(model, n=100000, values=None, seed=0, backends=('numba',)):
+    """Number of people whose next states differ from the numpy backend's, per backend.
+
+    Everyone starts spread over every chain's states, so each row and
+    interaction is exercised; values defaults to the base case.
+    """
+    if values is None:
+        values = model.parameters.base()
+    tables = Tables(model, [m[0] for m in model.matrices(values)])
+    rng = np.random.RandomState(seed)
+    states = np.column_stack([rng.randint(0, max(size, 1), n) for size in tables.sizes]).astype(np.int16)
+    living = np.arange(n)
+    u = rng.random_sample((len(model.chains), n))
+    reference = step('numpy', states, living, tables, u)
+    return dict((backend, int((step(backend, states, living, tables, u) != reference).any(axis=1).sum()))
+                for backend in backends)
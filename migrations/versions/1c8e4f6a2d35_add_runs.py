@@ -0,0 +1,30 @@
+"""add runs
+
+Revision ID: 1c8e4f6a2d35
+Revises: 52d7e0a4c1b9
+Create Date: 2026-10-19 10:48:02.731640
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '1c8e4f6a2d35'
+down_revision = '52d7e0a4c1b9'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('runs',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('name', sa.String(length=64), nullable=True),
+    sa.Column('created', sa.DateTime(), nullable=True),
+    sa.Column('n_draws', sa.Integer(), nullable=True),
+    sa.Column('n_cycles', sa.Integer(), nullable=True),
+    sa.Column('results_path', sa.String(length=4000), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+
+
+def downgrade():
+    op.drop_table('runs')
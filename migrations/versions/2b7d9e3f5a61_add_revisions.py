@@ -0,0 +1,27 @@
+"""add revisions
+
+Revision ID: 2b7d9e3f5a61
+Revises: 1c8e4f6a2d35
+Create Date: 2026-10-19 14:21:37.402118
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '2b7d9e3f5a61'
+down_revision = '1c8e4f6a2d35'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    revisions = op.create_table('revisions',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('value', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.bulk_insert(revisions, [{'id': 1, 'value': 0}])
+
+
+def downgrade():
+    op.drop_table('revisions')
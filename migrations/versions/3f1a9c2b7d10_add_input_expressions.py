@@ -0,0 +1,26 @@
+"""add input and transition probability expressions
+
+Revision ID: 3f1a9c2b7d10
+Revises: 105c01a28e83
+Create Date: 2026-10-19 09:12:44.104311
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3f1a9c2b7d10'
+down_revision = '105c01a28e83'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('raw_inputs', sa.Column('expression', sa.String(length=4000), nullable=True))
+    op.add_column('transition_probabilities', sa.Column('Tp_expression', sa.String(length=4000), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('transition_probabilities') as batch_op:
+        batch_op.drop_column('Tp_expression')
+    with op.batch_alter_table('raw_inputs') as batch_op:
+        batch_op.drop_column('expression')
@@ -0,0 +1,49 @@
+"""add initialization probabilities
+
+Revision ID: 4d1f8a6c3e27
+Revises: 2b7d9e3f5a61
+Create Date: 2026-10-19 15:02:44.118305
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '4d1f8a6c3e27'
+down_revision = '2b7d9e3f5a61'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('tags',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('name', sa.String(length=64), nullable=True),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('name')
+    )
+    op.create_table('states_tags',
+    sa.Column('state_id', sa.Integer(), nullable=True),
+    sa.Column('tag_id', sa.Integer(), nullable=True),
+    sa.ForeignKeyConstraint(['state_id'], ['states.id'], ),
+    sa.ForeignKeyConstraint(['tag_id'], ['tags.id'], )
+    )
+    op.create_table('initialization_probabilities',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('State_id', sa.Integer(), nullable=True),
+    sa.Column('Probability', sa.Float(), nullable=True),
+    sa.ForeignKeyConstraint(['State_id'], ['states.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_table('initialization_probabilities_tags',
+    sa.Column('initialization_probability_id', sa.Integer(), nullable=True),
+    sa.Column('tag_id', sa.Integer(), nullable=True),
+    sa.ForeignKeyConstraint(['initialization_probability_id'], ['initialization_probabilities.id'], ),
+    sa.ForeignKeyConstraint(['tag_id'], ['tags.id'], )
+    )
+
+
+def downgrade():
+    op.drop_table('initialization_probabilities_tags')
+    op.drop_table('initialization_probabilities')
+    op.drop_table('states_tags')
+    op.drop_table('tags')
@@ -0,0 +1,40 @@
+"""add state costs, utilities and transition costs
+
+Revision ID: 52d7e0a4c1b9
+Revises: 3f1a9c2b7d10
+Create Date: 2026-10-19 10:03:21.552917
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '52d7e0a4c1b9'
+down_revision = '3f1a9c2b7d10'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    with op.batch_alter_table('states') as batch_op:
+        batch_op.add_column(sa.Column('cost_input_id', sa.Integer(), nullable=True))
+        batch_op.add_column(sa.Column('utility_input_id', sa.Integer(), nullable=True))
+        batch_op.add_column(sa.Column('disability_input_id', sa.Integer(), nullable=True))
+        batch_op.create_foreign_key('fk_states_cost_input', 'raw_inputs', ['cost_input_id'], ['id'])
+        batch_op.create_foreign_key('fk_states_utility_input', 'raw_inputs', ['utility_input_id'], ['id'])
+        batch_op.create_foreign_key('fk_states_disability_input', 'raw_inputs', ['disability_input_id'], ['id'])
+    with op.batch_alter_table('transition_probabilities') as batch_op:
+        batch_op.add_column(sa.Column('Cost_input_id', sa.Integer(), nullable=True))
+        batch_op.create_foreign_key('fk_transition_probabilities_cost_input', 'raw_inputs', ['Cost_input_id'], ['id'])
+
+
+def downgrade():
+    with op.batch_alter_table('transition_probabilities') as batch_op:
+        batch_op.drop_constraint('fk_transition_probabilities_cost_input', type_='foreignkey')
+        batch_op.drop_column('Cost_input_id')
+    with op.batch_alter_table('states') as batch_op:
+        batch_op.drop_constraint('fk_states_disability_input', type_='foreignkey')
+        batch_op.drop_constraint('fk_states_utility_input', type_='foreignkey')
+        batch_op.drop_constraint('fk_states_cost_input', type_='foreignkey')
+        batch_op.drop_column('disability_input_id')
+        batch_op.drop_column('utility_input_id')
+        batch_op.drop_column('cost_input_id')
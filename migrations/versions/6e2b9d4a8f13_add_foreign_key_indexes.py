@@ -0,0 +1,38 @@
+"""add foreign key indexes
+
+Revision ID: 6e2b9d4a8f13
+Revises: 4d1f8a6c3e27
+Create Date: 2026-10-19 17:41:09.530212
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '6e2b9d4a8f13'
+down_revision = '4d1f8a6c3e27'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# raw_inputs.slug is already indexed by its unique constraint
+INDEXES = [
+    ('states', ['chain_id', 'cost_input_id', 'utility_input_id', 'disability_input_id']),
+    ('transition_probabilities', ['From_state_id', 'To_state_id', 'Cost_input_id', 'Chain_id']),
+    ('interactions', ['In_state_id', 'From_state_id', 'To_state_id', 'Effected_chain_id']),
+    ('raw_inputs', ['reference_id']),
+    ('states_tags', ['state_id', 'tag_id']),
+    ('initialization_probabilities', ['State_id']),
+    ('initialization_probabilities_tags', ['initialization_probability_id', 'tag_id']),
+]
+
+
+def upgrade():
+    for table, columns in INDEXES:
+        for column in columns:
+            op.create_index(op.f('ix_%s_%s' % (table, column)), table, [column], unique=False)
+
+
+def downgrade():
+    for table, columns in reversed(INDEXES):
+        for column in reversed(columns):
+            op.drop_index(op.f('ix_%s_%s' % (table, column)), table_name=table)
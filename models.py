@@ -0,0 +1,372 @@
+# The model tables, without Flask.
+#
+# Simulation workers, the compiler and notebooks only need the tables, so
+# they import this module rather than app.py, which builds the web
+# application. Importing it loads SQLAlchemy and defines the classes; nothing
+# connects to the database until a query is made, and tables are only created
+# when asked (db.create_all(), or the migrations).
+#
+# db stands in for Flask-SQLAlchemy's object of the same name: it carries the
+# sqlalchemy column types and functions (db.Column, db.relationship, ...), the
+# declarative base (db.Model, with a Model.query property) and a scoped
+# session (db.session), so the models, app.py and Limsa.py read as they did.
+# The database is LIMSA_DATABASE_URI if set, else database/limsa.sqlite.
+#
+# The web app and the job workers share the SQLite file, so it is opened with
+# a profile for many concurrent readers and few writers:
+#
+#   - WAL journaling, so readers never block on a writer or each other, with
+#     synchronous=NORMAL (durable at checkpoints, safe in WAL mode)
+#   - a memory-mapped file and a 64MB page cache per connection
+#   - busy_timeout, so a writer waits for another process's write to finish
+#     instead of failing with "database is locked"
+#   - a pool of connections shared between threads
+#
+# Within a process, writes that may race (e.g. several threads recording
+# runs) go through db.write, which hands them to a single writer thread with
+# its own session, so they are made one at a time. See db_benchmark.py for
+# the throughput this gives.
+
+import os
+import threading
+from datetime import datetime
+
+try:
+	import queue
+except ImportError:
+	import Queue as queue
+
+import sqlalchemy
+import sqlalchemy.orm
+from sqlalchemy import event
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.pool import QueuePool
+
+basedir = os.path.abspath(os.path.dirname(__file__))
+
+DATABASE_URI = os.environ.get('LIMSA_DATABASE_URI') or \
+	'sqlite:///' + os.path.join(basedir, 'database/limsa.sqlite')
+
+SQLITE_PRAGMAS = [
+	('journal_mode', 'WAL'),
+	('synchronous', 'NORMAL'),
+	('mmap_size', 256 * 1024 * 1024),
+	# Negative sizes are in KiB
+	('cache_size', -64 * 1024),
+	('busy_timeout', 30000),
+]
+
+POOL_SIZE = 8
+POOL_OVERFLOW = 8
+
+
+class Database(object):
+
+	def __init__(self, uri=DATABASE_URI):
+		for module in (sqlalchemy, sqlalchemy.orm):
+			for name in module.__all__:
+				if not hasattr(Database, name):
+					setattr(self, name, getattr(module, name))
+		self.Session = sqlalchemy.orm.sessionmaker()
+		self.session = sqlalchemy.orm.scoped_session(self.Session)
+		self.Model = declarative_base()
+		self.Model.query = self.session.query_property()
+		self.configure(uri)
+
+	def configure(self, uri, tuned=True):
+		"""Use the database at uri; call before the first query.
+
+		create_engine does not connect, so this is cheap. tuned=False opens
+		an SQLite file with SQLAlchemy's defaults instead of the profile above.
+		"""
+		self.uri = uri
+		self.engine = create_engine(uri, tuned)
+		self.Session.configure(bind=self.engine)
+		self.writes = WriteQueue(self.Session)
+
+	def write(self, write, *args):
+		"""Run write(session, *args) on this process's writer thread and commit.
+
+		Returns write's result, which should not be an instance bound to the
+		writer's session (return ids rather than objects).
+		"""
+		return self.writes.submit(write, *args)
+
+	@property
+	def metadata(self):
+		return self.Model.metadata
+
+	def Table(self, name, *args, **kwargs):
+		# Association tables live in the models' metadata
+		return sqlalchemy.Table(name, self.metadata, *args, **kwargs)
+
+	def create_all(self):
+		self.metadata.create_all(bind=self.engine)
+
+	def drop_all(self):
+		self.metadata.drop_all(bind=self.engine)
+
+	def dispose(self):
+		"""Drop pooled connections, e.g. in a process forked from one that used them."""
+		self.session.remove()
+		self.engine.dispose()
+		self.writes = WriteQueue(self.Session)
+
+
+def create_engine(uri, tuned=True):
+	url = sqlalchemy.engine.url.make_url(uri)
+	if not tuned or url.drivername.split('+')[0] != 'sqlite' or url.database in (None, '', ':memory:'):
+		return sqlalchemy.create_engine(uri)
+	engine = sqlalchemy.create_engine(uri, poolclass=QueuePool, pool_size=POOL_SIZE,
+		max_overflow=POOL_OVERFLOW, connect_args={'check_same_thread': False, 'timeout': 30})
+	event.listen(engine, 'connect', set_pragmas)
+	return engine
+
+
+def set_pragmas(connection, record):
+	cursor = connection.cursor()
+	for name, value in SQLITE_PRAGMAS:
+		cursor.execute('PRAGMA %s = %s' % (name, value))
+	cursor.close()
+
+
+class WriteQueue(object):
+
+	def __init__(self, Session):
+		self.Session = Session
+		self.queue = queue.Queue()
+		self.thread = None
+		self.lock = threading.Lock()
+
+	def submit(self, write, *args):
+		if threading.current_thread() is self.thread:
+			raise RuntimeError('db.write called from inside a write')
+		self._start()
+		done, outcome = threading.Event(), {}
+		self.queue.put((write, args, done, outcome))
+		done.wait()
+		if 'error' in outcome:
+			raise outcome['error']
+		return outcome['result']
+
+	def _start(self):
+		with self.lock:
+			if self.thread is None or not self.thread.is_alive():
+				self.thread = threading.Thread(target=self._run, name='db-writer')
+				self.thread.daemon = True
+				self.thread.start()
+
+	def _run(self):
+		session = self.Session()
+		while True:
+			write, args, done, outcome = self.queue.get()
+			try:
+				outcome['result'] = write(session, *args)
+				session.commit()
+			except Exception as e:
+				session.rollback()
+				outcome['error'] = e
+			finally:
+				# Nothing is kept between writes
+				session.expunge_all()
+				done.set()
+
+
+db = Database()
+
+
+class Chain(db.Model):
+	__tablename__ = 'chains'
+	id = db.Column(db.Integer, primary_key=True)
+	name = db.Column(db.String(64), unique=True)
+	states = db.relationship('State', backref='chain')
+
+	def __repr__(self):
+		return self.name
+
+class State(db.Model):
+	__tablename__ = 'states'
+	id = db.Column(db.Integer, primary_key=True)
+	name = db.Column(db.String(64))
+	chain_id = db.Column(db.Integer,db.ForeignKey('chains.id'), index=True)
+	Chain = db.relationship("Chain", foreign_keys=[chain_id])
+
+	# Annual cost, utility and disability weight of time spent in this state
+	cost_input_id = db.Column(db.Integer,db.ForeignKey('raw_inputs.id'), index=True)
+	utility_input_id = db.Column(db.Integer,db.ForeignKey('raw_inputs.id'), index=True)
+	disability_input_id = db.Column(db.Integer,db.ForeignKey('raw_inputs.id'), index=True)
+	cost_input = db.relationship("Raw_input", foreign_keys=[cost_input_id])
+	utility_input = db.relationship("Raw_input", foreign_keys=[utility_input_id])
+	disability_input = db.relationship("Raw_input", foreign_keys=[disability_input_id])
+
+
+	# TODO: Add chain name to representation
+	def __repr__(self):
+		return self.name
+
+class Transition_probability(db.Model):
+	__tablename__ = 'transition_probabilities'
+	id = db.Column(db.Integer, primary_key=True)
+
+	From_state_id = db.Column(db.Integer,db.ForeignKey('states.id'), index=True)
+	To_state_id = db.Column(db.Integer,db.ForeignKey('states.id'), index=True)
+
+	From_state = db.relationship("State", foreign_keys=[From_state_id])
+	To_state = db.relationship("State", foreign_keys=[To_state_id])
+
+	Tp_base = db.Column(db.Float)
+	# Optional expression in Raw_input slugs that Tp_base was computed from
+	Tp_expression = db.Column(db.String(4000))
+
+	Is_dynamic = db.Column(db.Boolean)
+
+	# One-off cost paid by everyone making this transition
+	Cost_input_id = db.Column(db.Integer,db.ForeignKey('raw_inputs.id'), index=True)
+	Cost_input = db.relationship("Raw_input", foreign_keys=[Cost_input_id])
+
+	Chain_id = db.Column(db.Integer,db.ForeignKey('chains.id'), index=True)
+	Chain = db.relationship("Chain", foreign_keys=[Chain_id])
+
+	def __repr__(self):
+		return self.From_state.name + " => " + self.To_state.name
+
+class Interaction(db.Model):
+	__tablename__ = 'interactions'
+	id = db.Column(db.Integer, primary_key=True)
+
+	In_state_id = db.Column(db.Integer,db.ForeignKey('states.id'), index=True)
+	From_state_id = db.Column(db.Integer,db.ForeignKey('states.id'), index=True)
+	To_state_id = db.Column(db.Integer,db.ForeignKey('states.id'), index=True)
+
+	In_state = db.relationship("State", foreign_keys=[In_state_id])
+	From_state = db.relationship("State", foreign_keys=[From_state_id])
+	To_state = db.relationship("State", foreign_keys=[To_state_id])
+
+	Adjustment = db.Column(db.Float)
+
+	Effected_chain_id = db.Column(db.Integer,db.ForeignKey('chains.id'), index=True)
+
+	def __repr__(self):
+		return self.In_state.name + " affects " + self.From_state.name + " => " + self.To_state.name
+
+# type TransitionProbability struct {
+# 	Id      int
+# 	From_id int
+# 	To_id   int
+# 	Tp_base float64
+# 	PSA_id  int
+# }
+
+# type Interaction struct {
+# 	Id                int
+# 	In_state_id       int
+# 	From_state_id     int
+# 	To_state_id       int
+# 	Adjustment        float64
+# 	Effected_model_id int
+# 	PSA_id            int
+# }
+
+
+
+class Raw_input(db.Model):
+	__tablename__ = 'raw_inputs'
+	id = db.Column(db.Integer, primary_key=True)
+	name = db.Column(db.String(64), unique=True)
+	slug = db.Column(db.String(64), unique=True)
+	value = db.Column(db.Float)
+	low = db.Column(db.Float)
+	high = db.Column(db.Float)
+	# Derived inputs are computed from other inputs' slugs
+	expression = db.Column(db.String(4000))
+	reference_id = db.Column(db.Integer,db.ForeignKey('references.id'), index=True)
+
+	def __repr__(self):
+		return self.name
+
+class Reference(db.Model):
+	__tablename__ = 'references'
+	id = db.Column(db.Integer, primary_key=True)
+	name = db.Column(db.String(4000))
+	bibtex = db.Column(db.String(2000))
+	raw_data = db.relationship('Raw_input', backref='reference')
+
+	def __repr__(self):
+		return self.name
+
+# Tags carried by people in a state (ie, HIV+), for initialization
+states_tags = db.Table('states_tags',
+	db.Column('state_id', db.Integer, db.ForeignKey('states.id'), index=True),
+	db.Column('tag_id', db.Integer, db.ForeignKey('tags.id'), index=True)
+)
+
+class Tag(db.Model):
+	__tablename__ = 'tags'
+	id = db.Column(db.Integer, primary_key=True)
+	name = db.Column(db.String(64), unique=True)
+	states = db.relationship('State', secondary=states_tags, backref='tags')
+
+	def __repr__(self):
+		return self.name
+
+initialization_probabilities_tags = db.Table('initialization_probabilities_tags',
+	db.Column('initialization_probability_id', db.Integer, db.ForeignKey('initialization_probabilities.id'), index=True),
+	db.Column('tag_id', db.Integer, db.ForeignKey('tags.id'), index=True)
+)
+
+class Initialization_probability(db.Model):
+	# Probability of starting in State for people with all of Tags, see initialize.py
+	__tablename__ = 'initialization_probabilities'
+	id = db.Column(db.Integer, primary_key=True)
+
+	State_id = db.Column(db.Integer,db.ForeignKey('states.id'), index=True)
+	State = db.relationship("State", foreign_keys=[State_id])
+
+	Probability = db.Column(db.Float)
+	Tags = db.relationship('Tag', secondary=initialization_probabilities_tags)
+
+	def __repr__(self):
+		return self.State.name + " | " + ", ".join(tag.name for tag in self.Tags)
+
+class Run(db.Model):
+	__tablename__ = 'runs'
+	id = db.Column(db.Integer, primary_key=True)
+	name = db.Column(db.String(64))
+	created = db.Column(db.DateTime, default=datetime.utcnow)
+	n_draws = db.Column(db.Integer)
+	n_cycles = db.Column(db.Integer)
+	# Traces are stored outside the database, see results.py
+	results_path = db.Column(db.String(4000))
+
+	def __repr__(self):
+		return "Run %s" % self.id
+
+class Revision(db.Model):
+	# Single row counting changes to the model tables; bumped on every flush
+	# that touches them, and used to version the API's responses
+	__tablename__ = 'revisions'
+	id = db.Column(db.Integer, primary_key=True)
+	value = db.Column(db.Integer, nullable=False, default=0)
+
+	def __repr__(self):
+		return "Revision %s" % self.value
+
+
+from sqlalchemy.orm import Session
+
+MODEL_CLASSES = (Chain, State, Transition_probability, Interaction, Raw_input, Reference, Tag,
+	Initialization_probability)
+
+@event.listens_for(Session, 'before_flush')
+def bump_revision(session, flush_context, instances):
+	changed = session.new | session.dirty | session.deleted
+	if not any(isinstance(instance, MODEL_CLASSES) for instance in changed):
+		return
+	revisions = Revision.__table__
+	result = session.execute(revisions.update().values(value=revisions.c.value + 1))
+	if result.rowcount == 0:
+		session.execute(revisions.insert().values(id=1, value=1))
+
+def model_revision():
+	revision = db.session.query(Revision.value).first()
+	return revision[0] if revision is not None else 0
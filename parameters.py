@@ -0,0 +1,162 @@
+from __future__ import division
+
+# Parameter vectors built from the Raw_inputs table.
+#
+# Every Raw_input with a slug becomes one column of a parameter matrix, with
+# one row per scenario (a sensitivity perturbation, a PSA draw, ...). Inputs
+# with an expression are derived from other inputs, e.g.
+# overall_percent_active_treated = percent_diagnosed_treated * case_detection_rate,
+# and are recomputed column-wise, in dependency order, whenever a matrix is
+# evaluated. Transition probabilities use the same expression language.
+
+from collections import OrderedDict
+
+import numpy as np
+
+
+# In order to convert yearly rates to quarterly rates, we use the following function
+# TODO this is not really true - to discuss
+def convert_year_to_qt(value):
+    return value/4
+
+
+# Functions available to Raw_input and transition probability expressions
+FUNCTIONS = {
+    'convert_year_to_qt': convert_year_to_qt,
+    'exp': np.exp,
+    'log': np.log,
+    'minimum': np.minimum,
+    'maximum': np.maximum,
+}
+
+
+def compile_expression(expression):
+    """Compile an expression and return (code, names of the inputs it uses)."""
+    code = compile(expression, '<expression>', 'eval')
+    names = [name for name in code.co_names if name not in FUNCTIONS]
+    return code, names
+
+
+def evaluate_expression(code, namespace, n):
+    """Evaluate compiled code against columns in namespace; returns a length-n array."""
+    result = eval(code, {'__builtins__': {}}, namespace)
+    return np.ones(n) * result
+
+
+class Parameters(object):
+
+    def __init__(self, slugs, names, value, low, high, expressions=None):
+        self.slugs = list(slugs)
+        self.names = list(names)
+        self.value = np.asarray(value, dtype=float)
+        self.low = np.asarray(low, dtype=float)
+        self.high = np.asarray(high, dtype=float)
+        self.index = dict((slug, i) for i, slug in enumerate(self.slugs))
+
+        self.sources = OrderedDict(expressions or {})
+        self._compile()
+        self.order = self._topological_order()
+
+        # The stored value of a derived input is whatever its expression gives
+        self.value = self.evaluate(self.value[None, :])[0]
+
+    def _compile(self):
+        self.expressions = OrderedDict()
+        self.parents = {}
+        for slug, expression in self.sources.items():
+            code, names = compile_expression(expression)
+            unknown = [name for name in names if name not in self.index]
+            if unknown:
+                raise KeyError('Expression for %s uses unknown inputs: %s' % (slug, ', '.join(unknown)))
+            self.expressions[slug] = code
+            self.parents[slug] = names
+
+    # Code objects cannot be pickled, so expressions are recompiled when a
+    # pickled copy is loaded (e.g. in a worker process)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['expressions']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._compile()
+
+    @classmethod
+    def from_raw_inputs(cls, raw_inputs):
+        slugs, names, value, low, high, expressions = [], [], [], [], [], {}
+        for raw_input in raw_inputs:
+            if raw_input.slug is None or (raw_input.value is None and not raw_input.expression):
+                continue
+            base = raw_input.value if raw_input.value is not None else np.nan
+            slugs.append(raw_input.slug)
+            names.append(raw_input.name)
+            value.append(base)
+            low.append(raw_input.low if raw_input.low is not None else base)
+            high.append(raw_input.high if raw_input.high is not None else base)
+            if raw_input.expression:
+                expressions[raw_input.slug] = raw_input.expression
+        return cls(slugs, names, value, low, high, expressions)
+
+    def __len__(self):
+        return len(self.slugs)
+
+    def is_derived(self, slug):
+        return slug in self.expressions
+
+    def independent(self):
+        """Slugs that are not derived from other inputs."""
+        return [slug for slug in self.slugs if slug not in self.expressions]
+
+    def varying(self):
+        """Independent slugs whose low and high differ."""
+        return [slug for slug in self.independent()
+                if self.low[self.index[slug]] != self.high[self.index[slug]]]
+
+    def dependents(self, slug):
+        """All derived inputs that change when slug changes."""
+        found = []
+        for derived in self.order:
+            if any(parent == slug or parent in found for parent in self.parents[derived]):
+                found.append(derived)
+        return found
+
+    def base(self, n=1):
+        """n copies of the base-case parameter vector."""
+        return np.tile(self.value, (n, 1))
+
+    def namespace(self, matrix):
+        """Columns of matrix keyed by slug, for evaluating expressions."""
+        namespace = dict(FUNCTIONS)
+        for slug, i in self.index.items():
+            namespace[slug] = matrix[:, i]
+        return namespace
+
+    def evaluate(self, matrix):
+        """Recompute the derived columns of matrix (scenarios x parameters) in place."""
+        matrix = np.asarray(matrix, dtype=float)
+        namespace = self.namespace(matrix)
+        for slug in self.order:
+            i = self.index[slug]
+            matrix[:, i] = evaluate_expression(self.expressions[slug], namespace, matrix.shape[0])
+        return matrix
+
+    def _topological_order(self):
+        order, state = [], {}
+
+        def visit(slug, path):
+            if state.get(slug) == 'done':
+                return
+            if state.get(slug) == 'visiting':
+                raise ValueError('Raw_input expressions are circular: %s' % ' -> '.join(path + [slug]))
+            state[slug] = 'visiting'
+            for parent in self.parents.get(slug, ()):
+                visit(parent, path + [slug])
+            state[slug] = 'done'
+            if slug in self.expressions:
+                order.append(slug)
+
+        for slug in self.expressions:
+            visit(slug, [])
+        return order
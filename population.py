@@ -0,0 +1,222 @@
+from __future__ import division
+
+# Individual-level population for microsimulation.
+#
+# People are rows of fixed-capacity arrays: their state index in every chain
+# (people x chains), age in years, sex and whether the slot is in use.
+# Slots freed by deaths go on a free-list (a stack of slot indices) and are
+# handed to new entrants, so the arrays are allocated once and never
+# reallocated or compacted while a run is going; only when more people are
+# alive than the capacity allows do they grow, by doubling.
+#
+# step() moves everyone alive through one cycle of the compiled model's
+# matrices. Per chain, people are grouped by current state and each group
+# draws its next states from that state's row of cumulative probabilities.
+# With a kernel backend (see kernels.py) the model's interactions are also
+# applied to each person's rows, and lookup, adjustment and sampling run
+# fused in one pass, compiled with Numba when it is installed.
+#
+# Transmission (see transmission.py) reaches a population through its
+# dynamics: at the start of every step each one gives the infection
+# probabilities of the people it applies to, from the running counts at
+# that moment, and those people draw from their own adjusted rows.
+#
+# The number of living people in every state of every chain is kept as a
+# running count, updated from the people who enter, leave or change state,
+# so transmission and reporting can read it without scanning everyone.
+#
+# State codes are stored in the smallest integer type that holds every
+# chain's state indices (int8 for chains of up to 127 states) and slot
+# indices in int32, which is what lets 10^7 people fit in a few hundred MB.
+
+import numpy as np
+
+import kernels
+from profiling import NULL_PROFILER
+
+
+MALE, FEMALE = 0, 1
+
+
+def state_dtype(model):
+    """Smallest integer type holding the state indices of every chain."""
+    largest = max([len(chain) for chain in model.chains] + [1])
+    for dtype in (np.int8, np.int16, np.int32):
+        if largest - 1 <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    return np.dtype(np.int64)
+
+
+def index_dtype(capacity):
+    return np.dtype(np.int32 if capacity <= np.iinfo(np.int32).max else np.int64)
+
+
+def sample_changed(row, s, changes, members, u):
+    """Next states of members in state s, with row's transitions changed per person.
+
+    changes are (to_state, probability) pairs; probability is a number or
+    an array over everyone stepped. The change is balanced on the diagonal.
+    """
+    rows = np.tile(row, (len(members), 1))
+    for to, probability in changes:
+        probability = probability[members] if np.ndim(probability) else probability
+        old = rows[:, to].copy()
+        rows[:, to] = probability
+        rows[:, s] += old - probability
+    above = np.cumsum(rows, axis=1) > u[:, None]
+    return np.where(above.any(axis=1), above.argmax(axis=1), len(row) - 1)
+
+
+class Population(object):
+
+    def __init__(self, model, capacity, seed=0, dtype=None, backend=None, dynamics=()):
+        self.model = model
+        # Objects with population_transitions(population, living), such as
+        # HIVTransmission and TBTransmission prepared with one scenario's
+        # values; only the grouped step applies them
+        self.dynamics = list(dynamics)
+        # None for the grouped NumPy step without interactions, or a kernel
+        # backend: 'auto' or one of kernels.BACKENDS
+        self.backend = None if backend is None else kernels.resolve(backend)
+        self.rng = np.random.RandomState(seed)
+        if dtype is None:
+            dtype = state_dtype(model)
+        self.states = np.zeros((capacity, len(model.chains)), dtype=dtype)
+        self.age = np.zeros(capacity, dtype=np.float32)
+        self.sex = np.zeros(capacity, dtype=np.int8)
+        self.alive = np.zeros(capacity, dtype=bool)
+        # Free slots; the next one handed out is free[n_free - 1]
+        self.free = np.arange(capacity, dtype=index_dtype(capacity))[::-1].copy()
+        self.n_free = capacity
+        # Living people in each state, per chain
+        self.counts = [np.zeros(len(chain), dtype=np.int64) for chain in model.chains]
+        # Times step() and Demographics.cycle(), see profiling.py
+        self.profiler = NULL_PROFILER
+
+    @property
+    def capacity(self):
+        return self.alive.shape[0]
+
+    @property
+    def size(self):
+        return self.capacity - self.n_free
+
+    def add(self, states, age, sex):
+        """Place new people in free slots; returns their slot indices."""
+        states = np.atleast_2d(states)
+        n = states.shape[0]
+        if n > self.n_free:
+            self._grow(self.size + n)
+        slots = self.free[self.n_free - n:self.n_free][::-1].copy()
+        self.n_free -= n
+        self.states[slots] = states
+        self.age[slots] = age
+        self.sex[slots] = sex
+        self.alive[slots] = True
+        self._count(states, 1)
+        return slots
+
+    def remove(self, slots):
+        """Free the slots of people who have died or left."""
+        slots = np.asarray(slots)
+        slots = slots[self.alive[slots]]
+        self._count(self.states[slots], -1)
+        self.alive[slots] = False
+        self.free[self.n_free:self.n_free + len(slots)] = slots
+        self.n_free += len(slots)
+        return slots
+
+    def assign(self, slots, states):
+        """Set the states (slots x chains) of living people."""
+        self._count(self.states[slots], -1)
+        self.states[slots] = states
+        self._count(self.states[slots], 1)
+
+    def living(self):
+        return np.flatnonzero(self.alive)
+
+    def step(self, matrices, living=None):
+        """One cycle of transitions for everyone alive.
+
+        matrices is a states x states matrix per chain, for example one
+        scenario of CompiledModel.matrices.
+        """
+        profiler = self.profiler
+        t = profiler.start()
+        if living is None:
+            living = self.living()
+        if self.backend is not None:
+            if self.dynamics:
+                raise ValueError('Population dynamics need the grouped step (backend=None)')
+            return self._step_kernel(matrices, living, t)
+        # Everyone's infection probabilities, from the counts at the start of the cycle
+        changes = {}
+        for dynamic in self.dynamics:
+            for c, f, to, probability in dynamic.population_transitions(self, living):
+                changes.setdefault((c, f), []).append((to, probability))
+        if self.dynamics:
+            t = profiler.lap('population/dynamics', t)
+        for c, matrix in enumerate(matrices):
+            current = self.states[living, c]
+            cdf = np.cumsum(matrix, axis=1)
+            last = matrix.shape[0] - 1
+            following = current.copy()
+            u = self.rng.random_sample(len(living))
+            t = profiler.lap('population/draws', t)
+            if not len(matrix):
+                # A chain without states; its draws are still taken, so the
+                # kernels see the same ones
+                continue
+            for s in np.flatnonzero(np.bincount(current, minlength=matrix.shape[0])):
+                members = np.flatnonzero(current == s)
+                if (c, s) in changes:
+                    following[members] = sample_changed(matrix[s], s, changes[(c, s)], members, u[members])
+                else:
+                    following[members] = np.minimum(np.searchsorted(cdf[s], u[members], side='right'), last)
+            self.states[living, c] = following
+            t = profiler.lap('population/transitions', t)
+            moved = following != current
+            size = len(self.counts[c])
+            self.counts[c] += np.bincount(following[moved], minlength=size) - \
+                np.bincount(current[moved], minlength=size)
+            t = profiler.lap('population/counts', t)
+        profiler.count('person_cycles', len(living))
+
+    def _step_kernel(self, matrices, living, t):
+        profiler = self.profiler
+        tables = kernels.Tables(self.model, matrices)
+        # Drawn in the same order as the grouped step's draws
+        u = self.rng.random_sample((len(matrices), len(living)))
+        t = profiler.lap('population/draws', t)
+        following = kernels.step(self.backend, self.states, living, tables, u)
+        t = profiler.lap('population/transitions', t)
+        self._count(self.states[living], -1)
+        self.states[living] = following
+        self._count(following, 1)
+        profiler.lap('population/counts', t)
+        profiler.count('person_cycles', len(living))
+
+    def occupancy(self):
+        """Share of the living population in each state of every chain."""
+        return [counts / max(self.size, 1) for counts in self.counts]
+
+    def _count(self, states, sign):
+        for c, counts in enumerate(self.counts):
+            # Chains without states have nothing to count (their column holds 0)
+            if len(counts):
+                counts += sign * np.bincount(states[:, c], minlength=len(counts))
+
+    def _grow(self, needed):
+        capacity = self.capacity
+        new = max(needed, 2 * capacity)
+        extra = new - capacity
+        self.states = np.concatenate([self.states, np.zeros((extra, self.states.shape[1]), self.states.dtype)])
+        self.age = np.concatenate([self.age, np.zeros(extra, self.age.dtype)])
+        self.sex = np.concatenate([self.sex, np.zeros(extra, self.sex.dtype)])
+        self.alive = np.concatenate([self.alive, np.zeros(extra, bool)])
+        # New slots go under the existing free ones, lowest handed out first
+        free = np.empty(new, dtype=index_dtype(new))
+        free[:extra] = np.arange(capacity, new)[::-1]
+        free[extra:extra + self.n_free] = self.free[:self.n_free]
+        self.free = free
+        self.n_free += extra
@@ -0,0 +1,229 @@
+from __future__ import division
+
+# Timers and counters for the phases of a run.
+#
+# The engine (and a microsimulated Population and its Demographics) time
+# each phase of a cycle through a profiler:
+#
+#     t = profiler.start()
+#     ...                          # interactions
+#     t = profiler.lap('interactions', t)
+#
+# lap() adds the time since t to the named phase and returns the current
+# time, so consecutive phases cost one clock read each. NULL_PROFILER, the
+# default, does nothing and never reads the clock, so an unprofiled run pays
+# one method call per phase per cycle. count() keeps named counters (cycles,
+# people stepped, ...).
+#
+# A Profiler can also
+#
+#   - sample the stack of the thread that started it every sample_interval
+#     seconds from a background thread, and report the functions seen most
+#     often (a cheap sampling profiler that needs no rerun under cProfile)
+#   - trace allocations with tracemalloc (Python 3), reporting the peak and
+#     the lines that allocated most
+#
+# report() gives time per phase, counters, cycles per second and the samples
+# and allocations as a JSON-serializable dict; write() saves it as
+# profile.json, next to a run's results or a job's checkpoint (see jobs.py).
+#
+# Profilers are merged like reducers, so the phases timed in PSA worker
+# processes add up in the parent.
+
+import json
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+PROFILE_FILE = 'profile.json'
+
+
+class NullProfiler(object):
+
+    enabled = False
+
+    def start(self):
+        return 0.0
+
+    def lap(self, name, since):
+        return since
+
+    def count(self, name, n=1):
+        pass
+
+    def empty(self):
+        return self
+
+    def merge(self, other):
+        pass
+
+
+NULL_PROFILER = NullProfiler()
+
+
+class Profiler(object):
+
+    enabled = True
+
+    def __init__(self, sample_interval=None, allocations=False, clock=time.time):
+        self.sample_interval = sample_interval
+        self.allocations = allocations and tracemalloc is not None
+        self.clock = clock
+        self.times = OrderedDict()
+        self.calls = {}
+        self.counters = OrderedDict()
+        self.samples = {}
+        self.wall = 0.0
+        self._began = None
+        self._sampler = None
+        self._stopping = None
+        self._snapshot = None
+        self._peak = 0
+
+    # Nothing to do with the clock or a running sampler survives pickling;
+    # a profiler sent to a worker process arrives with its settings only
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for name in ('_began', '_sampler', '_stopping', '_snapshot'):
+            state[name] = None
+        return state
+
+    def empty(self):
+        return Profiler(self.sample_interval, self.allocations, self.clock)
+
+    #### Timing
+
+    def start(self):
+        return self.clock()
+
+    def lap(self, name, since):
+        now = self.clock()
+        self.times[name] = self.times.get(name, 0.0) + now - since
+        self.calls[name] = self.calls.get(name, 0) + 1
+        return now
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def merge(self, other):
+        for name, seconds in other.times.items():
+            self.times[name] = self.times.get(name, 0.0) + seconds
+            self.calls[name] = self.calls.get(name, 0) + other.calls.get(name, 0)
+        for name, n in other.counters.items():
+            self.count(name, n)
+        for key, n in other.samples.items():
+            self.samples[key] = self.samples.get(key, 0) + n
+        self._peak = max(self._peak, other._peak)
+
+    #### Whole runs
+
+    def begin(self):
+        """Start the wall clock, the sampler and allocation tracing."""
+        self._began = time.time()
+        if self.sample_interval:
+            self._stopping = threading.Event()
+            target = threading.current_thread().ident
+            self._sampler = threading.Thread(target=self._sample, args=(target,), name='profiler')
+            self._sampler.daemon = True
+            self._sampler.start()
+        if self.allocations:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(10)
+            tracemalloc.clear_traces()
+        return self
+
+    def end(self):
+        if self._began is None:
+            return self
+        self.wall += time.time() - self._began
+        self._began = None
+        if self._sampler is not None:
+            self._stopping.set()
+            self._sampler.join()
+            self._sampler = None
+        if self.allocations and tracemalloc.is_tracing():
+            self._peak = max(self._peak, tracemalloc.get_traced_memory()[1])
+            self._snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+        return self
+
+    def __enter__(self):
+        return self.begin()
+
+    def __exit__(self, *exc):
+        self.end()
+
+    def _sample(self, thread_id):
+        while not self._stopping.wait(self.sample_interval):
+            frame = sys._current_frames().get(thread_id)
+            if frame is None:
+                continue
+            # The innermost frames; numpy's C functions have none, so time
+            # in them shows as the line that called them
+            stack = []
+            while frame is not None and len(stack) < 3:
+                code = frame.f_code
+                stack.append('%s:%d %s' % (os.path.basename(code.co_filename), frame.f_lineno, code.co_name))
+                frame = frame.f_back
+            key = ' < '.join(stack)
+            self.samples[key] = self.samples.get(key, 0) + 1
+
+    #### Reports
+
+    def report(self, top=20):
+        total = sum(self.times.values())
+        phases = OrderedDict()
+        for name, seconds in sorted(self.times.items(), key=lambda item: -item[1]):
+            phases[name] = {'seconds': seconds, 'calls': self.calls.get(name, 0),
+                            'share': seconds / total if total else 0.0}
+        report = OrderedDict([('wall_seconds', self.wall), ('phase_seconds', total),
+                              ('phases', phases), ('counters', OrderedDict(self.counters))])
+        cycles = self.counters.get('cycles')
+        if cycles and self.wall:
+            report['cycles_per_second'] = cycles / self.wall
+        if self.samples:
+            n = sum(self.samples.values())
+            report['samples'] = [{'stack': key, 'samples': count, 'share': count / n}
+                                 for key, count in sorted(self.samples.items(), key=lambda item: -item[1])[:top]]
+        if self.allocations:
+            report['allocations'] = OrderedDict([('peak_bytes', self._peak)])
+            if self._snapshot is not None:
+                report['allocations']['top'] = [
+                    {'line': str(stat.traceback[0]), 'bytes': stat.size, 'count': stat.count}
+                    for stat in self._snapshot.statistics('lineno')[:top]]
+        return report
+
+    def summary(self):
+        """Seconds per phase and cycles per second, for a job's result."""
+        report = self.report()
+        return OrderedDict([('wall_seconds', report['wall_seconds']),
+                            ('cycles_per_second', report.get('cycles_per_second')),
+                            ('phases', OrderedDict((name, phase['seconds'])
+                                                   for name, phase in report['phases'].items()))])
+
+    def write(self, directory):
+        """Save the report as profile.json in directory; returns its path."""
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        path = os.path.join(directory, PROFILE_FILE)
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+        return path
+
+
+def read(directory):
+    """The report saved by Profiler.write in directory, or None."""
+    path = os.path.join(directory, PROFILE_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
@@ -0,0 +1,168 @@
+from __future__ import division
+
+# Probabilistic sensitivity analysis.
+#
+# Draws for every independent Raw_input are sampled up front from a
+# distribution between its low and high (derived inputs are recomputed from
+# each draw), so results do not depend on how the draws are later split
+# between batches or worker processes. Draws are then run through the
+# engine a batch at a time and folded into reducers as each batch finishes;
+# with several workers every batch comes back as partial reducers that are
+# merged in the parent, so memory stays constant and convergence can be
+# watched through the progress callback while the run is going.
+#
+# Every draw is validated strictly (see validate.py) before anything is
+# run: a model with transitions left out or inputs outside their range is
+# refused, not just warned about.
+#
+# With a Checkpoint the run saves its progress periodically (see
+# checkpoint.py); restore() picks it up again after a crash or preemption.
+
+import multiprocessing
+
+import numpy as np
+
+import checkpoint as checkpoints
+import validate
+
+
+def sample(parameters, n_draws, seed=0, distribution='pert'):
+    """n_draws x parameters matrix of PSA draws.
+
+    distribution is 'pert' (beta-PERT with its mode at the base value),
+    'triangular' or 'uniform' between each input's low and high.
+    """
+    rng = np.random.RandomState(seed)
+    draws = parameters.base(n_draws)
+    for slug in parameters.varying():
+        i = parameters.index[slug]
+        low, high = min(parameters.low[i], parameters.high[i]), max(parameters.low[i], parameters.high[i])
+        # Unchecked PSAs may have base values outside their range; use the
+        # nearest bound as the mode
+        mode = min(max(parameters.value[i], low), high)
+        if distribution == 'uniform':
+            draws[:, i] = rng.uniform(low, high, n_draws)
+        elif distribution == 'triangular':
+            draws[:, i] = rng.triangular(low, mode, high, n_draws)
+        elif distribution == 'pert':
+            alpha = 1.0 + 4.0 * (mode - low) / (high - low)
+            beta = 1.0 + 4.0 * (high - mode) / (high - low)
+            draws[:, i] = low + (high - low) * rng.beta(alpha, beta, n_draws)
+        else:
+            raise ValueError('Unknown PSA distribution: %s' % distribution)
+    return parameters.evaluate(draws)
+
+
+class PSA(object):
+
+    def __init__(self, engine, reducers, n_draws, seed=0, distribution='pert', progress=None,
+                 check=True):
+        self.engine = engine
+        self.reducers = list(reducers)
+        self.n_draws = n_draws
+        self.seed = seed
+        # progress(draws finished, reducers) is called after every batch
+        self.progress = progress
+        self.distribution = distribution
+        self.draws = sample(engine.model.parameters, n_draws, seed, distribution)
+        if check:
+            # Refuse draws that give impossible transition matrices before
+            # spending any time on them
+            validate.check(engine.model, self.draws, strict=True)
+        # First draw not yet folded into the reducers, and the saved state of
+        # a partly run batch to continue from
+        self.done = 0
+        self.pending = None
+
+    def restore(self, path):
+        """Continue from the checkpoint at path on the next run()."""
+        arrays, meta = checkpoints.load(path)
+        saved = meta['psa']
+        if (saved['n_draws'], saved['seed'], saved['distribution']) != \
+                (self.n_draws, self.seed, self.distribution):
+            raise ValueError('Checkpoint at %s is for a different PSA' % path)
+        checkpoints.set_rng_state(self.engine.rng, arrays['rng/keys'], meta['rng'])
+        self.done = saved['done']
+        self.pending = checkpoints.batch_state(arrays, meta)
+
+    def batches(self):
+        size = self.engine.batch_size
+        return [(start, min(start + size, self.n_draws))
+                for start in range(0, self.n_draws, size)]
+
+    def run(self, n_workers=1, observers=(), checkpoint=None):
+        """Run every draw and return the merged reducers.
+
+        observers are extra engine observers (e.g. a TraceWriter); they are
+        only supported when running in this process. checkpoint, a
+        checkpoint.Checkpoint, saves progress as the run goes.
+        """
+        observers = list(self.reducers) + list(observers)
+        batches = [(start, stop) for start, stop in self.batches() if start >= self.done]
+        if n_workers != 1 and len(observers) > len(self.reducers):
+            raise ValueError('Extra observers can only be used with n_workers=1')
+
+        # A batch interrupted part way through is finished here first
+        if self.pending is not None and (n_workers == 1 or self.pending['cycle'] > 0):
+            start, stop = batches.pop(0)
+            self._run_batch(start, stop, observers, checkpoint)
+        elif self.pending is not None:
+            for reducer, state in zip(self.reducers, self.pending['observers']):
+                reducer.restore(self.engine, None, state)
+        self.pending = None
+
+        if n_workers == 1:
+            for start, stop in batches:
+                self._run_batch(start, stop, observers, checkpoint)
+            return self.reducers
+
+        pool = multiprocessing.Pool(n_workers)
+        try:
+            tasks = [(self.engine, [reducer.empty() for reducer in self.reducers],
+                      self.draws[start:stop]) for start, stop in batches]
+            # Partial results are merged in batch order, so the merged
+            # statistics do not depend on which worker finishes first
+            for (start, stop), (n, partial, profiler) in zip(batches, pool.imap(_run_batch, tasks)):
+                for reducer, other in zip(self.reducers, partial):
+                    reducer.merge(other)
+                self.engine.profiler.merge(profiler)
+                self.done = stop
+                self._report(stop)
+                if checkpoint is not None and stop < self.n_draws and checkpoint.due(0):
+                    self._save(checkpoint, stop, observers)
+        finally:
+            pool.close()
+            pool.join()
+        return self.reducers
+
+    def _run_batch(self, start, stop, observers, checkpoint):
+        if checkpoint is not None:
+            checkpoint.meta['psa'] = self._meta(start)
+        self.engine.run_batch(self.draws[start:stop], observers,
+                              resume=self.pending, checkpoint=checkpoint)
+        self.pending = None
+        self.done = stop
+        self._report(stop)
+
+    def _save(self, checkpoint, start, observers):
+        # A batch boundary, saved as cycle 0 of the next batch
+        values = self.draws[start:start + self.engine.batch_size]
+        checkpoint.meta['psa'] = self._meta(start)
+        checkpoint.save_batch(self.engine, values, 0,
+                              self.engine.initial_occupancy(values.shape[0]), observers)
+
+    def _meta(self, start):
+        return {'n_draws': self.n_draws, 'seed': self.seed,
+                'distribution': self.distribution, 'done': start}
+
+    def _report(self, done):
+        if self.progress is not None:
+            self.progress(done, self.reducers)
+
+
+def _run_batch(task):
+    engine, reducers, draws = task
+    # Only this batch's phases go back, to be merged into the parent's
+    engine.profiler = engine.profiler.empty()
+    engine.run_batch(draws, reducers)
+    return draws.shape[0], reducers, engine.profiler
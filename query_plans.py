@@ -0,0 +1,152 @@
+from __future__ import division
+
+# Query plan checks for the model database.
+#
+#     python query_plans.py [--chains 300] [--states 10] [--database path]
+#
+# Runs EXPLAIN QUERY PLAN on the queries the compiler, the API, the
+# initializer and the admin make, against a synthetic model of --chains
+# chains (or an existing database, e.g. one brought up to date by the
+# migrations), and fails if any of them scans a table it should look up
+# through an index. Loading a whole table is a scan by design, so each query
+# lists the tables it is allowed to scan; everything else must be a SEARCH.
+# The time each query takes is printed alongside, so growth with model size
+# shows up when run at two sizes. tests/test_query_plans.py runs the same
+# check on a small synthetic model with the test suite.
+
+import argparse
+import os
+import re
+import shutil
+import sys
+import tempfile
+import time
+
+from sqlalchemy.orm import joinedload
+
+from db_benchmark import build
+from models import db, Chain, State, Transition_probability, Interaction, Raw_input, Tag, \
+    Initialization_probability, Revision, states_tags
+
+
+# (name, query, tables it may scan)
+def hot_queries():
+    chain_id, state_id, input_id, tag_id = 1, 2, 3, 1
+    return [
+        # Compiler and initializer: whole tables, see compiler.compile_database
+        ('compile chains', Chain.query, ['chains']),
+        ('compile states', State.query, ['states']),
+        ('compile transitions', Transition_probability.query, ['transition_probabilities']),
+        ('compile inputs', Raw_input.query, ['raw_inputs']),
+        ('compile interactions', Interaction.query, ['interactions']),
+        ('initializer tags', Tag.query.options(joinedload(Tag.states)), ['tags', 'states_tags']),
+        ('initializer rows', Initialization_probability.query.options(joinedload(Initialization_probability.Tags)),
+         ['initialization_probabilities', 'initialization_probabilities_tags']),
+        # API, see documents.model_document and models.model_revision
+        ('api revision', Revision.query.with_entities(Revision.value).limit(1), ['revisions']),
+        ('api chains with states', Chain.query.options(joinedload(Chain.states)).order_by(Chain.id), ['chains']),
+        ('api chain', Chain.query.options(joinedload(Chain.states)).filter(Chain.id == chain_id), []),
+        # Lookups by the notebook and the admin, and lazy relationship loads
+        ('states of chain', State.query.filter_by(chain_id=chain_id), []),
+        ('state by name in chain', State.query.filter_by(name='State 1', chain_id=chain_id), []),
+        ('transitions from state', Transition_probability.query.filter_by(From_state_id=state_id), []),
+        ('transitions to state', Transition_probability.query.filter_by(To_state_id=state_id), []),
+        ('transitions of chain', Transition_probability.query.filter_by(Chain_id=chain_id), []),
+        ('interactions in state', Interaction.query.filter_by(In_state_id=state_id), []),
+        ('interactions from state', Interaction.query.filter_by(From_state_id=state_id), []),
+        ('interactions to state', Interaction.query.filter_by(To_state_id=state_id), []),
+        ('interactions on chain', Interaction.query.filter_by(Effected_chain_id=chain_id), []),
+        ('input by slug', Raw_input.query.filter_by(slug='input_1'), []),
+        ('inputs of reference', Raw_input.query.filter_by(reference_id=1), []),
+        ('states costed by input', State.query.filter_by(cost_input_id=input_id), []),
+        ('states valued by input', State.query.filter_by(utility_input_id=input_id), []),
+        ('states weighted by input', State.query.filter_by(disability_input_id=input_id), []),
+        ('transitions costed by input', Transition_probability.query.filter_by(Cost_input_id=input_id), []),
+        ('tags of state', Tag.query.join(states_tags, Tag.id == states_tags.c.tag_id)
+         .filter(states_tags.c.state_id == state_id), []),
+        ('states with tag', State.query.join(states_tags, State.id == states_tags.c.state_id)
+         .filter(states_tags.c.tag_id == tag_id), []),
+        ('initialization of state', Initialization_probability.query.filter_by(State_id=state_id), []),
+    ]
+
+
+# Joined loads alias their tables (states_1); the alias is the table's name
+# with a number added
+SCAN = re.compile(r'^SCAN (?:TABLE )?(\w+?)(?:_\d+)?(?: |$)')
+
+
+def explain(query):
+    """EXPLAIN QUERY PLAN details for a query, one string per step."""
+    compiled = query.statement.compile(dialect=db.engine.dialect)
+    params = [compiled.params[name] for name in compiled.positiontup]
+    connection = db.engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        cursor.execute('EXPLAIN QUERY PLAN ' + str(compiled), params)
+        return [row[-1] for row in cursor.fetchall()]
+    finally:
+        connection.close()
+
+
+def scans(plan):
+    """Tables a plan reads in full, without an index."""
+    tables = []
+    for detail in plan:
+        match = SCAN.match(detail)
+        if match and 'COVERING INDEX' not in detail:
+            tables.append(match.group(1))
+    return tables
+
+
+def check(queries=None, repeat=5):
+    """[(name, plan, unexpected scans, seconds)] for the hot queries."""
+    report = []
+    for name, query, allowed in queries or hot_queries():
+        plan = explain(query)
+        unexpected = [table for table in scans(plan) if table not in allowed]
+        start = time.time()
+        for _ in range(repeat):
+            query.all()
+        report.append((name, plan, unexpected, (time.time() - start) / repeat))
+        db.session.rollback()
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Check the query plans of the hot model queries')
+    parser.add_argument('--chains', type=int, default=300)
+    parser.add_argument('--states', type=int, default=10)
+    parser.add_argument('--database', default=None, help='check this database instead of a synthetic one')
+    parser.add_argument('--verbose', action='store_true', help='print every plan')
+    args = parser.parse_args(argv)
+
+    directory = None
+    if args.database is None:
+        directory = tempfile.mkdtemp(prefix='limsa-plans-')
+        db.configure('sqlite:///' + os.path.join(directory, 'plans.sqlite'))
+        build(args.chains, args.states)
+    else:
+        db.configure('sqlite:///' + os.path.abspath(args.database))
+    try:
+        report = check()
+    finally:
+        db.dispose()
+        if directory is not None:
+            shutil.rmtree(directory)
+
+    failed = 0
+    for name, plan, unexpected, seconds in report:
+        status = 'SCAN ' + ', '.join(unexpected) if unexpected else 'ok'
+        print('%-30s %8.2fms  %s' % (name, seconds * 1000, status))
+        if unexpected or args.verbose:
+            for detail in plan:
+                print('    ' + detail)
+        failed += bool(unexpected)
+    if failed:
+        print('FAIL: %d of %d queries scan a table without an index' % (failed, len(report)))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,267 @@
+from __future__ import division
+
+# Streaming reducers for simulation outputs.
+#
+# A reducer watches the engine like any other observer and, as each batch of
+# replicates (PSA draws or stochastic runs) finishes, folds their outputs into
+# online statistics: mean and variance with Welford/Chan updates, and
+# percentiles with a mergeable log-bucketed quantile sketch (DDSketch). Memory
+# stays constant however many replicates are run, the running statistics
+# can be read at any time to watch convergence, and partial reducers built in
+# different worker processes merge exactly (moments) or within the sketch's
+# relative accuracy (quantiles).
+
+import copy
+
+import numpy as np
+
+from engine import Observer
+
+
+class Moments(object):
+
+    # Running count, mean and sum of squared deviations for an array of
+    # outputs, updated a batch at a time
+
+    def __init__(self, shape=()):
+        self.n = 0
+        self.mean = np.zeros(shape)
+        self.m2 = np.zeros(shape)
+
+    def update(self, batch):
+        batch = np.asarray(batch, dtype=float)
+        if batch.shape[0] == 0:
+            return
+        other = Moments(batch.shape[1:])
+        other.n = batch.shape[0]
+        other.mean = batch.mean(axis=0)
+        other.m2 = ((batch - other.mean) ** 2).sum(axis=0)
+        self.merge(other)
+
+    def merge(self, other):
+        if other.n == 0:
+            return
+        n = self.n + other.n
+        delta = other.mean - self.mean
+        self.mean = self.mean + delta * (other.n / n)
+        self.m2 = self.m2 + other.m2 + delta ** 2 * (self.n * other.n / n)
+        self.n = n
+
+    @property
+    def variance(self):
+        return self.m2 / (self.n - 1) if self.n > 1 else np.zeros_like(self.m2) * np.nan
+
+    @property
+    def stderr(self):
+        return np.sqrt(self.variance / self.n) if self.n > 1 else self.variance
+
+
+class QuantileSketch(object):
+
+    # DDSketch: values are counted in logarithmic buckets of relative width
+    # 2 * accuracy, one row of buckets per output, so any quantile is
+    # returned within that relative error. Sketches with the same accuracy
+    # merge by adding bucket counts.
+
+    def __init__(self, size=1, accuracy=0.01, max_buckets=2048):
+        self.size = size
+        self.accuracy = accuracy
+        self.max_buckets = max_buckets
+        self.gamma = (1.0 + accuracy) / (1.0 - accuracy)
+        self.log_gamma = np.log(self.gamma)
+        self.zeros = np.zeros(size, dtype=np.int64)
+        # positive and negative stores: (offset of first bucket key, counts)
+        self.stores = {1: [0, np.zeros((size, 0), dtype=np.int64)],
+                       -1: [0, np.zeros((size, 0), dtype=np.int64)]}
+
+    def update(self, batch):
+        batch = np.asarray(batch, dtype=float).reshape(-1, self.size)
+        rows = np.tile(np.arange(self.size), (batch.shape[0], 1))
+        zero = batch == 0
+        self.zeros += zero.sum(axis=0)
+        for sign in (1, -1):
+            mask = (batch * sign) > 0
+            if mask.any():
+                keys = np.ceil(np.log(batch[mask] * sign) / self.log_gamma).astype(np.int64)
+                self._add(sign, rows[mask], keys, np.ones(len(keys), dtype=np.int64))
+
+    def merge(self, other):
+        if other.accuracy != self.accuracy or other.size != self.size:
+            raise ValueError('Only sketches with the same accuracy and size can be merged')
+        self.zeros += other.zeros
+        for sign in (1, -1):
+            offset, counts = other.stores[sign]
+            rows, columns = np.nonzero(counts)
+            if len(rows):
+                self._add(sign, rows, columns + offset, counts[rows, columns])
+
+    @property
+    def count(self):
+        return self.zeros + sum(counts.sum(axis=1) for _, counts in self.stores.values())
+
+    def quantile(self, q):
+        """Quantiles q (scalar or sequence) of every output, as len(q) x size."""
+        qs = np.atleast_1d(q)
+        result = np.empty((len(qs), self.size))
+        result.fill(np.nan)
+
+        neg_offset, neg = self.stores[-1]
+        pos_offset, pos = self.stores[1]
+        # Order all buckets from the most negative value to the largest
+        values = np.concatenate([
+            -self._value(neg_offset + np.arange(neg.shape[1]))[::-1],
+            [0.0],
+            self._value(pos_offset + np.arange(pos.shape[1]))])
+        for i in range(self.size):
+            counts = np.concatenate([neg[i, ::-1], [self.zeros[i]], pos[i]])
+            total = counts.sum()
+            if total == 0:
+                continue
+            cumulative = np.cumsum(counts)
+            ranks = qs * (total - 1)
+            result[:, i] = values[np.searchsorted(cumulative, ranks, side='right')]
+        return result if np.ndim(q) else result[0]
+
+    def _value(self, keys):
+        # Midpoint (in relative terms) of each bucket
+        return 2.0 * self.gamma ** keys / (self.gamma + 1.0)
+
+    def _add(self, sign, rows, keys, counts):
+        offset, store = self.stores[sign]
+        if store.shape[1] == 0:
+            offset = keys.min()
+        low, high = min(offset, keys.min()), max(offset + store.shape[1] - 1, keys.max())
+        if low < offset or high >= offset + store.shape[1]:
+            grown = np.zeros((self.size, high - low + 1), dtype=np.int64)
+            grown[:, offset - low:offset - low + store.shape[1]] = store
+            store, offset = grown, low
+        np.add.at(store, (rows, keys - offset), counts)
+
+        # Keep memory bounded by collapsing the smallest-magnitude buckets
+        excess = store.shape[1] - self.max_buckets
+        if excess > 0:
+            store[:, excess] += store[:, :excess].sum(axis=1)
+            store, offset = store[:, excess:].copy(), offset + excess
+        self.stores[sign] = [offset, store]
+
+
+class Reducer(Observer):
+
+    # Folds one output of every finished replicate into running statistics.
+    #
+    # output maps the engine's final occupancy to a replicates x ... array
+    # (engine.state_outcome, or any picklable callable). When every is set,
+    # the output is instead sampled at the start of every every-th cycle and
+    # at the end, giving a time series per replicate.
+
+    def __init__(self, name, output, quantiles=(0.025, 0.5, 0.975), every=None, accuracy=0.01):
+        self.name = name
+        self.output = output
+        self.quantiles = tuple(quantiles)
+        self.every = every
+        self.accuracy = accuracy
+        self.moments = None
+        self.sketch = None
+
+    def empty(self):
+        """A reducer with the same settings and no data, e.g. for a worker."""
+        fresh = copy.copy(self)
+        fresh.moments = None
+        fresh.sketch = None
+        return fresh
+
+    def start(self, engine, values):
+        self.series = []
+
+    def cycle(self, cycle, occupancy, matrices):
+        if self.every and cycle % self.every == 0:
+            self.series.append(self.output(occupancy))
+
+    def finish(self, occupancy):
+        if self.every:
+            self.series.append(self.output(occupancy))
+            # replicates x samples (x outputs)
+            batch = np.concatenate([np.asarray(s, dtype=float)[:, None] for s in self.series], axis=1)
+        else:
+            batch = np.asarray(self.output(occupancy), dtype=float)
+        self.series = []
+        self.update(batch)
+
+    def update(self, batch):
+        if self.moments is None:
+            self.moments = Moments(batch.shape[1:])
+            self.sketch = QuantileSketch(int(np.prod(batch.shape[1:])), self.accuracy)
+        self.moments.update(batch)
+        self.sketch.update(batch)
+
+    def merge(self, other):
+        if other.moments is None:
+            return
+        if self.moments is None:
+            self.moments = Moments(other.moments.mean.shape)
+            self.sketch = QuantileSketch(other.sketch.size, other.sketch.accuracy)
+        self.moments.merge(other.moments)
+        self.sketch.merge(other.sketch)
+
+    @property
+    def n(self):
+        return self.moments.n if self.moments is not None else 0
+
+    def summary(self):
+        """Current n, mean, standard deviation, standard error and quantiles."""
+        if self.moments is None:
+            return {'name': self.name, 'n': 0}
+        shape = self.moments.mean.shape
+        quantiles = self.sketch.quantile(self.quantiles)
+        return {
+            'name': self.name,
+            'n': self.moments.n,
+            'mean': self.moments.mean,
+            'sd': np.sqrt(self.moments.variance),
+            'stderr': self.moments.stderr,
+            'quantiles': dict((q, quantiles[i].reshape(shape))
+                              for i, q in enumerate(self.quantiles)),
+        }
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('series', None)
+        return state
+
+    def state(self):
+        arrays = {}
+        if self.moments is not None:
+            arrays['n'] = np.array(self.moments.n)
+            arrays['mean'] = self.moments.mean
+            arrays['m2'] = self.moments.m2
+            arrays['zeros'] = self.sketch.zeros
+            for sign, label in ((1, 'positive'), (-1, 'negative')):
+                offset, counts = self.sketch.stores[sign]
+                arrays[label + '/offset'] = np.array(offset)
+                arrays[label + '/counts'] = counts
+        if getattr(self, 'series', None):
+            arrays['series'] = np.concatenate([np.asarray(s, dtype=float)[:, None] for s in self.series], axis=1)
+        return arrays
+
+    def restore(self, engine, values, state):
+        self.start(engine, values)
+        self.moments = self.sketch = None
+        if 'n' in state:
+            self.moments = Moments(state['mean'].shape)
+            self.moments.n = int(state['n'])
+            self.moments.mean = np.array(state['mean'])
+            self.moments.m2 = np.array(state['m2'])
+            self.sketch = QuantileSketch(int(np.prod(state['mean'].shape)), self.accuracy)
+            self.sketch.zeros = np.array(state['zeros'])
+            for sign, label in ((1, 'positive'), (-1, 'negative')):
+                self.sketch.stores[sign] = [int(state[label + '/offset']), np.array(state[label + '/counts'])]
+        if 'series' in state:
+            self.series = [np.array(state['series'][:, i]) for i in range(state['series'].shape[1])]
+
+
+def merge_all(reducers, partials):
+    """Merge lists of partial reducers (e.g. one list per worker) into reducers."""
+    for partial in partials:
+        for reducer, other in zip(reducers, partial):
+            reducer.merge(other)
+    return reducers
@@ -0,0 +1,119 @@
+from __future__ import division
+
+# Chain diagrams.
+#
+# Each chain is laid out with graphviz dot and written to
+#
+#     static/diagrams/chain-<chain id>-<hash>.<svg|png>
+#
+# where the hash is of the chain's states and transitions (its entry in the
+# API's model document, see app.py). A diagram is only laid out once for a
+# given version of its chain; editing one chain leaves the others' files
+# valid. Files are drawn to a temporary file of their own (from mkstemp, so
+# unique across processes and threads) and renamed into place, so
+# concurrent renders never see or clobber each other's half-written output.
+#
+# render_all() lays out every chain missing a diagram in parallel, one
+# process per chain.
+
+import hashlib
+import json
+import multiprocessing
+import os
+import tempfile
+
+
+basedir = os.path.abspath(os.path.dirname(__file__))
+DIAGRAM_DIR = os.path.join(basedir, 'static/diagrams')
+
+FORMATS = ('svg', 'png')
+
+
+def chain_hash(chain):
+    return hashlib.sha1(json.dumps(chain, sort_keys=True).encode('utf-8')).hexdigest()[:12]
+
+
+def diagram_name(chain, format='svg'):
+    return 'chain-%d-%s.%s' % (chain['id'], chain_hash(chain), format)
+
+
+def diagram_path(chain, format='svg', root=None):
+    return os.path.join(root or DIAGRAM_DIR, diagram_name(chain, format))
+
+
+def chain_graph(chain):
+    """pygraphviz graph of a chain document, laid out left to right."""
+    import pygraphviz as pgv
+    names = dict((state['id'], state['name']) for state in chain['states'])
+    G = pgv.AGraph(directed=True, rankdir="LR")
+    for tp in chain['transition_probabilities']:
+        from_name, to_name = names.get(tp['from_state_id']), names.get(tp['to_state_id'])
+        if from_name is None or to_name is None:
+            continue
+        G.add_node(from_name, shape="box", fontname="ArialMT")
+        G.add_node(to_name, shape="box", fontname="ArialMT")
+        label = "Dynamic" if tp['is_dynamic'] else tp['tp_base']
+        G.add_edge(from_name, to_name, label=label, fontname="ArialMT", fontsize="10")
+    return G
+
+
+def render_chain(chain, formats=FORMATS, root=None):
+    """Draw the chain's diagram in each format unless it exists; returns the paths."""
+    paths = [diagram_path(chain, format, root) for format in formats]
+    missing = [(format, path) for format, path in zip(formats, paths) if not os.path.exists(path)]
+    if missing:
+        G = chain_graph(chain)
+        G.layout(prog='dot')
+        for format, path in missing:
+            directory = os.path.dirname(path)
+            if not os.path.exists(directory):
+                try:
+                    os.makedirs(directory)
+                except OSError:
+                    # Created by a concurrent render
+                    pass
+            # Unique per call: the server renders from several threads
+            handle, temporary = tempfile.mkstemp(prefix=os.path.basename(path) + '.', suffix='.tmp',
+                                                 dir=directory)
+            os.close(handle)
+            try:
+                G.draw(temporary, format=format)
+                os.rename(temporary, path)
+            except Exception:
+                os.remove(temporary)
+                raise
+    return paths
+
+
+def render_all(chains, formats=FORMATS, root=None, processes=None):
+    """Render every chain missing a diagram, in parallel; returns chain id -> paths."""
+    missing = [chain for chain in chains
+               if not all(os.path.exists(diagram_path(chain, format, root)) for format in formats)]
+    if len(missing) > 1 and processes != 1:
+        pool = multiprocessing.Pool(processes)
+        try:
+            pool.map(_render, [(chain, formats, root) for chain in missing])
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for chain in missing:
+            render_chain(chain, formats, root)
+    return dict((chain['id'], [diagram_path(chain, format, root) for format in formats])
+                for chain in chains)
+
+
+def prune(chains, root=None):
+    """Delete diagrams of old versions of chains."""
+    root = root or DIAGRAM_DIR
+    if not os.path.exists(root):
+        return
+    current = set(diagram_name(chain, format) for chain in chains for format in FORMATS)
+    for name in os.listdir(root):
+        if name.startswith('chain-') and name not in current:
+            os.remove(os.path.join(root, name))
+
+
+def _render(task):
+    chain, formats, root = task
+    return render_chain(chain, formats, root)
@@ -0,0 +1,172 @@
+from __future__ import division
+
+# Columnar, memory-mapped store for simulation traces.
+#
+# A run's traces live in their own directory under RESULTS_DIR, linked from
+# the database by the id of its row in the runs table rather than stored in
+# limsa.sqlite. The directory holds one raw .npy file per chain per chunk of
+# draws plus a manifest.json describing the layout:
+#
+#     results/<run id>/manifest.json
+#     results/<run id>/chain-<c>/draws-<start>-<stop>.npy
+#
+# Each chunk is a (cycles + 1) x draws x states array written through a
+# memory map one cycle at a time as the engine runs, so a trace never has to
+# fit in memory. Readers memory-map the chunks back and slice by draw,
+# chain, state and cycle without loading the rest.
+
+import os
+import shutil
+
+import numpy as np
+
+from engine import Observer
+from snapshot import read_manifest, write_manifest
+
+
+basedir = os.path.abspath(os.path.dirname(__file__))
+RESULTS_DIR = os.path.join(basedir, 'results')
+
+
+def run_path(run_id, root=None):
+    return os.path.join(root or RESULTS_DIR, str(run_id))
+
+
+class TraceWriter(Observer):
+
+    # Engine observer that writes the occupancy of every chain, every cycle
+
+    def __init__(self, run_id, model, n_cycles, dtype='float32', root=None, overwrite=False,
+                 resume=False):
+        self.path = run_path(run_id, root)
+        if resume and os.path.exists(self.path):
+            # Continue a run restored from a checkpoint
+            self.manifest = read_manifest(self.path)
+            self.dtype = np.dtype(self.manifest['dtype'])
+            return
+        if os.path.exists(self.path):
+            if not overwrite:
+                raise ValueError('Results for run %s already exist at %s' % (run_id, self.path))
+            shutil.rmtree(self.path)
+        os.makedirs(self.path)
+
+        self.dtype = np.dtype(dtype)
+        self.manifest = {
+            'run_id': run_id,
+            'n_cycles': n_cycles,
+            'dtype': self.dtype.str,
+            'layout': ['cycle', 'draw', 'state'],
+            'chains': [{'name': chain.name, 'states': chain.state_names}
+                       for chain in model.chains],
+            'chunks': [],
+            'n_draws': 0,
+        }
+        write_manifest(self.path, self.manifest)
+
+    def start(self, engine, values):
+        self._open(values, 'w+')
+
+    def restore(self, engine, values, state):
+        # Cycles written before the checkpoint are already in the chunk files
+        self._open(values, 'r+')
+
+    def _open(self, values, mode):
+        start = self.manifest['n_draws']
+        stop = start + values.shape[0]
+        self.chunk = {'start': start, 'stop': stop, 'files': []}
+        self.arrays = []
+        for c, chain in enumerate(self.manifest['chains']):
+            name = os.path.join('chain-%d' % c, 'draws-%d-%d.npy' % (start, stop))
+            directory = os.path.join(self.path, 'chain-%d' % c)
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+            shape = (self.manifest['n_cycles'] + 1, stop - start, len(chain['states']))
+            self.arrays.append(np.lib.format.open_memmap(
+                os.path.join(self.path, name), mode=mode, dtype=self.dtype, shape=shape))
+            self.chunk['files'].append(name)
+
+    def cycle(self, cycle, occupancy, matrices):
+        for array, occ in zip(self.arrays, occupancy):
+            array[cycle] = occ
+
+    def finish(self, occupancy):
+        for array, occ in zip(self.arrays, occupancy):
+            array[-1] = occ
+            array.flush()
+        self.arrays = []
+        self.manifest['chunks'].append(self.chunk)
+        self.manifest['n_draws'] = self.chunk['stop']
+        write_manifest(self.path, self.manifest)
+
+
+class Results(object):
+
+    # Read-only, out-of-core view of a run's traces
+
+    def __init__(self, run_id, root=None):
+        self.path = run_path(run_id, root)
+        self.manifest = read_manifest(self.path)
+        self.chain_index = dict((chain['name'], c) for c, chain in enumerate(self.manifest['chains']))
+
+    @property
+    def n_draws(self):
+        return self.manifest['n_draws']
+
+    @property
+    def n_cycles(self):
+        return self.manifest['n_cycles']
+
+    def states(self, chain):
+        return self.manifest['chains'][self._chain(chain)]['states']
+
+    def chunks(self, chain):
+        """Yield (start, stop, memory-mapped cycles x draws x states array) per chunk."""
+        c = self._chain(chain)
+        for chunk in self.manifest['chunks']:
+            array = np.load(os.path.join(self.path, chunk['files'][c]), mmap_mode='r')
+            yield chunk['start'], chunk['stop'], array
+
+    def trace(self, chain, draws=None, states=None, cycles=None):
+        """Occupancy as a draws x cycles x states array.
+
+        draws is a slice or array of draw indices, states a list of state
+        names or indices, and cycles a slice or array of cycle indices; only
+        the chunks holding the selected draws are read.
+        """
+        c = self._chain(chain)
+        wanted = np.arange(self.n_draws)[draws if draws is not None else slice(None)]
+        state_index = self._states(c, states)
+        cycle_index = np.arange(self.n_cycles + 1)[cycles if cycles is not None else slice(None)]
+
+        parts = []
+        for start, stop, array in self.chunks(c):
+            local = wanted[(wanted >= start) & (wanted < stop)] - start
+            if len(local) == 0:
+                continue
+            part = array[np.ix_(cycle_index, local, state_index)]
+            parts.append(np.transpose(part, (1, 0, 2)))
+        if not parts:
+            return np.zeros((0, len(cycle_index), len(state_index)), dtype=self.manifest['dtype'])
+        return np.concatenate(parts, axis=0)
+
+    def _chain(self, chain):
+        return self.chain_index[chain] if not isinstance(chain, int) else chain
+
+    def _states(self, c, states):
+        names = self.manifest['chains'][c]['states']
+        if states is None:
+            return np.arange(len(names))
+        return np.array([names.index(s) if not isinstance(s, int) else s for s in states], dtype=int)
+
+
+def create_run(name=None, n_draws=None, n_cycles=None):
+    """Record a new run in the database and return its id."""
+    from models import db, Run
+
+    def write(session):
+        run = Run(name=name, n_draws=n_draws, n_cycles=n_cycles)
+        session.add(run)
+        session.flush()
+        run.results_path = run_path(run.id)
+        return run.id
+    return db.write(write)
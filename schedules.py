@@ -0,0 +1,112 @@
+from __future__ import division
+
+# Time-varying inputs.
+#
+# A Schedule gives a Raw_input a value over time, for interventions and
+# scale-ups such as hiv_treatment_recruitment_annual rising from 2015:
+#
+#     Schedule('hiv_treatment_recruitment_annual', [2015, 2020], [0.1, 0.6],
+#              interpolation='linear')
+#
+# Times are in years on the same scale as the run's start_year (calendar
+# years above, or years from the start with the default start_year of 0).
+# With interpolation='step' the input takes each value from its time until
+# the next; with 'linear' it moves in a straight line between them. Before
+# the first time the input keeps the scenario's own value, and after the
+# last it holds the last one. relative=True multiplies the scenario's value
+# instead of replacing it, so PSA draws keep their spread.
+#
+# Schedules compiles every schedule of a run into one cycle x input table,
+# and splits the cycles into segments over which no scheduled input
+# changes. The engine rebuilds the transition matrices (and re-evaluates
+# derived inputs and expressions) only when a segment starts, so a step
+# change costs one rebuild and a static stretch none; a linear ramp changes
+# every cycle it covers. Dynamics (see transmission.py) are prepared again
+# with the new values; observers such as Economics read the scenario's own
+# values once, at the start of the run.
+
+import numpy as np
+
+
+INTERPOLATIONS = ('step', 'linear')
+
+
+class Schedule(object):
+
+    def __init__(self, slug, times, values, interpolation='step', relative=False):
+        if interpolation not in INTERPOLATIONS:
+            raise ValueError('Unknown interpolation: %s' % interpolation)
+        if len(times) != len(values) or not len(times):
+            raise ValueError('Schedule for %s needs one value for each of its times' % slug)
+        order = np.argsort(times, kind='mergesort')
+        self.slug = slug
+        self.times = np.asarray(times, dtype=float)[order]
+        self.values = np.asarray(values, dtype=float)[order]
+        self.interpolation = interpolation
+        self.relative = relative
+
+    def at(self, years):
+        """Value at each of years; NaN before the first time."""
+        years = np.asarray(years, dtype=float)
+        if self.interpolation == 'linear':
+            result = np.interp(years, self.times, self.values)
+        else:
+            result = self.values[np.maximum(np.searchsorted(self.times, years, side='right') - 1, 0)]
+        return np.where(years < self.times[0], np.nan, result)
+
+    def describe(self):
+        return {'slug': self.slug, 'times': self.times.tolist(), 'values': self.values.tolist(),
+                'interpolation': self.interpolation, 'relative': self.relative}
+
+
+class Schedules(object):
+
+    def __init__(self, parameters, schedules, n_cycles, start_year=0.0):
+        self.parameters = parameters
+        self.schedules = list(schedules)
+        self.n_cycles = n_cycles
+        self.start_year = start_year
+        for schedule in self.schedules:
+            if schedule.slug not in parameters.index:
+                raise KeyError('No Raw_input with slug %s' % schedule.slug)
+            if parameters.is_derived(schedule.slug):
+                raise ValueError('%s is derived from other inputs and cannot be scheduled' % schedule.slug)
+        self.columns = np.array([parameters.index[s.slug] for s in self.schedules], dtype=int)
+        self.relative = np.array([s.relative for s in self.schedules], dtype=bool)
+        # Year at the start of every cycle (quarterly cycles)
+        self.years = start_year + np.arange(n_cycles) / 4.0
+        self.table = np.column_stack([s.at(self.years) for s in self.schedules] or
+                                     [np.zeros((n_cycles, 0))])
+        # Segment of every cycle: a new one starts whenever a row of the
+        # table differs from the one before it
+        before, after = self.table[:-1], self.table[1:]
+        same = ((after == before) | (np.isnan(after) & np.isnan(before))).all(axis=1)
+        self.segment = np.concatenate([[0], np.cumsum(~same)]).astype(int)
+        self.starts = np.concatenate([[0], np.flatnonzero(~same) + 1]).astype(int)
+
+    @classmethod
+    def from_params(cls, parameters, params, n_cycles):
+        """Schedules from a job's params['schedules'] (dicts like Schedule.describe())."""
+        schedules = [Schedule(s['slug'], s['times'], s['values'], s.get('interpolation', 'step'),
+                              bool(s.get('relative'))) for s in params.get('schedules', ())]
+        return cls(parameters, schedules, n_cycles, float(params.get('start_year', 0.0)))
+
+    def changes(self, cycle):
+        """Whether a new segment starts at cycle."""
+        return cycle == 0 or self.segment[cycle] != self.segment[cycle - 1]
+
+    def values(self, values, cycle):
+        """Copy of values (scenarios x parameters, evaluated) with the inputs for cycle."""
+        values = np.array(values, dtype=float, ndmin=2)
+        row = self.table[cycle]
+        for k, column in enumerate(self.columns):
+            if np.isnan(row[k]):
+                continue
+            if self.relative[k]:
+                values[:, column] *= row[k]
+            else:
+                values[:, column] = row[k]
+        return self.parameters.evaluate(values)
+
+    def describe(self):
+        return {'start_year': self.start_year, 'schedules': [s.describe() for s in self.schedules]}
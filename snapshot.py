@@ -0,0 +1,110 @@
+# Binary snapshots: a directory of raw .npy arrays plus a JSON manifest.
+#
+# Compiled models, checkpoints and result traces all use this layout. Arrays
+# are stored uncompressed and loaded with a memory map, so opening a snapshot
+# is zero-copy: pages are only read when an array is actually touched.
+#
+#     <path>/manifest.json    {"meta": {...}, "arrays": [names], "files": {...}}
+#     <path>/<name>.<generation>.npy
+#
+# Array names may contain '/' to group related arrays ('reducers/0/mean');
+# they are stored as '.'-separated file names. Every save writes its arrays
+# under a new generation and then swaps in its manifest with one
+# os.replace, so readers see either the previous snapshot or the new one
+# and an interrupted save leaves the previous one intact. Files of earlier
+# generations are removed after the swap (memory maps already open on
+# them stay valid).
+
+import hashlib
+import json
+import os
+import uuid
+
+import numpy as np
+
+
+MANIFEST = 'manifest.json'
+
+# os.rename already replaces atomically on POSIX under Python 2
+_replace = getattr(os, 'replace', os.rename)
+
+
+def write_manifest(path, manifest):
+    # Write then replace, so readers never see a half-written manifest
+    temporary = os.path.join(path, MANIFEST + '.tmp')
+    with open(temporary, 'w') as f:
+        json.dump(manifest, f, indent=1)
+    _replace(temporary, os.path.join(path, MANIFEST))
+
+
+def read_manifest(path):
+    with open(os.path.join(path, MANIFEST)) as f:
+        return json.load(f)
+
+
+def save(path, arrays, meta=None):
+    """Write arrays (name -> array) and JSON-serializable meta to path.
+
+    The arrays are written as a new generation and the manifest replaced
+    last, so an interrupted save leaves the previous snapshot intact.
+    """
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    generation = uuid.uuid4().hex[:12]
+    scalars = []
+    files = {}
+    for name, array in arrays.items():
+        array = np.asarray(array)
+        if array.ndim == 0:
+            scalars.append(name)
+        files[name] = _filename(name, generation)
+        np.save(os.path.join(path, files[name]), array)
+    write_manifest(path, {'meta': meta or {}, 'arrays': sorted(arrays),
+                          'scalars': sorted(scalars), 'files': files})
+    current = set(files.values())
+    for filename in os.listdir(path):
+        if filename.endswith('.npy') and filename not in current:
+            os.remove(os.path.join(path, filename))
+
+
+def load(path, mmap=True):
+    """Return (arrays, meta); arrays are read-only memory maps unless mmap is False."""
+    manifest = read_manifest(path)
+    scalars = set(manifest.get('scalars', ()))
+    # Snapshots written before generations name their files without one
+    files = manifest.get('files', {})
+    arrays = {}
+    for name in manifest['arrays']:
+        # Memory maps cannot be zero-dimensional, so scalars are read directly
+        mode = 'r' if mmap and name not in scalars else None
+        arrays[name] = np.load(os.path.join(path, files.get(name) or _filename(name)), mmap_mode=mode)
+    return arrays, manifest['meta']
+
+
+def exists(path):
+    return os.path.exists(os.path.join(path, MANIFEST))
+
+
+def digest(arrays, meta=None):
+    """Content hash of arrays and meta; equal for a snapshot and its source."""
+    sha = hashlib.sha1()
+    sha.update(json.dumps(meta or {}, sort_keys=True).encode('utf-8'))
+    for name in sorted(arrays):
+        array = np.ascontiguousarray(arrays[name])
+        sha.update(('%s %s %s' % (name, array.dtype.str, array.shape)).encode('utf-8'))
+        sha.update(array.tobytes() if hasattr(array, 'tobytes') else array.tostring())
+    return sha.hexdigest()
+
+
+def group(arrays, prefix):
+    """Arrays under prefix/, keyed by the rest of their name."""
+    prefix = prefix.rstrip('/') + '/'
+    return dict((name[len(prefix):], array) for name, array in arrays.items()
+                if name.startswith(prefix))
+
+
+def _filename(name, generation=None):
+    stem = name.replace('/', '.')
+    if generation is not None:
+        stem += '.' + generation
+    return stem + '.npy'
@@ -0,0 +1,209 @@
+from __future__ import division
+
+# Population strata (age group, sex, setting, ...) as an axis of the cohort.
+#
+# Instead of duplicating chains per stratum, every scenario row of a batch is
+# expanded into one row per combination of stratum levels, so the engine
+# steps all strata in the same batched matrix products it already uses for
+# scenarios. Row scenario * size + k holds stratum k of that scenario:
+#
+#     values     (scenarios * strata) x parameters, with each axis's inputs
+#                set for its level and derived inputs recomputed
+#     occupancy  (scenarios * strata) x states, each row the distribution of
+#                that stratum over the chain's states
+#     mass       (scenarios * strata,), the share of the population in each
+#                stratum; it sums to 1 for every scenario
+#
+# An AgeAxis moves people up an age group at each birthday boundary (every
+# fourth cycle): with ages spread evenly within a group, 1 / width of the
+# group has its birthday into the next one. Everything else about the
+# strata is fixed, so mass depends only on the cycle.
+#
+# Observers see the population as a whole: occupancy averaged over strata
+# weighted by mass, and matrices giving the same population flows (see
+# Strata.population). Axis inputs therefore act through transition
+# probabilities; state costs and utilities are taken at the scenario's own
+# values.
+
+import numpy as np
+
+
+class Axis(object):
+
+    def __init__(self, name, levels, shares=None, inputs=None, multipliers=None):
+        """A stratification axis.
+
+        shares is the initial share of the population at each level (equal
+        by default); inputs maps Raw_input slugs to their value at each
+        level and multipliers maps slugs to a factor per level (e.g. a
+        relative risk).
+        """
+        self.name = name
+        self.levels = list(levels)
+        if shares is None:
+            shares = np.ones(len(self.levels))
+        shares = np.asarray(shares, dtype=float)
+        self.shares = shares / shares.sum()
+        self.inputs = dict((slug, np.asarray(v, dtype=float)) for slug, v in (inputs or {}).items())
+        self.multipliers = dict((slug, np.asarray(v, dtype=float))
+                                for slug, v in (multipliers or {}).items())
+        for slug, v in list(self.inputs.items()) + list(self.multipliers.items()):
+            if v.shape != (len(self.levels),):
+                raise ValueError('%s: %s needs one value per level' % (name, slug))
+
+    def __len__(self):
+        return len(self.levels)
+
+    def describe(self):
+        return {'class': type(self).__name__, 'name': self.name, 'levels': [str(l) for l in self.levels],
+                'shares': self.shares.tolist(), 'ageing': self.describe_ageing(),
+                'inputs': dict((slug, v.tolist()) for slug, v in self.inputs.items()),
+                'multipliers': dict((slug, v.tolist()) for slug, v in self.multipliers.items())}
+
+    def describe_ageing(self):
+        return None
+
+    def ageing(self, cycle):
+        """Fraction of each level moving to the next one at the start of cycle, or None."""
+        return None
+
+
+class AgeAxis(Axis):
+
+    def __init__(self, name, levels, width, shares=None, inputs=None, multipliers=None):
+        """Age groups in increasing order; width is each group's width in years.
+
+        The last group is open-ended and nobody leaves it.
+        """
+        Axis.__init__(self, name, levels, shares, inputs, multipliers)
+        width = np.asarray(width, dtype=float) * np.ones(len(self.levels))
+        self.leaving = 1.0 / width
+        self.leaving[-1] = 0.0
+
+    def ageing(self, cycle):
+        if cycle > 0 and cycle % 4 == 0:
+            return self.leaving
+        return None
+
+    def describe_ageing(self):
+        return self.leaving.tolist()
+
+
+class Strata(object):
+
+    def __init__(self, axes):
+        self.axes = list(axes)
+        self.shape = tuple(len(axis) for axis in self.axes)
+        self.size = int(np.prod(self.shape))
+        # Level of every axis for each stratum, in row order
+        self.levels = np.indices(self.shape).reshape(len(self.axes), -1).T
+        self.shares = np.ones(self.size)
+        for a, axis in enumerate(self.axes):
+            self.shares *= axis.shares[self.levels[:, a]]
+
+    def describe(self):
+        """Everything that sets the strata, JSON-serializable (for cache keys)."""
+        return [axis.describe() for axis in self.axes]
+
+    def labels(self):
+        return [tuple(axis.levels[i] for axis, i in zip(self.axes, row)) for row in self.levels]
+
+    def expand(self, parameters, values):
+        """Stratified copy of values (scenarios x parameters), one row per stratum."""
+        values = np.atleast_2d(values)
+        expanded = np.repeat(values, self.size, axis=0)
+        n = values.shape[0]
+        for a, axis in enumerate(self.axes):
+            level = np.tile(self.levels[:, a], n)
+            for slug, by_level in axis.inputs.items():
+                expanded[:, parameters.index[slug]] = by_level[level]
+            for slug, by_level in axis.multipliers.items():
+                expanded[:, parameters.index[slug]] *= by_level[level]
+        return parameters.evaluate(expanded)
+
+    def initial_mass(self, n):
+        return np.tile(self.shares, n)
+
+    def mass(self, n, cycle):
+        """Mass of every stratum at the start of cycle."""
+        mass = self.initial_mass(n)
+        for c in range(1, cycle + 1):
+            mass = self.age(c, None, mass)[1]
+        return mass
+
+    def age(self, cycle, occupancy, mass):
+        """Occupancy and mass after the birthdays falling at the start of cycle.
+
+        occupancy may be None to advance mass alone.
+        """
+        for a, axis in enumerate(self.axes):
+            leaving = axis.ageing(cycle)
+            if leaving is None:
+                continue
+            grid = mass.reshape((-1,) + self.shape)
+            broadcast = [1] * grid.ndim
+            broadcast[a + 1] = len(axis)
+            moved = grid * leaving.reshape(broadcast)
+            # From each level to the one above it
+            into, out_of = [slice(None)] * grid.ndim, [slice(None)] * grid.ndim
+            into[a + 1], out_of[a + 1] = slice(1, None), slice(None, -1)
+            into, out_of = tuple(into), tuple(out_of)
+            stayed = grid - moved
+            new_mass = stayed.copy()
+            new_mass[into] += moved[out_of]
+            new_mass = new_mass.reshape(-1)
+
+            if occupancy is not None:
+                # Each stratum's new distribution is the mass-weighted mix
+                # of those who stayed and those who arrived from below
+                mixed = []
+                for occ in occupancy:
+                    people = occ.reshape(grid.shape + (occ.shape[1],))
+                    total = people * stayed[..., None]
+                    total[into] += people[out_of] * moved[out_of][..., None]
+                    with np.errstate(divide='ignore', invalid='ignore'):
+                        occ_new = total.reshape(occ.shape) / new_mass[:, None]
+                    # Empty strata keep their previous distribution
+                    empty = new_mass <= 0
+                    occ_new[empty] = occ[empty]
+                    mixed.append(occ_new)
+                occupancy = mixed
+            mass = new_mass
+        return occupancy, mass
+
+    def population(self, occupancy, matrices, mass):
+        """Population occupancy (scenarios x states) and matrices for each chain.
+
+        The matrices move the population occupancy to the same state totals
+        as stepping every stratum with its own matrix; with matrices None
+        only the occupancy is combined.
+        """
+        k = self.size
+        weights = mass.reshape(-1, k)
+        n = weights.shape[0]
+        total = weights.sum(axis=1)
+        population, combined = [], []
+        for c, occ in enumerate(occupancy):
+            s = occ.shape[1]
+            weighted = occ * mass[:, None]
+            pop = weighted.reshape(n, k, s).sum(axis=1) / total[:, None]
+            population.append(pop)
+            if matrices is None:
+                continue
+            matrix = matrices[c].reshape(n, k, s, s)
+            flow = np.einsum('nks,nkst->nst', weighted.reshape(n, k, s), matrix)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                pop_matrix = flow / (pop * total[:, None])[:, :, None]
+            # States nobody is in move like the average stratum
+            empty = pop <= 0
+            if empty.any():
+                average = np.einsum('nk,nkst->nst', weights, matrix) / total[:, None, None]
+                pop_matrix[empty] = average[empty]
+            combined.append(pop_matrix)
+        return population, (combined if matrices is not None else None)
+
+    def collapse(self, array, mass):
+        """Mass-weighted sum over strata of a per-row array; scenarios x ..."""
+        array = np.asarray(array)
+        weighted = array * mass.reshape((-1,) + (1,) * (array.ndim - 1))
+        return weighted.reshape((-1, self.size) + array.shape[1:]).sum(axis=1)
@@ -0,0 +1,73 @@
+from __future__ import division
+
+# One-way (tornado) and two-way sensitivity sweeps.
+#
+# All perturbations are laid out as rows of one parameter matrix - the base
+# case, then every input at its low and high - and evaluated by the engine in
+# a single batch. Derived inputs are recomputed for every row, so moving
+# case_detection_rate also moves overall_percent_active_treated and every
+# transition probability that depends on it.
+
+from collections import namedtuple
+
+import numpy as np
+
+
+SensitivityRow = namedtuple('SensitivityRow', [
+    'slug', 'name', 'low', 'high', 'outcome_low', 'outcome_high', 'swing'])
+
+
+def one_way_matrix(parameters, slugs=None):
+    """Base row followed by a low and a high row for each slug."""
+    if slugs is None:
+        slugs = parameters.varying()
+    for slug in slugs:
+        if parameters.is_derived(slug):
+            raise ValueError('%s is derived from other inputs and cannot be swept directly' % slug)
+
+    matrix = parameters.base(1 + 2 * len(slugs))
+    for k, slug in enumerate(slugs):
+        i = parameters.index[slug]
+        matrix[1 + 2 * k, i] = parameters.low[i]
+        matrix[2 + 2 * k, i] = parameters.high[i]
+    return slugs, parameters.evaluate(matrix)
+
+
+def two_way_matrix(parameters, first, second, n=5):
+    """n x n grid between the low and high values of two inputs."""
+    a, b = parameters.index[first], parameters.index[second]
+    grid_a = np.linspace(parameters.low[a], parameters.high[a], n)
+    grid_b = np.linspace(parameters.low[b], parameters.high[b], n)
+
+    matrix = parameters.base(n * n)
+    matrix[:, a] = np.repeat(grid_a, n)
+    matrix[:, b] = np.tile(grid_b, n)
+    return grid_a, grid_b, parameters.evaluate(matrix)
+
+
+def tornado(engine, outcome, slugs=None):
+    """Ranked one-way sensitivity table.
+
+    outcome maps the engine's final occupancy to one value per scenario.
+    Returns (base outcome, rows sorted by decreasing swing).
+    """
+    parameters = engine.model.parameters
+    slugs, matrix = one_way_matrix(parameters, slugs)
+    results = outcome(engine.run(matrix))
+
+    rows = []
+    for k, slug in enumerate(slugs):
+        i = parameters.index[slug]
+        low, high = results[1 + 2 * k], results[2 + 2 * k]
+        rows.append(SensitivityRow(slug, parameters.names[i],
+                                   parameters.low[i], parameters.high[i],
+                                   low, high, abs(high - low)))
+    rows.sort(key=lambda row: row.swing, reverse=True)
+    return results[0], rows
+
+
+def two_way(engine, outcome, first, second, n=5):
+    """Outcome over an n x n grid of two inputs, as (grid_a, grid_b, n x n array)."""
+    grid_a, grid_b, matrix = two_way_matrix(engine.model.parameters, first, second, n)
+    results = outcome(engine.run(matrix))
+    return grid_a, grid_b, results.reshape(n, n)
@@ -0,0 +1,60 @@
+# Shared fixtures: small models compiled in memory from database-like rows,
+# so the tests need neither the model database nor Flask.
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks import ChainRow, InputRow, InteractionRow, StateRow, TransitionRow, synthetic_model
+from compiler import compile_model
+
+
+TB_STATES = ['Uninfected', 'Fast latent', 'Slow latent', 'Infectious active', 'Death']
+
+
+def tb_rows():
+    """Chain, state, transition and input rows of the TB chain."""
+    values = [('number_of_infections_per_infected', 10.0), ('prop_fast', 0.14),
+              ('prop_slow', 0.86), ('active_cost', 400.0), ('active_utility', 0.7)]
+    inputs = [InputRow(i + 1, slug, slug, value, value * 0.8, value * 1.2, None)
+              for i, (slug, value) in enumerate(values)]
+    states = [StateRow(i + 1, name, 1, None, None, None) for i, name in enumerate(TB_STATES)]
+    states[3] = StateRow(4, 'Infectious active', 1, 4, 5, None)
+    transitions = [TransitionRow(1, 1, 2, 0.0, None, True, None),
+                   TransitionRow(2, 1, 3, 0.0, None, True, None),
+                   TransitionRow(3, 2, 4, 0.1, None, False, None),
+                   TransitionRow(4, 3, 4, 0.002, None, False, None),
+                   TransitionRow(5, 4, 1, 0.2, None, False, None),
+                   TransitionRow(6, 4, 5, 0.05, None, False, None)]
+    return [ChainRow(1, 'TB disease')], states, transitions, inputs
+
+
+@pytest.fixture
+def tb_model():
+    """One TB chain: the infection transitions are dynamic, active TB is costed."""
+    return compile_model(*tb_rows())
+
+
+@pytest.fixture
+def mixed_model():
+    """The TB chain, a chain with no states (as the real model's Setting) and smoking.
+
+    Smokers have a utility of 0.9 and progress from Slow latent to active
+    TB twice as fast.
+    """
+    chains, states, transitions, inputs = tb_rows()
+    chains += [ChainRow(2, 'Setting'), ChainRow(3, 'Smoking')]
+    states += [StateRow(6, 'Non-smoker', 3, None, None, None), StateRow(7, 'Smoker', 3, None, 6, None)]
+    transitions += [TransitionRow(7, 6, 7, 0.05, None, False, None),
+                    TransitionRow(8, 7, 6, 0.02, None, False, None)]
+    inputs.append(InputRow(6, 'smoker_utility', 'smoker_utility', 0.9, 0.8, 1.0, None))
+    return compile_model(chains, states, transitions, inputs, [InteractionRow(1, 7, 3, 4, 2.0)])
+
+
+@pytest.fixture
+def small_model():
+    """Nine chains of eight states, with interactions between neighbours."""
+    return synthetic_model(9, 8)
@@ -0,0 +1,100 @@
+import threading
+
+import numpy as np
+
+import cache
+from engine import Engine, state_outcome
+from psa import PSA
+from reducers import Reducer
+from schedules import Schedule, Schedules
+from strata import AgeAxis, Axis, Strata
+from transmission import TBTransmission
+
+
+INITIAL = {'TB disease': [0.9, 0, 0, 0.1, 0]}
+
+
+def test_key_depends_on_everything_given(tb_model):
+    values = tb_model.parameters.base(2)
+    other = values.copy()
+    other[1, 0] *= 1.01
+    base = cache.key(tb_model, values, 0, 8, reducers=['a'])
+    assert cache.key(tb_model, values.copy(), 0, 8, reducers=['a']) == base
+    changed = [cache.key(tb_model, other, 0, 8, reducers=['a']),
+               cache.key(tb_model, values[:1], 0, 8, reducers=['a']),
+               cache.key(tb_model, values, 1, 8, reducers=['a']),
+               cache.key(tb_model, values, 0, 9, reducers=['a']),
+               cache.key(tb_model, values, 0, 8, reducers=['b']),
+               cache.key(tb_model, values, 0, 8)]
+    assert len(set(changed + [base])) == len(changed) + 1
+
+
+def test_key_depends_on_the_model(tb_model, small_model):
+    values = tb_model.parameters.base()
+    assert cache.key(tb_model, values) != cache.key(small_model, small_model.parameters.base())
+
+
+class Recording(cache.Cache):
+
+    def __init__(self, root):
+        cache.Cache.__init__(self, root)
+        self.keys = []
+        self.computed = 0
+
+    def cached(self, key, compute):
+        self.keys.append(key)
+
+        def counted():
+            self.computed += 1
+            return compute()
+
+        return cache.Cache.cached(self, key, counted)
+
+
+def psa(model, **options):
+    engine = Engine(model, 8, initial=INITIAL, batch_size=5, **options)
+    reducer = Reducer('active', state_outcome(model, 'TB disease', 'Infectious active'))
+    return PSA(engine, [reducer], 10, seed=1)
+
+
+def test_cached_psa_keys_on_engine_setup(tb_model, tmp_path):
+    store = Recording(str(tmp_path))
+    schedules = Schedules(tb_model.parameters, [Schedule('prop_fast', [1], [0.3])], 8)
+    setups = [{}, {'dtype': np.float32}, {'dynamics': [TBTransmission(tb_model)]},
+              {'strata': Strata([Axis('setting', ['urban', 'rural'])])},
+              {'strata': Strata([Axis('setting', ['urban', 'rural'], [3, 1])])},
+              {'strata': Strata([AgeAxis('age', [0, 15], 15)])},
+              {'schedules': schedules}]
+    for options in setups:
+        cache.cached_psa(store, psa(tb_model, **options))
+    assert len(set(store.keys)) == len(setups)
+    assert store.computed == len(setups)
+
+    # The same setup again is a hit with the same statistics
+    first = cache.cached_psa(store, psa(tb_model))[0].summary()
+    assert store.computed == len(setups)
+    assert np.array_equal(first['mean'], psa(tb_model).run()[0].summary()['mean'])
+
+
+def test_concurrent_puts_of_one_key(tmp_path):
+    store = cache.Cache(str(tmp_path), memory_entries=0)
+    failures = []
+
+    def put(i):
+        try:
+            for j in range(20):
+                value = np.full(1000, i * 100 + j)
+                arrays, meta = store.put('ab' * 20, {'x': value, 'y': value}, {'i': i, 'j': j})
+                assert arrays['x'][0] == meta['i'] * 100 + meta['j']
+                arrays, meta = store.get('ab' * 20)
+                # Every manifest names files that are still there
+                assert (arrays['x'] == arrays['y']).all()
+        except Exception as error:
+            failures.append(error)
+
+    threads = [threading.Thread(target=put, args=(i,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert failures == []
@@ -0,0 +1,59 @@
+import numpy as np
+import pytest
+
+import checkpoint
+from economics import Economics
+from engine import Engine, state_outcome
+from psa import PSA
+from reducers import Reducer
+from transmission import TBTransmission
+
+
+INITIAL = {'TB disease': [0.9, 0, 0, 0.1, 0]}
+
+
+def engine(model):
+    return Engine(model, 12, initial=INITIAL, batch_size=7, dynamics=[TBTransmission(model)])
+
+
+def test_resumed_batch_is_identical(tb_model, tmp_path):
+    path = str(tmp_path / 'batch')
+    values = tb_model.parameters.base(3) * np.array([[1.1], [1.0], [0.9]])
+    economics = Economics()
+    whole = engine(tb_model).run_batch(values, [economics], checkpoint=checkpoint.Checkpoint(path, every_cycles=5))
+    # The last checkpoint is the start of cycle 10
+    assert checkpoint.load(path)[1]['batch']['cycle'] == 10
+
+    resumed_economics = Economics()
+    resumed = checkpoint.resume(engine(tb_model), path, [resumed_economics])
+    for a, b in zip(whole, resumed):
+        assert np.array_equal(a, b)
+    for a, b in zip(economics.totals(), resumed_economics.totals()):
+        assert np.array_equal(a, b)
+
+
+class Interrupted(Exception):
+    pass
+
+
+def psa(model, progress=None):
+    reducer = Reducer('active', state_outcome(model, 'TB disease', 'Infectious active'))
+    return PSA(engine(model), [reducer], 30, seed=5, progress=progress)
+
+
+def test_resumed_psa_is_identical(tb_model, tmp_path):
+    path = str(tmp_path / 'psa')
+    whole = psa(tb_model).run()[0].summary()
+
+    def interrupt(done, reducers):
+        if done >= 14:
+            raise Interrupted()
+
+    with pytest.raises(Interrupted):
+        psa(tb_model, interrupt).run(checkpoint=checkpoint.Checkpoint(path, every_cycles=5))
+    resumed = psa(tb_model)
+    resumed.restore(path)
+    summary = resumed.run()[0].summary()
+    assert summary['n'] == whole['n'] == 30
+    assert np.array_equal(summary['mean'], whole['mean'])
+    assert np.array_equal(summary['sd'], whole['sd'])
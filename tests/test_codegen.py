@@ -0,0 +1,54 @@
+import os
+import re
+import shutil
+import subprocess
+
+import numpy as np
+import pytest
+
+import codegen
+from compiler import compile_model
+from conftest import tb_rows, InputRow
+
+
+def reserved_model():
+    chains, states, transitions, inputs = tb_rows()
+    # Slugs that clean up to names the modules define themselves
+    for i, slug in enumerate(['values', 'high', 'nan', 'np', 'matrices', 'values_2']):
+        inputs.append(InputRow(10 + i, slug, slug, i + 0.5, i, i + 1.0, None))
+    return compile_model(chains, states, transitions, inputs)
+
+
+def test_unique():
+    assert codegen.unique(['A', 'A', 'A2', 'B'], ('B',)) == ['A', 'A2', 'A22', 'B2']
+
+
+def test_go_names_do_not_shadow_package_names():
+    go = codegen.go_module(codegen.model_contents(reserved_model()))
+    defined = re.findall(r'^(?:var |\t)(\w+) +=', go, re.M)
+    assert len(defined) == len(set(defined))
+    for name in codegen.GO_RESERVED:
+        assert defined.count(name) == 1
+
+
+def test_python_module_runs_with_reserved_slugs(mixed_model):
+    model = reserved_model()
+    namespace = {}
+    exec(codegen.python_module(codegen.model_contents(model)), namespace)
+    assert np.isnan(namespace['nan'])
+    assert namespace['np'] is np
+    assert namespace['values'] == 0.5
+    assert namespace['VALUES'].shape == (len(model.parameters.slugs),)
+    # A model with a chain without states generates too
+    exec(codegen.python_module(codegen.model_contents(mixed_model)), {})
+
+
+@pytest.mark.skipif(shutil.which('go') is None, reason='Go is not installed')
+def test_go_module_builds(tmp_path, mixed_model):
+    for i, model in enumerate([reserved_model(), mixed_model]):
+        directory = tmp_path / str(i)
+        directory.mkdir()
+        (directory / 'go.mod').write_text(u'module parameters\n\ngo 1.13\n')
+        (directory / 'parameters.go').write_text(codegen.go_module(codegen.model_contents(model)))
+        env = dict(os.environ, GOCACHE=str(tmp_path / 'cache'), GOFLAGS='-mod=mod', GO111MODULE='on')
+        subprocess.check_call(['go', 'build', './...'], cwd=str(directory), env=env)
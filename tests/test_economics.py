@@ -0,0 +1,43 @@
+import numpy as np
+
+from economics import Economics
+from engine import Engine
+
+
+def run(model, initial, n_cycles=8, discount_rate=0.0):
+    economics = Economics(discount_rate)
+    engine = Engine(model, n_cycles, initial={'TB disease': initial})
+    engine.run_batch(model.parameters.base(2), [economics])
+    return economics.totals()
+
+
+def test_dead_cohort_accrues_no_qalys(tb_model):
+    costs, qalys, dalys = run(tb_model, [0, 0, 0, 0, 1])
+    assert np.allclose(costs, 0.0)
+    assert np.allclose(qalys, 0.0)
+    # Every quarter of the two years is a quarter of life lost
+    assert np.allclose(dalys, 2.0)
+
+
+def test_healthy_cohort_accrues_full_qalys(tb_model):
+    # Uninfected with no infections (the dynamic transitions are 0) stay put
+    costs, qalys, dalys = run(tb_model, [1, 0, 0, 0, 0])
+    assert np.allclose(qalys, 2.0)
+    assert np.allclose(dalys, 0.0)
+
+
+def test_discounting_lowers_totals(tb_model):
+    _, undiscounted, _ = run(tb_model, [0, 0, 0, 1, 0])
+    _, discounted, _ = run(tb_model, [0, 0, 0, 1, 0], discount_rate=0.03)
+    assert (discounted < undiscounted).all()
+
+
+def test_empty_chain_leaves_qalys_alone(mixed_model):
+    # Everyone is uninfected and a non-smoker; the Setting chain has no states
+    economics = Economics(0.0)
+    engine = Engine(mixed_model, 8, initial={'TB disease': [1, 0, 0, 0, 0], 'Smoking': [1, 0]})
+    engine.run_batch(mixed_model.parameters.base(1), [economics])
+    costs, qalys, dalys = economics.totals()
+    # Smokers (5% a quarter) lose a tenth of a QALY each year they smoke
+    assert 1.9 < qalys[0] < 2.0
+    assert np.allclose(dalys, 0.0)
@@ -0,0 +1,33 @@
+import numpy as np
+
+from engine import Engine, precision_error
+from population import index_dtype, state_dtype
+from transmission import TBTransmission
+
+
+def test_float32_stays_within_precision_bound(small_model):
+    engine = Engine(small_model, 120, dtype=np.float32)
+    error = precision_error(engine, small_model.parameters.base(3))
+    # Rounding grows at most linearly, by about a float32 epsilon a cycle
+    assert 0 < error < 120 * np.finfo(np.float32).eps
+    for occupancy in engine.run(small_model.parameters.base(3)):
+        assert occupancy.dtype == np.float32
+        assert np.allclose(occupancy.sum(axis=1), 1.0, atol=1e-5)
+
+
+def test_float32_with_dynamics(tb_model):
+    engine = Engine(tb_model, 80, initial={'TB disease': [0.9, 0, 0, 0.1, 0]},
+                    dtype=np.float32, dynamics=[TBTransmission(tb_model)])
+    assert precision_error(engine) < 1e-5
+
+
+def test_compact_population_dtypes(small_model):
+    assert state_dtype(small_model) == np.int8
+    assert index_dtype(1000) == np.int32
+    assert index_dtype(2 ** 31) == np.int64
+
+
+def test_precision_error_with_an_empty_chain(mixed_model):
+    engine = Engine(mixed_model, 40, initial={'TB disease': [0.9, 0, 0, 0.1, 0], 'Smoking': [0.8, 0.2]},
+                    dtype=np.float32)
+    assert 0 < precision_error(engine) < 40 * np.finfo(np.float32).eps
@@ -0,0 +1,24 @@
+import numpy as np
+
+import cache
+import jobs
+
+
+def test_psa_job_with_workers_runs_in_a_queue_worker(tb_model, tmp_path, monkeypatch):
+    # Patched before the workers fork, so they see the same model and directories
+    monkeypatch.setattr(jobs, 'compile_database', lambda: tb_model)
+    monkeypatch.setattr(jobs, 'RESULTS_DIR', str(tmp_path / 'results'))
+    monkeypatch.setattr(cache, '_default', cache.Cache(str(tmp_path / 'cache')))
+    path = str(tmp_path / 'jobs.sqlite')
+    queue = jobs.JobQueue(path)
+    params = {'n_cycles': 8, 'n_draws': 12, 'batch_size': 4, 'n_workers': 2,
+              'initial': {'TB disease': [0.9, 0, 0, 0.1, 0]},
+              'outcomes': [['TB disease', 'Infectious active']]}
+    job_id = queue.submit('psa', params)
+
+    jobs.start_workers(1, path, once=True)
+    job = queue.get(job_id)
+    assert job['status'] == jobs.DONE, job['error']
+    summary = job['result'][0]
+    assert summary['n'] == 12
+    assert 0 < np.asarray(summary['mean']).item() < 1
@@ -0,0 +1,67 @@
+import os
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+
+import kernels
+from population import Population
+
+
+needs_numba = pytest.mark.skipif(kernels.numba is None, reason='Numba is not installed')
+
+
+def test_resolve():
+    assert kernels.resolve('auto') == kernels.default_backend()
+    assert kernels.resolve('numpy') == 'numpy'
+    with pytest.raises(ValueError):
+        kernels.resolve('cuda')
+
+
+@needs_numba
+def test_numba_matches_numpy(small_model):
+    # small_model has interactions, so the adjusted rows are compared too
+    assert kernels.verify(small_model, n=20000) == {'numba': 0}
+
+
+@needs_numba
+def test_numba_matches_numpy_with_an_empty_chain(mixed_model):
+    assert kernels.verify(mixed_model, n=20000) == {'numba': 0}
+
+
+@needs_numba
+def test_parallel_numba_matches_numpy():
+    # In a process of its own: once the parallel kernel's threads are
+    # running, a later fork (the PSA tests' worker pool) would hang
+    code = ('import kernels; from benchmarks import synthetic_model; '
+            'print(kernels.verify(synthetic_model(9, 8), n=20000, backends=("numba-parallel",)))')
+    output = subprocess.check_output([sys.executable, '-c', code], 
+                                     cwd=os.path.dirname(os.path.abspath(kernels.__file__)))
+    assert output.decode().strip() == "{'numba-parallel': 0}"
+
+
+@pytest.mark.parametrize('backend', ['numpy', pytest.param('numba', marks=needs_numba)])
+def test_empty_chain_is_passed_over(mixed_model, backend):
+    matrices = [m[0] for m in mixed_model.matrices(mixed_model.parameters.base())]
+    tables = kernels.Tables(mixed_model, matrices)
+    rng = np.random.RandomState(0)
+    states = np.column_stack([rng.randint(0, 5, 1000), np.zeros(1000, int), rng.randint(0, 2, 1000)])
+    following = kernels.step(backend, states.astype(np.int8), np.arange(1000), tables, rng.random_sample((3, 1000)))
+    assert (following[:, 1] == 0).all()
+    assert (following[:, 0] != states[:, 0]).any()
+
+
+@pytest.mark.parametrize('backend', ['numpy', pytest.param('numba', marks=needs_numba)])
+def test_kernel_steps_like_grouped_step(tb_model, backend):
+    # Without interactions the kernels and the grouped step take the same
+    # draws and give the same people the same states
+    matrices = [m[0] for m in tb_model.matrices(tb_model.parameters.base())]
+    populations = [Population(tb_model, 500, seed=4), Population(tb_model, 500, seed=4, backend=backend)]
+    for population in populations:
+        population.add(np.arange(500)[:, None] % 5, 30, 0)
+        for _ in range(10):
+            population.step(matrices)
+    grouped, kernel = populations
+    assert np.array_equal(grouped.states, kernel.states)
+    assert all(np.array_equal(a, b) for a, b in zip(grouped.counts, kernel.counts))
@@ -0,0 +1,33 @@
+import numpy as np
+
+from population import Population
+from transmission import TBTransmission
+
+
+def populate(model, n=2000, seed=0, **options):
+    population = Population(model, n, seed=seed, **options)
+    rng = np.random.RandomState(seed)
+    states = np.zeros((n, len(model.chains)), dtype=population.states.dtype)
+    states[:, 0] = rng.choice(5, n, p=[0.8, 0.05, 0.05, 0.1, 0.0])
+    states[:, 2] = rng.randint(0, 2, n)
+    population.add(states, 30, 0)
+    return population
+
+
+def test_step_with_an_empty_chain(mixed_model):
+    values = mixed_model.parameters.base()
+    tb = TBTransmission(mixed_model)
+    tb.prepare(values)
+    population = populate(mixed_model, dynamics=[tb])
+    matrices = [m[0] for m in mixed_model.matrices(values)]
+    for _ in range(20):
+        population.step(matrices)
+    living = population.living()
+    assert len(population.counts[1]) == 0
+    assert (population.states[living, 1] == 0).all()
+    for c in (0, 2):
+        assert np.array_equal(population.counts[c],
+                              np.bincount(population.states[living, c], minlength=len(mixed_model.chains[c])))
+    # Some people have been infected and some have died
+    assert population.counts[0][1] + population.counts[0][2] > 200
+    assert population.counts[0][4] > 0
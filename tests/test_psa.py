@@ -0,0 +1,25 @@
+import numpy as np
+
+from engine import Engine, state_outcome
+from psa import PSA
+from reducers import Reducer
+from transmission import TBTransmission
+
+
+def run(model, n_workers):
+    engine = Engine(model, 12, initial={'TB disease': [0.9, 0, 0, 0.1, 0]}, batch_size=7,
+                    dynamics=[TBTransmission(model)])
+    reducer = Reducer('active', state_outcome(model, 'TB disease', 'Infectious active'))
+    psa = PSA(engine, [reducer], 30, seed=3)
+    return psa.run(n_workers)[0].summary()
+
+
+def test_workers_give_the_same_results(tb_model):
+    one, two = run(tb_model, 1), run(tb_model, 2)
+    assert one['n'] == two['n'] == 30
+    assert one['sd'] > 0
+    # Batches are merged in order, so the moments agree to rounding
+    assert np.allclose(one['mean'], two['mean'], rtol=1e-12, atol=0)
+    assert np.allclose(one['sd'], two['sd'], rtol=1e-9, atol=0)
+    for q in one['quantiles']:
+        assert np.allclose(one['quantiles'][q], two['quantiles'][q])
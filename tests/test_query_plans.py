@@ -0,0 +1,39 @@
+# The hot model queries look rows up through the indexes added for them
+# (see query_plans.py, which also times them at larger model sizes).
+
+import pytest
+
+import query_plans
+from db_benchmark import build
+from models import db
+
+
+@pytest.fixture(scope='module')
+def database(tmp_path_factory):
+    db.configure('sqlite:///' + str(tmp_path_factory.mktemp('plans') / 'plans.sqlite'))
+    build(20, 5)
+    yield db
+    db.dispose()
+
+
+def unexpected_scans(report):
+    return dict((name, unexpected) for name, plan, unexpected, seconds in report if unexpected)
+
+
+def test_hot_queries_use_indexes(database):
+    assert unexpected_scans(query_plans.check(repeat=1)) == {}
+
+
+def test_missing_index_is_caught(database):
+    connection = database.engine.raw_connection()
+    try:
+        names = [row[0] for row in connection.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = 'states' AND sql LIKE '%chain_id%'")]
+        assert names
+        for name in names:
+            connection.execute('DROP INDEX %s' % name)
+        connection.commit()
+        scans = unexpected_scans(query_plans.check(repeat=1))
+        assert scans['states of chain'] == ['states']
+    finally:
+        connection.close()
@@ -0,0 +1,70 @@
+import numpy as np
+import pytest
+
+from engine import Engine
+from schedules import Schedule, Schedules
+from transmission import TBTransmission
+
+
+def test_step_and_linear_values():
+    step = Schedule('x', [2, 1], [20.0, 10.0])
+    linear = Schedule('x', [1, 2], [10.0, 20.0], interpolation='linear')
+    years = [0.5, 1.0, 1.5, 2.0, 3.0]
+    assert np.array_equal(step.at(years)[1:], [10, 10, 20, 20])
+    assert np.allclose(linear.at(years)[1:], [10, 15, 20, 20])
+    assert np.isnan(step.at(years)[0]) and np.isnan(linear.at(years)[0])
+    with pytest.raises(ValueError):
+        Schedule('x', [1, 2], [1.0])
+    with pytest.raises(ValueError):
+        Schedule('x', [1], [1.0], interpolation='cubic')
+
+
+def test_compiled_table_and_segments(tb_model):
+    parameters = tb_model.parameters
+    schedules = Schedules(parameters, [Schedule('prop_fast', [1], [0.5]),
+                                       Schedule('active_cost', [0.5, 1.5], [1.0, 2.0],
+                                                interpolation='linear', relative=True)], 10)
+    assert schedules.table.shape == (10, 2)
+    # prop_fast from cycle 4; active_cost from cycle 2, every cycle until 1.5 years
+    assert np.isnan(schedules.table[:4, 0]).all() and (schedules.table[4:, 0] == 0.5).all()
+    assert np.allclose(schedules.table[2:7, 1], [1.0, 1.25, 1.5, 1.75, 2.0])
+    assert schedules.starts.tolist() == [0, 2, 3, 4, 5, 6]
+    assert [schedules.changes(c) for c in range(10)] == [True, False] + [True] * 5 + [False] * 3
+
+    values = parameters.base(2)
+    values[1, parameters.index['active_cost']] = 200.0
+    later = schedules.values(values, 9)
+    assert (later[:, parameters.index['prop_fast']] == 0.5).all()
+    # relative multiplies each scenario's own value
+    assert later[:, parameters.index['active_cost']].tolist() == [800.0, 400.0]
+    assert np.array_equal(schedules.values(values, 0), values)
+
+
+def test_unknown_slug(tb_model):
+    with pytest.raises(KeyError):
+        Schedules(tb_model.parameters, [Schedule('no_such_input', [0], [1.0])], 4)
+
+
+def test_from_params_round_trip(tb_model):
+    schedules = Schedules(tb_model.parameters, [Schedule('prop_fast', [1, 2], [0.2, 0.4], 'linear')], 12, 2015.0)
+    again = Schedules.from_params(tb_model.parameters, schedules.describe(), 12)
+    assert again.describe() == schedules.describe()
+    assert np.array_equal(again.table, schedules.table, equal_nan=True)
+
+
+def test_schedule_from_the_start_matches_changed_values(tb_model):
+    parameters = tb_model.parameters
+    initial = {'TB disease': [0.9, 0, 0, 0.1, 0]}
+
+    def run(values, schedules=None):
+        engine = Engine(tb_model, 20, initial=initial, dynamics=[TBTransmission(tb_model)],
+                        schedules=schedules)
+        return engine.run(values)
+
+    values = parameters.base()
+    changed = values.copy()
+    changed[:, parameters.index['number_of_infections_per_infected']] = 5.0
+    schedule = Schedule('number_of_infections_per_infected', [0], [5.0])
+    scheduled = run(values, Schedules(parameters, [schedule], 20))
+    assert all(np.array_equal(a, b) for a, b in zip(scheduled, run(changed)))
+    assert not np.allclose(scheduled[0], run(values)[0])
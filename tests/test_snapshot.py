@@ -0,0 +1,33 @@
+import os
+
+import numpy as np
+import pytest
+
+import snapshot
+
+
+def test_save_replaces_previous(tmp_path):
+    path = str(tmp_path / 'snap')
+    snapshot.save(path, {'a': np.arange(3), 'b/c': np.ones(2)}, {'n': 1})
+    snapshot.save(path, {'a': np.arange(4)}, {'n': 2})
+    arrays, meta = snapshot.load(path)
+    assert meta == {'n': 2}
+    assert sorted(arrays) == ['a']
+    assert np.array_equal(arrays['a'], np.arange(4))
+    # Only the manifest and the latest generation's arrays are left
+    assert len(os.listdir(path)) == 2
+
+
+def test_interrupted_save_keeps_previous(tmp_path, monkeypatch):
+    path = str(tmp_path / 'snap')
+    snapshot.save(path, {'a': np.arange(3)}, {'n': 1})
+
+    def fail(*args):
+        raise IOError('disk full')
+
+    monkeypatch.setattr(snapshot, '_replace', fail)
+    with pytest.raises(IOError):
+        snapshot.save(path, {'a': np.arange(5)}, {'n': 2})
+    arrays, meta = snapshot.load(path)
+    assert meta == {'n': 1}
+    assert np.array_equal(arrays['a'], np.arange(3))
@@ -0,0 +1,44 @@
+import warnings
+
+import pytest
+
+import validate
+from compiler import compile_model
+from conftest import ChainRow, InputRow, StateRow, TransitionRow
+from engine import Engine
+from psa import PSA
+
+
+def model(value=0.1, to_state=2):
+    """Two states; the transition out of Alive is the input risk."""
+    inputs = [InputRow(1, 'risk', 'risk', value, 0.05, 0.2, None)]
+    states = [StateRow(1, 'Alive', 1, None, None, None), StateRow(2, 'Death', 1, None, None, None)]
+    transitions = [TransitionRow(1, 1, to_state, 0.0, 'risk', False, None)]
+    return compile_model([ChainRow(1, 'Life')], states, transitions, inputs)
+
+
+def test_valid_model_passes_strictly():
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        assert validate.check(model(), strict=True) == []
+
+
+@pytest.mark.parametrize('broken, check', [({'value': 0.5}, 'input_range'),
+                                           ({'to_state': 9}, 'missing_state')])
+def test_strict_turns_warnings_into_errors(broken, check):
+    broken = model(**broken)
+    with pytest.warns(validate.ModelWarning):
+        issues = validate.check(broken)
+    assert check in [issue.check for issue in issues if issue.severity == validate.WARNING]
+    with pytest.raises(validate.ModelError) as error, warnings.catch_warnings():
+        # Reachability is still only a warning
+        warnings.simplefilter('ignore', validate.ModelWarning)
+        validate.check(broken, strict=True)
+    assert [issue.check for issue in error.value.issues] == [check]
+
+
+def test_psa_refuses_input_outside_its_range():
+    broken = model(value=0.5)
+    with pytest.raises(validate.ModelError):
+        PSA(Engine(broken, 4), [], 10)
+    PSA(Engine(broken, 4), [], 10, check=False)
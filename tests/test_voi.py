@@ -0,0 +1,51 @@
+# EVPI and EVPPI against closed forms: with incremental net benefit x + y,
+# x and y independent standard normals, EVPPI(x) = E[max(x, 0)] = 1/sqrt(2 pi)
+# and EVPI = E[max(x + y, 0)] = sqrt(2)/sqrt(2 pi).
+
+import numpy as np
+import pytest
+
+import voi
+
+
+N = 20000
+
+
+@pytest.fixture
+def draws():
+    rng = np.random.RandomState(0)
+    params = rng.standard_normal((N, 2))
+    nb = np.column_stack([np.zeros(N), params.sum(axis=1)])
+    return nb, params
+
+
+def test_evpi(draws):
+    nb, _ = draws
+    assert voi.evpi(nb) == pytest.approx(np.sqrt(2) / np.sqrt(2 * np.pi), abs=0.02)
+
+
+@pytest.mark.parametrize('method', ['gam', 'gp'])
+def test_evppi_single_parameter(draws, method):
+    nb, params = draws
+    result = voi.evppi(nb, params, ['x', 'y'], {'x': ['x'], 'y': ['y'], 'both': ['x', 'y']},
+                       method=method)
+    assert result['x'] == pytest.approx(1 / np.sqrt(2 * np.pi), abs=0.02)
+    assert result['y'] == pytest.approx(1 / np.sqrt(2 * np.pi), abs=0.02)
+    # Knowing every parameter is perfect information
+    assert result['both'] == pytest.approx(voi.evpi(nb), abs=0.02)
+
+
+def test_evppi_irrelevant_parameter():
+    rng = np.random.RandomState(1)
+    params = rng.standard_normal((N, 2))
+    nb = np.column_stack([np.zeros(N), params[:, 0]])
+    result = voi.evppi(nb, params, ['x', 'noise'], {'noise': ['noise']})
+    assert result['noise'] == pytest.approx(0.0, abs=0.01)
+
+
+def test_gp_fits_a_subsample(draws):
+    nb, params = draws
+    groups = {'x': ['x']}
+    subsampled = voi.evppi(nb, params, ['x', 'y'], groups, method='gp', max_draws=2000)['x']
+    assert subsampled == pytest.approx(1 / np.sqrt(2 * np.pi), abs=0.03)
+    assert subsampled != voi.evppi(nb, params, ['x', 'y'], groups, method='gp', max_draws=None)['x']
@@ -0,0 +1,309 @@
+from __future__ import division
+
+# Transmission: the dynamic infection transitions.
+#
+# HIV spreads between the states of the "HIV risk groups" chain. Every
+# cycle the partnerships between groups are laid out in risk-group x
+# risk-group matrices, one per kind of partnership and per scenario:
+#
+#   heterosexual  general population and IDU men and women, with
+#                 general_parternships partners a year, mixing with the
+#                 other sex in proportion to the partnerships it offers
+#   commercial    sex workers with csw_number_of_partners_per_year clients a
+#                 year, spread over general population men
+#   MSM           num_partners_msm partners a year among MSM
+#   needles       partnerships_idus needle-sharing partners a year among
+#                 IDUs, each sharing num_injections_idu_annual /
+#                 partnerships_idus injections
+#
+# Each partnership transmits with trans_per_partnership (per shared
+# injection, TRANS_PER_INJECTION), reduced by condom use times
+# condom_effectiveness. The chance of escaping infection for a year is then
+# the product over partners, so the force of infection on each group is
+# one small batched matrix-vector product of log escape probabilities with
+# prevalence by group:
+#
+#     annual risk[g] = 1 - exp(sum_h partners[g, h] * log(1 - beta[g, h] * prevalence[h]))
+#
+# In the cohort engine chains are independent, so without strata nothing
+# ties HIV status to risk group: prevalence is taken to be the same in every
+# group, the Uninfected -> Acute probability is the average risk over the
+# risk-group distribution, and the mixing matrices act only through group
+# sizes (mean-field; assortative mixing has no effect). Stratifying the
+# cohort by risk group - an axis whose levels are named as in RISK_GROUPS,
+# given as axis= - gives every group its own prevalence and its own risk.
+# A microsimulated population (see population.py) has prevalence by group
+# exactly.
+#
+# TB infects in proportion to the share of the population in Infectious
+# active. Each infectious case causes number_of_infections_per_infected
+# infections a year (scaled by trans_coeff where it is set), so the annual
+# risk of infection is 1 - exp(-infections * trans_coeff * share infectious).
+# New infections are split between Fast latent and Slow latent in the ratio
+# prop_fast : prop_slow. With strata the share can be taken within each
+# level of one axis (e.g. setting or HIV status). The share is read from
+# the running occupancy the engine already maintains (or a population's
+# running counts), never from a scan over people.
+#
+# Both also drive a microsimulated Population, given as its dynamics:
+# population_transitions() gives each person's infection probabilities at
+# the start of a step.
+
+import numpy as np
+
+from engine import Dynamic, set_transition
+from parameters import convert_year_to_qt
+
+
+# CDC estimate of transmission per needle-sharing injection (63 per 10,000)
+TRANS_PER_INJECTION = 0.0063
+
+GENERAL_MEN, GENERAL_WOMEN, SEX_WORKERS, IDU_MEN, IDU_WOMEN, MSM = range(6)
+RISK_GROUPS = ['General population male', 'General population female', 'Sex worker',
+               'IDU male', 'IDU female', 'MSM']
+
+HIV_INFECTED = ['Acute', 'Early', 'Late', 'Advanced/AIDS']
+
+
+class HIVTransmission(Dynamic):
+
+    def __init__(self, model, hiv_chain='HIV disease', risk_chain='HIV risk groups',
+                 infected=HIV_INFECTED, infection=('Uninfected', 'Acute'), axis=None):
+        """axis names a strata axis of risk groups, for prevalence by group."""
+        self.model = model
+        self.axis = axis
+        self.hiv = model.chain_index[hiv_chain]
+        self.risk = model.chain_index[risk_chain]
+        chain = model.chains[self.risk]
+        # Position of each risk group among the risk chain's states
+        self.groups = np.array([chain.state(name) for name in RISK_GROUPS])
+        hiv = model.chains[self.hiv]
+        self.infected = np.array([hiv.state(name) for name in infected])
+        self.infection = hiv.state(infection[0]), hiv.state(infection[1])
+
+    def prepare(self, values):
+        self.inputs = inputs(self.model.parameters, values)
+
+    def describe(self):
+        return {'class': type(self).__name__, 'hiv': self.hiv, 'risk': self.risk,
+                'groups': self.groups.tolist(), 'infected': self.infected.tolist(),
+                'infection': [int(s) for s in self.infection], 'axis': self.axis}
+
+    def start(self, engine, values):
+        Dynamic.start(self, engine, values)
+        if self.axis is not None:
+            strata = engine.strata
+            if strata is None:
+                raise ValueError('HIV transmission by %s needs an engine with strata' % self.axis)
+            a = [axis.name for axis in strata.axes].index(self.axis)
+            names = strata.axes[a].levels
+            missing = [name for name in RISK_GROUPS if name not in names]
+            if missing:
+                raise ValueError('Strata axis %s has no level for %s' % (self.axis, ', '.join(missing)))
+            # Strata x groups indicator of each stratum's risk group
+            self.indicator = np.zeros((strata.size, len(RISK_GROUPS)))
+            self.stratum_group = -np.ones(strata.size, dtype=int)
+            for g, name in enumerate(RISK_GROUPS):
+                members = strata.levels[:, a] == names.index(name)
+                self.indicator[members, g] = 1.0
+                self.stratum_group[members] = g
+
+    def update(self, cycle, occupancy, matrices):
+        engine = self.engine
+        f, t = self.infection
+        if self.axis is None:
+            population = engine.population(occupancy)[0]
+            sizes = population[self.risk][:, self.groups]
+            prevalence = population[self.hiv][:, self.infected].sum(axis=1)
+            risk = self.annual_risk(sizes, np.tile(prevalence[:, None], (1, len(RISK_GROUPS))))
+            total = sizes.sum(axis=1)
+            average = np.where(total > 0, (risk * sizes).sum(axis=1) / np.maximum(total, 1e-300), 0.0)
+            return set_transition(matrices, self.hiv, f, t, engine.per_row(convert_year_to_qt(average)))
+        # Size and prevalence of each group from the strata, weighted by mass
+        k = engine.strata.size
+        mass = engine.mass.reshape(-1, k)
+        infected = occupancy[self.hiv][:, self.infected].sum(axis=1).reshape(-1, k)
+        sizes = mass.dot(self.indicator)
+        prevalence = (infected * mass).dot(self.indicator) / np.maximum(sizes, 1e-300)
+        risk = np.concatenate([self.quarterly_risk(sizes, prevalence), np.zeros((sizes.shape[0], 1))], axis=1)
+        # Strata outside the risk groups (stratum_group -1) take the 0 column
+        return set_transition(matrices, self.hiv, f, t, risk[:, self.stratum_group].reshape(-1))
+
+    def annual_risk(self, sizes, prevalence):
+        """Annual probability of infection for each risk group (scenarios x groups)."""
+        partners, beta = partnerships(self.inputs, sizes)
+        escape = np.einsum('kngh,kngh->ng', partners, np.log1p(-beta * prevalence[None, :, None, :]))
+        return -np.expm1(escape)
+
+    def quarterly_risk(self, sizes, prevalence):
+        return convert_year_to_qt(self.annual_risk(sizes, prevalence))
+
+    def population_risk(self, population):
+        """Quarterly risk for each risk group of a microsimulated population.
+
+        prepare() must have been called with a single scenario's values.
+        """
+        living = population.living()
+        group = population.states[living, self.risk]
+        is_infected = np.zeros(len(self.model.chains[self.hiv]), dtype=bool)
+        is_infected[self.infected] = True
+        infected = is_infected[population.states[living, self.hiv]]
+        n_states = len(self.model.chains[self.risk])
+        people = np.bincount(group, minlength=n_states)[self.groups].astype(float)
+        cases = np.bincount(group[infected], minlength=n_states)[self.groups]
+        prevalence = cases / np.maximum(people, 1)
+        return self.quarterly_risk(people[None, :] / max(len(living), 1), prevalence[None, :])[0]
+
+    def population_transitions(self, population, living):
+        """Uninfected -> Acute probability of each of living, by their risk group."""
+        by_state = np.zeros(len(self.model.chains[self.risk]))
+        by_state[self.groups] = self.population_risk(population)
+        f, t = self.infection
+        return [(self.hiv, f, t, by_state[population.states[living, self.risk]])]
+
+
+class TBTransmission(Dynamic):
+
+    def __init__(self, model, chain='TB disease', infectious=('Infectious active',),
+                 susceptible='Uninfected', fast='Fast latent', slow='Slow latent', axis=None):
+        """axis names a strata axis whose levels each have their own force of infection."""
+        self.model = model
+        self.chain = model.chain_index[chain]
+        tb = model.chains[self.chain]
+        self.infectious = np.array([tb.state(name) for name in infectious])
+        self.susceptible, self.fast, self.slow = tb.state(susceptible), tb.state(fast), tb.state(slow)
+        self.axis = axis
+
+    def describe(self):
+        return {'class': type(self).__name__, 'chain': self.chain, 'infectious': self.infectious.tolist(),
+                'susceptible': int(self.susceptible), 'fast': int(self.fast), 'slow': int(self.slow),
+                'axis': self.axis}
+
+    def start(self, engine, values):
+        Dynamic.start(self, engine, values)
+        strata = engine.strata
+        if self.axis is not None:
+            if strata is None:
+                raise ValueError('TB transmission by %s needs an engine with strata' % self.axis)
+            a = [axis.name for axis in strata.axes].index(self.axis)
+            # Strata x levels indicator of each stratum's level on the axis
+            levels = strata.levels[:, a]
+            self.indicator = np.zeros((strata.size, len(strata.axes[a])))
+            self.indicator[np.arange(strata.size), levels] = 1.0
+            self.levels = levels
+
+    def prepare(self, values):
+        parameters = self.model.parameters
+        values = np.atleast_2d(values)
+
+        def column(slug, default=None):
+            i = parameters.index.get(slug)
+            if i is None or np.isnan(values[:, i]).any():
+                if default is None:
+                    raise KeyError('TB transmission needs Raw_input %s' % slug)
+                return np.ones(values.shape[0]) * default
+            return values[:, i]
+
+        self.infections = column('number_of_infections_per_infected') * column('trans_coeff', 1.0)
+        fast, slow = column('prop_fast'), column('prop_slow')
+        self.share_fast = fast / (fast + slow)
+
+    def update(self, cycle, occupancy, matrices):
+        engine = self.engine
+        if self.axis is None:
+            infectious = engine.population(occupancy)[0][self.chain][:, self.infectious].sum(axis=1)
+            risk = self.quarterly_risk(infectious)
+            risk, share_fast = engine.per_row(risk), engine.per_row(self.share_fast)
+        else:
+            # Share infectious within each level, weighted by stratum mass
+            k = engine.strata.size
+            mass = engine.mass.reshape(-1, k)
+            cases = (occupancy[self.chain][:, self.infectious].sum(axis=1).reshape(-1, k) * mass).dot(self.indicator)
+            people = mass.dot(self.indicator)
+            infectious = cases / np.maximum(people, 1e-300)
+            risk = self.quarterly_risk(infectious[:, self.levels], self.infections[:, None]).reshape(-1)
+            share_fast = engine.per_row(self.share_fast)
+        matrices = set_transition(matrices, self.chain, self.susceptible, self.fast, risk * share_fast)
+        return set_transition(matrices, self.chain, self.susceptible, self.slow, risk * (1.0 - share_fast))
+
+    def quarterly_risk(self, infectious, infections=None):
+        """Quarterly probability of infection given the share infectious."""
+        if infections is None:
+            infections = self.infections
+        return convert_year_to_qt(-np.expm1(-infections * infectious))
+
+    def population_risk(self, population):
+        """(fast, slow) quarterly probabilities for a microsimulated population.
+
+        prepare() must have been called with a single scenario's values.
+        """
+        infectious = population.counts[self.chain][self.infectious].sum() / max(population.size, 1)
+        risk = self.quarterly_risk(infectious)[0]
+        return risk * self.share_fast[0], risk * (1.0 - self.share_fast[0])
+
+    def population_transitions(self, population, living):
+        """Infection into Fast and Slow latent, the same for every susceptible person."""
+        fast, slow = self.population_risk(population)
+        return [(self.chain, self.susceptible, self.fast, fast), (self.chain, self.susceptible, self.slow, slow)]
+
+
+def inputs(parameters, values):
+    """Columns of values (scenarios x parameters) used by HIV transmission."""
+    slugs = ['general_parternships', 'trans_per_partnership', 'condom_use', 'condom_effectiveness',
+             'condom_use_sex_workers', 'csw_number_of_partners_per_year', 'num_partners_msm',
+             'condom_use_msm', 'condom_use_idus', 'partnerships_idus', 'num_injections_idu_annual']
+    missing = [slug for slug in slugs if slug not in parameters.index]
+    if missing:
+        raise KeyError('HIV transmission needs Raw_inputs: %s' % ', '.join(missing))
+    values = np.atleast_2d(values)
+    return dict((slug, values[:, parameters.index[slug]]) for slug in slugs)
+
+
+def partnerships(inputs, sizes):
+    """Partners a year and transmission per partnership, by kind of partnership.
+
+    sizes is the share of the population in each risk group (scenarios x
+    groups). Returns two kinds x scenarios x groups x groups arrays.
+    """
+    n, g = sizes.shape
+    partners = np.zeros((4, n, g, g))
+    beta = np.zeros((4, n, g, g))
+
+    def condoms(use):
+        return inputs['trans_per_partnership'] * (1.0 - use * inputs['condom_effectiveness'])
+
+    def mix(kind, members, others, rate, transmission):
+        # Proportional mixing: partnerships go to others in proportion to
+        # the partnerships they offer
+        offered = sizes[:, others] * rate[:, None]
+        share = offered / np.maximum(offered.sum(axis=1), 1e-300)[:, None]
+        for m in members:
+            partners[kind][:, m, others] = rate[:, None] * share
+            beta[kind][:, m, others] = transmission[:, None]
+
+    general = inputs['general_parternships']
+    men, women = [GENERAL_MEN, IDU_MEN], [GENERAL_WOMEN, IDU_WOMEN]
+    mix(0, men, women, general, condoms(inputs['condom_use']))
+    mix(0, women, men, general, condoms(inputs['condom_use']))
+    # IDUs' sexual partnerships use IDU condom use
+    for m, others in ((IDU_MEN, women), (IDU_WOMEN, men)):
+        beta[0][:, m, others] = condoms(inputs['condom_use_idus'])[:, None]
+    for m, others in ((GENERAL_WOMEN, [IDU_MEN]), (GENERAL_MEN, [IDU_WOMEN])):
+        beta[0][:, m, others] = condoms(inputs['condom_use_idus'])[:, None]
+
+    # Sex workers' clients, balanced so both sides count the same partnerships
+    clients = inputs['csw_number_of_partners_per_year']
+    commercial = condoms(inputs['condom_use_sex_workers'])
+    partners[1][:, SEX_WORKERS, GENERAL_MEN] = clients
+    partners[1][:, GENERAL_MEN, SEX_WORKERS] = clients * sizes[:, SEX_WORKERS] / \
+        np.maximum(sizes[:, GENERAL_MEN], 1e-300)
+    beta[1][:, SEX_WORKERS, GENERAL_MEN] = beta[1][:, GENERAL_MEN, SEX_WORKERS] = commercial
+
+    partners[2][:, MSM, MSM] = inputs['num_partners_msm']
+    beta[2][:, MSM, MSM] = condoms(inputs['condom_use_msm'])
+
+    sharing = inputs['partnerships_idus']
+    injections = inputs['num_injections_idu_annual'] / np.maximum(sharing, 1e-300)
+    needles = -np.expm1(injections * np.log1p(-TRANS_PER_INJECTION))
+    mix(3, [IDU_MEN, IDU_WOMEN], [IDU_MEN, IDU_WOMEN], sharing, needles)
+    return partners, beta
@@ -0,0 +1,158 @@
+from __future__ import division
+
+# Structural checks on a compiled model, run before it is simulated.
+#
+# Checks that depend on parameter values are vectorized over a whole matrix
+# of scenarios (the base case at compile time, every draw before a PSA), so
+# validating 100,000 draws costs about as much as building their transition
+# matrices once. Each problem found is an Issue:
+#
+#   errors    probabilities outside [0, 1] or a chain's outgoing
+#             probabilities summing to more than 1, which would make the
+#             cohort negative; a run is refused
+#   warnings  transitions that reference a missing state (and so were left
+#             out of the model), base values outside their low/high range,
+#             and states from which Death can never be reached
+#
+# With strict=True missing states and out-of-range inputs are errors too:
+# the model being run would not be the one in the database, or its draws
+# would not span the inputs' ranges. PSAs are checked strictly.
+#
+# check() raises ModelError if there are any errors and issues a
+# ModelWarning for each warning.
+
+import warnings
+from collections import namedtuple
+
+import numpy as np
+
+
+ERROR, WARNING = 'error', 'warning'
+
+# Rows may sum to slightly more than 1 through rounding in Tp_base values
+TOLERANCE = 1e-9
+
+Issue = namedtuple('Issue', ['severity', 'check', 'message'])
+
+
+class ModelError(ValueError):
+
+    def __init__(self, issues):
+        self.issues = issues
+        ValueError.__init__(self, '\n'.join(issue.message for issue in issues))
+
+
+class ModelWarning(UserWarning):
+    pass
+
+
+def validate(model, values=None, absorbing=('Death',), strict=False):
+    """Issues found in model, evaluated at values (scenarios x parameters).
+
+    values defaults to the base case. States named in absorbing are the
+    ones every state should be able to reach; chains without one are not
+    checked for reachability. strict makes missing states and inputs
+    outside their range errors.
+    """
+    if values is None:
+        values = model.parameters.evaluate(model.parameters.base(1))
+    values = np.atleast_2d(values)
+
+    severity = ERROR if strict else WARNING
+    issues = []
+    issues.extend(missing_states(model, severity))
+    issues.extend(input_ranges(model.parameters, severity))
+    namespace = model.parameters.namespace(values)
+    for chain in model.chains:
+        tps = model.tp_values(chain, values, namespace)
+        issues.extend(probability_ranges(chain, tps))
+        issues.extend(row_sums(chain, tps))
+        issues.extend(reachability(chain, tps, absorbing))
+    return issues
+
+
+def check(model, values=None, absorbing=('Death',), strict=False):
+    """Raise ModelError if model has errors; warn about everything else."""
+    issues = validate(model, values, absorbing, strict)
+    for issue in issues:
+        if issue.severity == WARNING:
+            warnings.warn(issue.message, ModelWarning, stacklevel=2)
+    errors = [issue for issue in issues if issue.severity == ERROR]
+    if errors:
+        raise ModelError(errors)
+    return issues
+
+
+def missing_states(model, severity=WARNING):
+    return [Issue(severity, 'missing_state',
+                  'Transition probability %s references a state that is missing or in '
+                  'another chain; it is not part of the model' % tp_id)
+            for tp_id in model.unresolved]
+
+
+def input_ranges(parameters, severity=WARNING):
+    issues = []
+    low = np.minimum(parameters.low, parameters.high)
+    high = np.maximum(parameters.low, parameters.high)
+    outside = (parameters.value < low) | (parameters.value > high)
+    for i in np.flatnonzero(outside):
+        slug = parameters.slugs[i]
+        if parameters.is_derived(slug):
+            continue
+        issues.append(Issue(severity, 'input_range', 'Raw_input %s has value %g outside [%g, %g]'
+                            % (slug, parameters.value[i], parameters.low[i], parameters.high[i])))
+    for i in np.flatnonzero(parameters.low > parameters.high):
+        issues.append(Issue(severity, 'input_range', 'Raw_input %s has low %g above high %g'
+                            % (parameters.slugs[i], parameters.low[i], parameters.high[i])))
+    return issues
+
+
+def probability_ranges(chain, tps):
+    """tps is scenarios x transitions, as returned by CompiledModel.tp_values."""
+    issues = []
+    bad = (tps < 0) | (tps > 1) | np.isnan(tps)
+    for j in np.flatnonzero(bad.any(axis=0)):
+        scenarios = np.flatnonzero(bad[:, j])
+        issues.append(Issue(ERROR, 'probability_range',
+                            '%s: transition probability %s (%s => %s) is %g in scenario %d '
+                            '(%d of %d scenarios outside [0, 1])'
+                            % (chain.name, chain.tp_ids[j], chain.state_names[chain.from_index[j]],
+                               chain.state_names[chain.to_index[j]], tps[scenarios[0], j],
+                               scenarios[0], len(scenarios), tps.shape[0])))
+    return issues
+
+
+def row_sums(chain, tps):
+    issues = []
+    sums = np.zeros((tps.shape[0], len(chain)))
+    for s in range(len(chain)):
+        sums[:, s] = tps[:, chain.from_index == s].sum(axis=1)
+    bad = sums > 1.0 + TOLERANCE
+    for s in np.flatnonzero(bad.any(axis=0)):
+        scenarios = np.flatnonzero(bad[:, s])
+        issues.append(Issue(ERROR, 'row_sum',
+                            '%s: probabilities out of %s sum to %g in scenario %d '
+                            '(%d of %d scenarios above 1)'
+                            % (chain.name, chain.state_names[s], sums[scenarios[0], s],
+                               scenarios[0], len(scenarios), tps.shape[0])))
+    return issues
+
+
+def reachability(chain, tps, absorbing=('Death',)):
+    """States that can never reach an absorbing state, in any scenario."""
+    targets = [s for s, name in enumerate(chain.state_names) if name in absorbing]
+    if not targets:
+        return []
+    s = len(chain)
+    # An edge exists if its probability can be non-zero: dynamic transitions
+    # are set by the engine each cycle, so always count
+    possible = chain.is_dynamic | (tps > 0).any(axis=0)
+    reach = np.eye(s, dtype=bool)
+    reach[chain.from_index[possible], chain.to_index[possible]] = True
+    # Transitive closure by repeated squaring
+    for _ in range(int(np.ceil(np.log2(max(s, 2))))):
+        reach = np.dot(reach.astype(int), reach.astype(int)) > 0
+    stuck = ~reach[:, targets].any(axis=1)
+    return [Issue(WARNING, 'reachability', '%s: %s can never reach %s'
+                  % (chain.name, chain.state_names[i], ' or '.join(chain.state_names[t] for t in targets)))
+            for i in np.flatnonzero(stuck)]
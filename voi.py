@@ -0,0 +1,241 @@
+from __future__ import division
+
+# Value of information for Limsa PSA outputs.
+#
+# The expected value of perfect information (EVPI) and of partial perfect
+# information (EVPPI) are computed from a matrix of PSA net benefits with one
+# row per draw and one column per strategy. EVPPI uses the non-nested
+# regression estimator of Strong, Oakley & Brennan (2014): the incremental net
+# benefit of every strategy is smoothed against the parameters of a group,
+# and the fitted values stand in for the inner conditional expectation that
+# nested Monte Carlo would otherwise have to simulate.
+#
+# Smoothers are penalized regressions (a GAM built from cubic regression
+# splines, or a low-rank Gaussian process) whose smoothing parameter is picked
+# by generalized cross validation. The GP's design grows with draws x
+# inducing points, so it is fitted to a random subsample of at most
+# GP_MAX_DRAWS draws (a few thousand suffice, as in Strong et al.) and its
+# EVPPI estimated over those; use the GAM to use every draw. The normal equations of every group are
+# padded to a common width so that the smoothing search and the solves for a
+# whole block of groups run as batched linear algebra.
+
+from collections import OrderedDict
+
+import numpy as np
+
+
+# Smoothing parameters tried by GCV, relative to the scale of the design
+LAMBDA_GRID = np.logspace(-7, 2, 10)
+
+# Memory budget for the design matrices held for a block of groups
+MAX_BLOCK_BYTES = 256 * 1024 * 1024
+
+# Draws the GP smoother is fitted to; more are subsampled
+GP_MAX_DRAWS = 5000
+
+
+def net_benefit(costs, effects, wtp):
+    """Net monetary benefit (draws x strategies) at willingness-to-pay wtp."""
+    return wtp * np.asarray(effects, dtype=float) - np.asarray(costs, dtype=float)
+
+
+def evpi(nb):
+    """Expected value of perfect information from draws x strategies net benefits."""
+    nb = np.asarray(nb, dtype=float)
+    return nb.max(axis=1).mean() - nb.mean(axis=0).max()
+
+
+def evppi(nb, params, names, groups, method='gam', n_knots=8,
+          n_inducing=200, max_interaction=4, seed=0, max_draws=GP_MAX_DRAWS):
+    """EVPPI for every parameter group.
+
+    nb is draws x strategies, params is draws x parameters with columns named
+    by names (Raw_input slugs), and groups maps a group label to a list of
+    slugs. Returns an OrderedDict of group label -> EVPPI in the units of nb.
+    With method='gp' at most max_draws draws, chosen at random, are used.
+    """
+    nb = np.asarray(nb, dtype=float)
+    params = np.asarray(params, dtype=float)
+    if nb.ndim != 2 or params.ndim != 2 or nb.shape[0] != params.shape[0]:
+        raise ValueError('nb and params must both have one row per draw')
+
+    column = dict((name, i) for i, name in enumerate(names))
+    labels = list(groups)
+    for label in labels:
+        missing = [slug for slug in groups[label] if slug not in column]
+        if missing:
+            raise KeyError('Group %s references unknown inputs: %s' % (label, ', '.join(missing)))
+
+    # Regress incremental net benefit against the first strategy; its own
+    # fitted value is identically zero
+    inb = nb[:, 1:] - nb[:, :1]
+    if inb.shape[1] == 0:
+        return OrderedDict((label, 0.0) for label in labels)
+
+    rng = np.random.RandomState(seed)
+    if method == 'gp' and max_draws is not None and nb.shape[0] > max_draws:
+        rows = np.sort(rng.choice(nb.shape[0], max_draws, replace=False))
+        params, inb = params[rows], inb[rows]
+    x = _standardize(params)
+
+    def design(label):
+        cols = [column[slug] for slug in groups[label]]
+        if method == 'gam':
+            return _gam_design(x[:, cols], n_knots, max_interaction)
+        elif method == 'gp':
+            return _gp_design(x[:, cols], n_inducing, rng)
+        raise ValueError('Unknown EVPPI method: %s' % method)
+
+    results = OrderedDict()
+    for block, designs in _blocks(labels, design):
+        for label, g in zip(block, _fit_block(designs, inb)):
+            results[label] = _evppi_from_fitted(g)
+    return results
+
+
+def groups_by_reference(raw_inputs, match=None):
+    """Group Raw_input slugs by the name of their reference.
+
+    match, if given, is a substring that the reference name must contain
+    (for example 'Dye' for all TB natural-history inputs cited to Dye); all
+    matching inputs are then returned as a single group.
+    """
+    groups = OrderedDict()
+    for raw_input in raw_inputs:
+        if raw_input.slug is None or raw_input.reference is None:
+            continue
+        name = raw_input.reference.name.strip()
+        if match is not None:
+            if match not in name:
+                continue
+            name = match
+        groups.setdefault(name, []).append(raw_input.slug)
+    return groups
+
+
+def _evppi_from_fitted(g):
+    # g is draws x (strategies - 1); the reference strategy contributes zero
+    best = np.maximum(g.max(axis=1), 0.0)
+    return max(best.mean() - max(g.mean(axis=0).max(), 0.0), 0.0)
+
+
+def _standardize(x):
+    lo = x.min(axis=0)
+    span = x.max(axis=0) - lo
+    span[span == 0] = 1.0
+    return (x - lo) / span
+
+
+#### ---------------- Smoothers -------------------------
+
+def _spline_basis(x, n_knots):
+    # Cubic regression spline in truncated power form on [0, 1]: a linear
+    # term (lightly penalized) plus one penalized column per interior knot
+    knots = np.percentile(x, np.linspace(0, 100, n_knots + 2)[1:-1])
+    basis = np.empty((x.shape[0], n_knots + 1))
+    basis[:, 0] = x - 0.5
+    basis[:, 1:] = np.maximum(x[:, None] - knots[None, :], 0.0) ** 3
+    penalty = np.ones(n_knots + 1)
+    penalty[0] = 1e-6
+    return basis, penalty
+
+
+def _gam_design(x, n_knots, max_interaction):
+    n, p = x.shape
+    columns = [np.ones((n, 1))]
+    penalties = [np.zeros(1)]
+    small = []
+    for j in range(p):
+        basis, penalty = _spline_basis(x[:, j], n_knots)
+        columns.append(basis)
+        penalties.append(penalty)
+        small.append(_spline_basis(x[:, j], 2))
+
+    # Tensor-product interactions between low-rank margins, as in te() terms,
+    # for groups small enough to afford them
+    if 1 < p <= max_interaction:
+        for a in range(p):
+            for b in range(a + 1, p):
+                (ba, pa), (bb, pb) = small[a], small[b]
+                columns.append((ba[:, :, None] * bb[:, None, :]).reshape(n, -1))
+                penalties.append(np.maximum(pa[:, None], pb[None, :]).ravel())
+
+    design = np.hstack(columns)
+    return design, np.diag(np.concatenate(penalties))
+
+
+def _gp_design(x, n_inducing, rng):
+    # Subset-of-regressors Gaussian process with a squared exponential kernel;
+    # the kernel ridge penalty K(Z, Z) plays the role of the GP prior
+    n = x.shape[0]
+    z = x[rng.choice(n, min(n_inducing, n), replace=False)]
+    d2 = ((z[:, None, :] - z[None, :, :]) ** 2).sum(axis=2)
+    lengthscale2 = np.median(d2[d2 > 0]) if (d2 > 0).any() else 1.0
+    kzz = np.exp(-0.5 * d2 / lengthscale2)
+    kxz = np.exp(-0.5 * _sqdist(x, z) / lengthscale2)
+
+    m = z.shape[0]
+    design = np.hstack([np.ones((n, 1)), kxz])
+    penalty = np.zeros((m + 1, m + 1))
+    penalty[1:, 1:] = kzz + 1e-8 * np.eye(m)
+    return design, penalty
+
+
+def _sqdist(x, z):
+    return np.maximum((x ** 2).sum(axis=1)[:, None] - 2.0 * np.dot(x, z.T)
+                      + (z ** 2).sum(axis=1)[None, :], 0.0)
+
+
+#### ---------------- Batched fitting -------------------------
+
+def _blocks(labels, design):
+    # Build designs lazily and hand them out in blocks that fit the budget
+    block, designs, size = [], [], 0
+    for label in labels:
+        d = design(label)
+        if block and size + d[0].nbytes > MAX_BLOCK_BYTES:
+            yield block, designs
+            block, designs, size = [], [], 0
+        block.append(label)
+        designs.append(d)
+        size += d[0].nbytes
+    if block:
+        yield block, designs
+
+
+def _fit_block(designs, y):
+    n, d = y.shape
+    k = max(design.shape[1] for design, _ in designs)
+    g = len(designs)
+
+    # Padding rows/columns of the normal equations carry a unit penalty and
+    # no data, so their coefficients are exactly zero and do not disturb the
+    # fit of narrower groups
+    XtX = np.zeros((g, k, k))
+    Xty = np.zeros((g, k, d))
+    S = np.zeros((g, k, k))
+    for i, (design, penalty) in enumerate(designs):
+        w = design.shape[1]
+        XtX[i, :w, :w] = np.dot(design.T, design)
+        Xty[i, :w] = np.dot(design.T, y)
+        S[i, :w, :w] = penalty
+        S[i, w:, w:] = np.eye(k - w)
+    yty = (y ** 2).sum()
+
+    scale = np.einsum('gkk->g', XtX) / np.maximum(np.einsum('gkk->g', S), 1e-12)
+    best_gcv = np.empty(g)
+    best_gcv.fill(np.inf)
+    best_beta = np.zeros((g, k, d))
+    for lam in LAMBDA_GRID:
+        A = XtX + (lam * scale)[:, None, None] * S
+        beta = np.linalg.solve(A, Xty)
+        rss = (yty - 2.0 * np.einsum('gkd,gkd->g', beta, Xty)
+               + np.einsum('gkd,gkl,gld->g', beta, XtX, beta))
+        edf = np.einsum('gkk->g', np.linalg.solve(A, XtX))
+        gcv = n * np.maximum(rss, 0.0) / np.maximum(n - edf, 1.0) ** 2
+        better = gcv < best_gcv
+        best_gcv[better] = gcv[better]
+        best_beta[better] = beta[better]
+
+    return [np.dot(design, best_beta[i, :design.shape[1]])
+            for i, (design, _) in enumerate(designs)]